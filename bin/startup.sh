@@ -24,6 +24,8 @@ touch /var/log/sync_repo.log && chown $HTTPD_USER /var/log/sync_repo.log && tail
 # create a data directory for persistent server data if it doesn't exist
 mkdir -p $DATA_DIR && chown apache:apache $DATA_DIR
 touch $DATA_DIR/.htpasswd && chown apache:apache $DATA_DIR/.htpasswd
+# admin users are added by hand: htpasswd $DATA_DIR/.htpasswd-admin <user>
+touch $DATA_DIR/.htpasswd-admin && chown apache:apache $DATA_DIR/.htpasswd-admin
 
 # start fastapi
 su -l $HTTPD_USER -s /bin/bash -c "cd /srv/app; nohup uvicorn app:app --host 0.0.0.0 --port 8089" &
@@ -1,18 +1,23 @@
-from fastapi import FastAPI, BackgroundTasks, Request, Depends
+from fastapi import FastAPI, BackgroundTasks, Request, Depends, Query, HTTPException
+from fastapi.responses import StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import HTTPBasicCredentials, HTTPBasic
 from typing import Annotated
 from models import models
-from db import db
+from db import db, async_db
 from util import git_utils
+from util.repo_status_cache import etag_matches
 from sys import stdout
 from util.httpd_utils import add_httpd_user
 from secrets import token_urlsafe
-from scheduler import init_scheduler
-from typing import Optional, Literal
+from scheduler import init_scheduler, request_sync
+from util.sync_hook import SYNC_HOOK_SECRET, SIGNATURE_HEADER, verify_signature
+from typing import Optional, Literal, Union
 
 from contextlib import asynccontextmanager
 
 import logging
+import json
 import requests
 from datetime import datetime, timedelta
 
@@ -22,60 +27,218 @@ logger = logging.getLogger()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    git_utils.trust_upstream_host()
-    git_utils.clone_repo()
-    init_scheduler()
+    git_utils.trust_upstream_hosts()
+    git_utils.upstream_agent.start()
+    git_utils.clone_repos()
+    db.load_client_registry()
+    if db.REPO_ACCESS_WRITE_BEHIND:
+        db.access_buffer.start()
+    scheduler = init_scheduler()
     yield
+    scheduler.shutdown(wait=False)
+    if db.REPO_ACCESS_WRITE_BEHIND:
+        db.access_buffer.stop()
+    await async_db.async_engine.dispose()
+    git_utils.sync_pool.shutdown(cancel_futures=True)
+    git_utils.upstream_agent.stop()
 
 app = FastAPI(lifespan=lifespan)
 
 security = HTTPBasic()
 
 @app.get('/public')
-def get_public():
+async def get_public():
     """ Sample endpoint that's publicly accessible """
     return {"message": "This is a public route!" }
 
-@app.get('/public/repo-status')
-def get_repo_status() -> models.RepoListing:
-    """ Return the name and latest commit of the git repo """
-    return git_utils.get_repo_status()
+@app.get('/public/cache-stats')
+async def get_cache_stats():
+    """ Return the size and hit/miss counts of the server's in-memory caches, and the number
+    of requests waiting on a command queue """
+    return {
+        "client_registry": db.client_registry.stats(),
+        "command_waiters": db.command_notifier.stats(),
+        "git_refs": {name: repo.refs.stats() for name, repo in git_utils.repos.items()},
+        "repo_status": {name: repo.status_cache.stats() for name, repo in git_utils.repos.items()},
+    }
+
+def _get_repo(repo_name: Optional[str]) -> git_utils.UpstreamRepo:
+    """ Get the served repo with the given name, or the default repo if no name is given """
+    if (repo := git_utils.get_repo(repo_name)) is None:
+        raise HTTPException(404, f"Repo {repo_name} is not served")
+    return repo
+
+async def _repo_status(repo: git_utils.UpstreamRepo) -> tuple[models.RepoListing, str, bytes]:
+    """ Get the cached status of the given repo. On a miss the repo is read in the threadpool,
+    so the event loop isn't held up by git """
+    return repo.status_cache.get_cached() or await run_in_threadpool(repo.status_cache.get)
+
+async def _repo_status_response(request: Request, repo: git_utils.UpstreamRepo) -> Response:
+    """ Respond with the status of the given repo, or with a bodiless 304 if the request's
+    If-None-Match matches its ETag """
+    _, etag, body = await _repo_status(repo)
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag_matches(request.headers.get('if-none-match'), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+@app.get('/public/repo-status', response_model=models.RepoListing)
+async def get_repo_status(request: Request):
+    """ Return the name and latest commit of the default git repo. The ETag is the commit hash, so
+    clients can poll with If-None-Match and get a bodiless 304 until the repo changes """
+    return await _repo_status_response(request, _get_repo(None))
+
+@app.get('/public/repo-status/{repo_name}', response_model=models.RepoListing)
+async def get_named_repo_status(repo_name: str, request: Request):
+    """ Return the name and latest commit of the given git repo, with the same ETag handling as
+    /public/repo-status """
+    return await _repo_status_response(request, _get_repo(repo_name))
+
+@app.post('/public/sync-hook', status_code=202)
+async def sync_hook(request: Request):
+    """ Webhook for the upstream to call on a push, signed with SYNC_HOOK_SECRET. Schedules a
+    sync of the pushed repo, debounced so that a burst of pushes leads to a single sync. Syncs
+    every repo if the payload doesn't name a served repo """
+    if not SYNC_HOOK_SECRET:
+        raise HTTPException(404, "Sync hook is not configured")
+    body = await request.body()
+    if not verify_signature(SYNC_HOOK_SECRET, body, request.headers.get(SIGNATURE_HEADER)):
+        raise HTTPException(403, "Invalid signature")
+    try:
+        repo_name = (json.loads(body).get('repository') or {}).get('name')
+    except (ValueError, AttributeError):
+        repo_name = None
+    request_sync(repo_name if repo_name in git_utils.repos else None)
+    return { "status": "scheduled" }
 
 @app.get('/public/client-status')
-def get_client_statuses(
+async def get_client_statuses(
         report_time: Optional[datetime] = None, 
         auth_state: Optional[models.AuthStateQuery] = models.AuthStateQuery.ANY,
-        latest_commit: Optional[bool] = None) -> list[models.ClientStatus]:
-    """ Get the list of active clients to the server, and the sync status of their git repos """
-    return db.get_client_status_report(report_time, auth_state, latest_commit)
+        latest_commit: Optional[bool] = None,
+        after: Optional[str] = None,
+        limit: Annotated[Optional[int], Query(ge=0)] = None,
+        format: Literal['json', 'ndjson'] = 'json') -> list[models.ClientStatus]:
+    """ Get the list of active clients to the server, and the sync status of their git repos.
+    Clients are ordered by name: Pass the name of the last client in a page as 'after' to
+    fetch the next page. The 'ndjson' format streams one client per line as rows are read.
+    """
+    if format == 'ndjson':
+        statuses = async_db.stream_client_status_report(report_time, auth_state, latest_commit, after, limit)
+        return StreamingResponse(
+            (status.model_dump_json() + '\n' async for status in statuses),
+            media_type='application/x-ndjson')
+    return await async_db.get_client_status_report(report_time, auth_state, latest_commit, after, limit)
+
+@app.get('/public/client-status/summary')
+async def get_client_status_summary(
+        report_time: Optional[datetime] = None,
+        auth_state: Optional[models.AuthStateQuery] = models.AuthStateQuery.ANY,
+        latest_commit: Optional[bool] = None) -> models.ClientStatusSummary:
+    """ Get the number of clients in each auth state and on each commit, with the same filters
+    as /public/client-status """
+    return await async_db.get_client_status_summary(report_time, auth_state, latest_commit)
 
 @app.get('/private/verify-auth')
-def verify_auth(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
+async def verify_auth(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
     """ Sanity check basic-auth gated endpoint. Used by clients to confirm that
     handshake protocol succeeded. Auth is handled at the httpd layer.
     """
     return { "whoami": credentials.username }
 
 @app.post('/private/log-repo-access')
-def log_repo_access(repo: models.RepoListing, credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
-    """ Endpoints for clients to report that they successfully pulled a git repo. """
-    db.log_client_repo_access(credentials.username, repo.commit_hash)
+async def log_repo_access(repo: models.RepoListing, credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
+    """ Endpoints for clients to report that they successfully pulled a git repo. As with
+    check-in, a repo that isn't served is rejected """
+    repo_name = _get_repo(repo.name).name
+    if db.REPO_ACCESS_WRITE_BEHIND:
+        await async_db.buffer_client_repo_access(credentials.username, repo.commit_hash, repo_name)
+    else:
+        await async_db.log_client_repo_access(credentials.username, repo.commit_hash, repo_name)
     return { "status": "acknowledged" }
 
+@app.post('/private/check-in')
+async def check_in(check_in: models.CheckInRequest, credentials: Annotated[HTTPBasicCredentials, Depends(security)]) -> models.CheckInResponse:
+    """ Single call for clients to make at the start of each cycle: Records the client's access to
+    its current commit, and returns the latest commit of the repo and the head of the client's
+    command queue """
+    repo = _get_repo(check_in.repo)
+    command_queue = await async_db.check_in(credentials.username, check_in.commit_hash, repo.name)
+    return models.CheckInResponse(
+        whoami=credentials.username,
+        repo=(await _repo_status(repo))[0],
+        command_queue=command_queue)
+
 @app.get('/private/command-queue')
-def get_next_command(credentials: Annotated[HTTPBasicCredentials, Depends(security)]) -> models.CommandQueueResponse:
-    """ Get the next command in the authenticated client's command queue """
-    return db.get_next_command(credentials.username)
+async def get_next_command(
+        credentials: Annotated[HTTPBasicCredentials, Depends(security)],
+        wait: Annotated[float, Query(ge=0, le=async_db.COMMAND_QUEUE_MAX_WAIT_SECONDS)] = 0,
+        max_commands: Annotated[Optional[int], Query(alias='max', ge=1, le=async_db.COMMAND_QUEUE_MAX_BATCH)] = None
+        ) -> Union[models.CommandQueueResponse, models.CommandQueueBatchResponse]:
+    """ Get the next command in the authenticated client's command queue, or if 'max' is given,
+    up to that many commands from the head of the queue. If the queue is empty, wait up to 'wait'
+    seconds for a command to arrive before responding """
+    if wait:
+        return await async_db.wait_for_command(credentials.username, wait, max_commands)
+    if max_commands is not None:
+        return await async_db.get_next_commands(credentials.username, max_commands)
+    return await async_db.get_next_command(credentials.username)
+
+@app.get('/public/command-queue/metrics')
+async def get_command_queue_metrics() -> models.CommandQueueMetrics:
+    """ Get the depth of each client's command queue and the latency of recent commands. Served
+    from a snapshot that's refreshed periodically, so may be up to a refresh interval old """
+    return await async_db.get_queue_metrics()
+
+@app.get('/private/command-queue/stream')
+async def stream_commands(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
+    """ Server-sent event stream of the authenticated client's command queue. Sends the queue
+    length and head as an event whenever they change, and a comment as a keepalive otherwise """
+    async def _events():
+        async for response in async_db.stream_commands(credentials.username):
+            yield ": keepalive\n\n" if response is None else f"data: {response.model_dump_json()}\n\n"
+    return StreamingResponse(_events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 @app.post('/private/command-queue')
-def complete_command(
+async def complete_command(
         completion_status: models.CommandQueueCompletionRequest,
         credentials: Annotated[HTTPBasicCredentials, Depends(security)]) -> models.CommandQueueResponse:
     """ Mark the head of the authenticated client's command queue as complete """
-    return db.dequeue_command(credentials.username, completion_status.status)
+    return await async_db.dequeue_command(credentials.username, completion_status.status)
+
+@app.post('/private/command-queue/batch')
+async def complete_commands(
+        request: models.CommandQueueBatchCompletionRequest,
+        credentials: Annotated[HTTPBasicCredentials, Depends(security)]) -> models.CommandQueueResponse:
+    """ Mark several commands handed out to the authenticated client as complete, all or none at once """
+    if len(request.completions) > async_db.COMMAND_QUEUE_MAX_BATCH:
+        raise HTTPException(400, f"At most {async_db.COMMAND_QUEUE_MAX_BATCH} commands can be completed at once")
+    return await async_db.dequeue_commands(
+        credentials.username, [(completion.id, completion.status) for completion in request.completions])
+
+@app.post('/admin/command-queue/broadcast')
+async def broadcast_command(request: models.CommandBroadcastRequest) -> models.CommandBroadcastResponse:
+    """ Enqueue a command for a list of clients, or for every client matching the given client
+    status filters. Auth is handled at the httpd layer """
+    enqueued = await async_db.enqueue_commands(
+        request.command, request.priority, request.client_names,
+        request.report_time, request.auth_state, request.latest_commit)
+    logger.info(f"Broadcast command to {enqueued} clients")
+    return models.CommandBroadcastResponse(enqueued=enqueued)
+
+@app.get('/admin/command-history')
+async def get_command_history(
+        client_name: Optional[str] = None,
+        status: Optional[models.DbCommandStatus] = None,
+        before: Optional[datetime] = None,
+        limit: Annotated[int, Query(ge=1, le=1000)] = 100) -> list[models.CommandHistoryEntry]:
+    """ Get completed commands, newest first, including those moved to the archive. Pass the
+    completion time of the last command in a page as 'before' to fetch the next page """
+    return await async_db.get_command_history(client_name, status, before, limit)
 
 def follow_up_challenge(request: models.ChallengeInitiateRequest, challenge: models.ChallengeInitiateResponse):
-    """ Background task that follows up on a challenge initiated by a client. """
+    """ Background task that follows up on a challenge initiated by a client. Runs in the
+    threadpool since it blocks on the client's callback, so it uses the sync db API """
     logger.info(f"C/R: Sending callback to {request.callback_address}")
     credentials = models.ChallengeCompleteRequest(
         id_secret=challenge.id_secret,
@@ -102,6 +265,6 @@ async def post_initiate_challenge(request: models.ChallengeInitiateRequest, back
     negotiation protocol.
     """
     logger.info(f"C/R: Received challenge request from {request.client_name}")
-    challenge = db.create_auth_session(request.client_name)
+    challenge = await async_db.create_auth_session(request.client_name)
     background_tasks.add_task(follow_up_challenge, request, challenge)
     return challenge
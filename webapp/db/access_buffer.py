@@ -0,0 +1,73 @@
+from datetime import datetime
+from typing import Callable
+import threading
+import logging
+
+logger = logging.getLogger()
+
+
+class RepoAccessBuffer:
+    """ Write-behind buffer for client repo access reports. Reports are coalesced in memory,
+    keeping only the latest access time for each (client id, repo, commit hash), and a background
+    thread hands them to flush_func in a single batch every flush_ms milliseconds, or sooner
+    once max_entries distinct reports are waiting.
+    """
+    def __init__(self, flush_ms: int, max_entries: int, flush_func: Callable[[dict[tuple[str, str, str], datetime]], None]):
+        self.flush_ms = flush_ms
+        self.max_entries = max_entries
+        self._flush_func = flush_func
+        self._entries: dict[tuple[str, str, str], datetime] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread = None
+
+    def record(self, client_id: str, repo: str, commit_hash: str, access_time: datetime = None):
+        """ Buffer a report that the given client accessed the given commit of the given repo """
+        access_time = access_time or datetime.now()
+        with self._lock:
+            key = (client_id, repo, commit_hash)
+            if key not in self._entries or self._entries[key] < access_time:
+                self._entries[key] = access_time
+            if len(self._entries) >= self.max_entries:
+                self._wake.set()
+
+    def flush(self) -> int:
+        """ Write out every buffered report, returning the number written """
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        if not entries:
+            return 0
+
+        try:
+            self._flush_func(entries)
+        except Exception:
+            logger.exception(f"Failed to flush {len(entries)} repo access reports, retrying on next flush")
+            for (client_id, repo, commit_hash), access_time in entries.items():
+                self.record(client_id, repo, commit_hash, access_time)
+            return 0
+        return len(entries)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_ms / 1000)
+            self._wake.clear()
+            self.flush()
+
+    def start(self):
+        """ Start the background flusher thread """
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name='repo-access-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background flusher thread, then write out any remaining reports """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,177 @@
+""" Async counterparts of the functions in db.py, for use from the FastAPI event loop.
+
+Reads run on an aiosqlite-backed AsyncSession. Writes are handed to the same serialized
+writer thread as the sync API and awaited, so the event loop never blocks on the write lock.
+"""
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from os import environ
+from models import models
+from fastapi import HTTPException
+from datetime import datetime
+from typing import AsyncIterator, Optional, Union
+import asyncio
+from . import db
+from .db import SQLITE_PRAGMAS, DbCommandStatus, apply_sqlite_pragmas
+from .command_queue import COMMAND_LEASE
+from .client_state_report import query_client_states, client_states_statement, summarize_client_states
+
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{environ['DATA_DIR']}/db.sqlite")
+apply_sqlite_pragmas(async_engine.sync_engine, SQLITE_PRAGMAS)
+
+AsyncDbSession = async_sessionmaker(bind=async_engine)
+
+# Number of rows fetched from the database at a time when streaming a report
+STREAM_BATCH_SIZE = int(environ.get('STREAM_BATCH_SIZE', 500))
+
+# Longest a command queue long-poll may wait, kept below the proxy's 60 second timeout
+COMMAND_QUEUE_MAX_WAIT_SECONDS = float(environ.get('COMMAND_QUEUE_MAX_WAIT_SECONDS', 50))
+# How often a command queue stream sends a keepalive if nothing has changed
+COMMAND_STREAM_KEEPALIVE_SECONDS = float(environ.get('COMMAND_STREAM_KEEPALIVE_SECONDS', 15))
+# How often a command queue stream rereads the queue without being notified of a change, to pick up
+# changes made by another process. Well within the lease, so that a streamed head stays leased
+COMMAND_STREAM_RECHECK_SECONDS = float(environ.get('COMMAND_STREAM_RECHECK_SECONDS', COMMAND_LEASE.total_seconds() / 2))
+# Most commands a client can claim or complete in one request
+COMMAND_QUEUE_MAX_BATCH = int(environ.get('COMMAND_QUEUE_MAX_BATCH', 100))
+
+async def _write(write_func, *args, **kwargs):
+    """ Run a @write_transaction function from db.py on the writer thread """
+    return await asyncio.wrap_future(db.writer.submit(write_func.__wrapped__, *args, **kwargs))
+
+
+async def create_auth_session(client_name: str) -> models.ChallengeInitiateResponse:
+    """ Create a new challenge session in the database """
+    return await _write(db.create_auth_session, client_name)
+
+async def activate_auth_session(client_name: str, challenge_secret: str, expires: datetime):
+    """ Activate an auth session in the database after the handshake protocol succeeds """
+    return await _write(db.activate_auth_session, client_name, challenge_secret, expires)
+
+async def fail_auth_session(client_name: str, challenge_secret: str):
+    """ Fail an auth session in the database after the handshake protocol fails """
+    return await _write(db.fail_auth_session, client_name, challenge_secret)
+
+async def log_client_repo_access(client_name: str, git_hash: str, repo: str = db.DEFAULT_REPO):
+    """ Update the state of the given client's latest access to the given repo """
+    return await _write(db.log_client_repo_access, client_name, git_hash, repo)
+
+async def buffer_client_repo_access(client_name: str, git_hash: str, repo: str = db.DEFAULT_REPO):
+    """ Queue a report of the given client's access to the given repo for the next batch write """
+    async with AsyncDbSession() as session:
+        client_id = await session.run_sync(db.client_registry.get_client_id, client_name)
+    if client_id is None:
+        raise HTTPException(404, "Given client name is invalid")
+    db.access_buffer.record(client_id, repo, git_hash)
+
+async def log_commit_fetch(commit_hash: str, commit_time: datetime, repo: str = db.DEFAULT_REPO):
+    """ Log that a new commit has been pulled from the upstream of the given repo """
+    return await _write(db.log_commit_fetch, commit_hash, commit_time, repo)
+
+async def get_client_status_report(report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                                   latest_commit: bool = None, after: str = None, limit: int = None) -> list[models.ClientStatus]:
+    """ Get the current auth token status and repo access times for each client """
+    async with AsyncDbSession() as session:
+        client_states = await session.run_sync(query_client_states, report_time, auth_state, latest_commit, after, limit)
+        return [models.ClientStatus.from_db(s) for s in client_states]
+
+async def stream_client_status_report(report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                                      latest_commit: bool = None, after: str = None, limit: int = None) -> AsyncIterator[models.ClientStatus]:
+    """ Stream the current auth token status and repo access times for each client, fetching
+    rows from the database in batches as they're consumed """
+    async with AsyncDbSession() as session:
+        statement = client_states_statement(report_time, auth_state, latest_commit, after, limit)
+        rows = await session.stream(statement, execution_options={'yield_per': STREAM_BATCH_SIZE})
+        async for row in rows:
+            yield models.ClientStatus.from_db(row)
+
+async def get_client_status_summary(report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                                    latest_commit: bool = None) -> models.ClientStatusSummary:
+    """ Get the number of clients in each auth state and on each commit """
+    async with AsyncDbSession() as session:
+        return models.ClientStatusSummary.from_counts(
+            *await session.run_sync(summarize_client_states, report_time, auth_state, latest_commit))
+
+async def enqueue_command(client_name: str, command: str, priority: int = 1, created: datetime = None):
+    return await _write(db.enqueue_command, client_name, command, priority, created)
+
+async def enqueue_commands(command: str, priority: int = 1, client_names: list[str] = None,
+                           report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                           latest_commit: bool = None) -> int:
+    """ Enqueue a command for each of the given clients, or each client matching the given filters """
+    return await _write(db.enqueue_commands, command, priority, client_names, report_time, auth_state, latest_commit)
+
+async def get_next_command(client_name: str) -> models.CommandQueueResponse:
+    """ Get the next incomplete command in the client's command queue """
+    return await _write(db.get_next_command, client_name)
+
+async def check_in(client_name: str, commit_hash: Optional[str], repo: str = db.DEFAULT_REPO) -> models.CommandQueueResponse:
+    """ Record the client's access to the given commit and get the next command in its queue """
+    if commit_hash is not None and db.REPO_ACCESS_WRITE_BEHIND:
+        await buffer_client_repo_access(client_name, commit_hash, repo)
+        commit_hash = None
+    return await _write(db.check_in, client_name, commit_hash, repo)
+
+async def get_next_commands(client_name: str, max_commands: int) -> models.CommandQueueBatchResponse:
+    """ Get up to max_commands incomplete commands from the head of the client's command queue """
+    return await _write(db.get_next_commands, client_name, max_commands)
+
+async def wait_for_command(client_name: str, wait: float, max_commands: int = None) -> Union[models.CommandQueueResponse, models.CommandQueueBatchResponse]:
+    """ Get the next incomplete command in the client's command queue, or up to max_commands
+    commands if given. If the queue is empty, wait up to the given number of seconds for a command
+    to be enqueued before returning """
+    deadline = asyncio.get_running_loop().time() + wait
+    while True:
+        with db.command_notifier.subscribe(client_name) as queue_changed:
+            if max_commands is None:
+                response = await get_next_command(client_name)
+                found = response.command is not None
+            else:
+                response = await get_next_commands(client_name, max_commands)
+                found = bool(response.commands)
+            remaining = deadline - asyncio.get_running_loop().time()
+            if found or remaining <= 0:
+                return response
+            # The queue is read once more after a timeout, to pick up commands enqueued by another process
+            await asyncio.wait({queue_changed}, timeout=remaining)
+
+async def stream_commands(client_name: str, keepalive: float = COMMAND_STREAM_KEEPALIVE_SECONDS,
+                          recheck: float = COMMAND_STREAM_RECHECK_SECONDS) -> AsyncIterator[Optional[models.CommandQueueResponse]]:
+    """ Yield the state of the client's command queue whenever it changes, claiming each new head
+    as it's reached. Yields None if nothing has changed in keepalive seconds. Reading the queue is a
+    write, so it's only reread when notified of a change, or every recheck seconds """
+    loop = asyncio.get_running_loop()
+    last_response = None
+    while True:
+        with db.command_notifier.subscribe(client_name) as queue_changed:
+            response = await get_next_command(client_name)
+            if response != last_response:
+                last_response = response
+                yield response
+            recheck_at = loop.time() + recheck
+            while (remaining := recheck_at - loop.time()) > 0:
+                changed, _ = await asyncio.wait({queue_changed}, timeout=min(keepalive, remaining))
+                if changed:
+                    break
+                yield None
+
+async def dequeue_commands(client_name: str, completions: list[tuple[str, DbCommandStatus]]) -> models.CommandQueueResponse:
+    """ Mark each of the given (command id, status) as either successful or failed, then return the count of commands left in the queue """
+    return await _write(db.dequeue_commands, client_name, completions)
+
+async def get_command_history(client_name: str = None, status: DbCommandStatus = None, before: datetime = None,
+                              limit: int = 100) -> list[models.CommandHistoryEntry]:
+    """ Get completed commands, newest first, including those moved to the archive """
+    async with AsyncDbSession() as session:
+        rows = await session.run_sync(db.query_command_history, client_name, status, before, limit)
+        return [models.CommandHistoryEntry.model_validate(row, from_attributes=True) for row in rows]
+
+async def get_queue_metrics() -> models.CommandQueueMetrics:
+    """ Get the latest snapshot of the command queue metrics, computing it if there isn't one yet """
+    metrics = db.queue_metrics.get()
+    if metrics is None:
+        async with AsyncDbSession() as session:
+            metrics = await session.run_sync(db.queue_metrics.refresh)
+    return metrics
+
+async def dequeue_command(client_name: str, command_status: DbCommandStatus) -> models.CommandQueueResponse:
+    """ Mark a command as either successful or failed, then return the count of commands left in the queue"""
+    return await _write(db.dequeue_command, client_name, command_status)
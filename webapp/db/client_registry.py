@@ -0,0 +1,61 @@
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from .db_schema import DbClient
+from typing import Optional
+import threading
+import time
+
+
+class ClientRegistry:
+    """ In-memory cache of client name -> (id, valid), so that resolving the identity of the
+    client behind each private request doesn't cost a query. Entries expire after a TTL to pick
+    up changes made outside this process, and are refreshed explicitly when clients are added
+    or invalidated through db.py. Unknown names aren't cached, so new clients are found at once.
+    """
+    def __init__(self, ttl_seconds: float):
+        self._ttl = ttl_seconds
+        # name -> (id, valid, expiry as a time.monotonic() value)
+        self._clients: dict[str, tuple[str, bool, float]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, session: Session):
+        """ Replace the contents of the registry with every client in the database """
+        rows = session.execute(select(DbClient.name, DbClient.id, DbClient.valid)).all()
+        expiry = time.monotonic() + self._ttl
+        with self._lock:
+            self._clients = {name: (id, bool(valid), expiry) for name, id, valid in rows}
+
+    def set(self, name: str, id: str, valid: bool):
+        """ Record the current id and validity of a client """
+        with self._lock:
+            self._clients[name] = (id, valid, time.monotonic() + self._ttl)
+
+    def invalidate(self, name: str = None):
+        """ Drop the given client from the registry, or every client if no name is given """
+        with self._lock:
+            if name is None:
+                self._clients.clear()
+            else:
+                self._clients.pop(name, None)
+
+    def get_client_id(self, session: Session, name: str) -> Optional[str]:
+        """ Get the id of the valid client with the given name, or None if there isn't one """
+        with self._lock:
+            entry = self._clients.get(name)
+            if entry and entry[2] > time.monotonic():
+                self.hits += 1
+                return entry[0] if entry[1] else None
+            self.misses += 1
+
+        row = session.execute(select(DbClient.id, DbClient.valid).where(DbClient.name == name)).first()
+        if row is None:
+            self.invalidate(name)
+            return None
+        self.set(name, row.id, bool(row.valid))
+        return row.id if row.valid else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._clients), 'hits': self.hits, 'misses': self.misses}
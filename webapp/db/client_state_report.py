@@ -1,15 +1,18 @@
-from sqlalchemy import select, text
-from db.db_schema import DbGitCommit, DbClientStateView
+from sqlalchemy import select, text, delete, or_, TextClause
+from sqlalchemy.dialects.sqlite import insert
+from db.db_schema import DbGitCommit, DbClientStateView, DbClientLatestState, DbClientAuthEvent, DbClientCommitAccess
 from sqlalchemy.orm import Session
 from models.models import AuthStateQuery
 from datetime import datetime, timedelta
 from functools import wraps
 
-# SQL literal for generating a report on 
-REPORT_SQL = """
+# SQL literal for finding the latest auth session and repo access of each client as of a given time.
+# CROSS JOIN keeps client as the outer loop, so each client's latest row is looked up by index
+# rather than scanning the history table
+LATEST_STATE_CTE_SQL = """
 WITH latest_auth AS (
     SELECT client_auth_sessions.* FROM client
-    LEFT JOIN client_auth_sessions ON client.id = client_auth_sessions.client_id
+    CROSS JOIN client_auth_sessions ON client.id = client_auth_sessions.client_id
     WHERE client_auth_sessions.id = (
         SELECT id FROM client_auth_sessions
         WHERE client_auth_sessions.client_id = client.id
@@ -19,7 +22,7 @@ WITH latest_auth AS (
     )
 ), latest_commit AS (
     SELECT client_commit_access.* FROM client
-    LEFT JOIN client_commit_access ON client.id = client_commit_access.client_id
+    CROSS JOIN client_commit_access ON client.id = client_commit_access.client_id
     WHERE client_commit_access.id = (
         SELECT id FROM client_commit_access
         WHERE client_commit_access.client_id = client.id
@@ -28,37 +31,217 @@ WITH latest_auth AS (
         LIMIT 1
     )
 )
-SELECT 
+"""
+
+# SQL literal for whether a client's latest access, given as {access}, was of the newest commit of
+# its repo as of the report time
+ON_LATEST_COMMIT_SQL = """COALESCE({access}.commit_hash = (
+    SELECT commit_hash FROM repo_commits
+    WHERE repo_commits.repo = {access}.repo
+    AND commit_time <= :report_time
+    ORDER BY commit_time DESC
+    LIMIT 1
+), 0)"""
+
+# SQL literal for generating a report on the state of each client at a point in history
+REPORT_SQL = LATEST_STATE_CTE_SQL + """
+SELECT
     client.id, client.name,
-    CASE 
+    CASE
         WHEN latest_auth.auth_state = 'SUCCESSFUL' AND latest_auth.expires < :report_time THEN 'EXPIRED'
         ELSE latest_auth.auth_state
-    END auth_state, 
+    END auth_state,
     latest_auth.initiated, latest_auth.expires,
-    latest_commit.commit_hash, latest_commit.access_time
+    latest_commit.commit_hash, latest_commit.repo, latest_commit.access_time
 FROM client
 LEFT JOIN latest_auth ON latest_auth.client_id = client.id
 LEFT JOIN latest_commit ON latest_commit.client_id = client.id
 -- TODO These are some ugly where clauses to handle nullable fields
 WHERE (:auth_state = 'ANY' OR latest_auth.auth_state = :auth_state OR (:auth_state IS NULL AND latest_auth.auth_state is NULL))
-AND   (:latest_commit IS NULL OR (COALESCE(latest_commit.commit_hash = :commit_hash, 0)) = :latest_commit)
+AND   (:latest_commit IS NULL OR """ + ON_LATEST_COMMIT_SQL.format(access='latest_commit') + """ = :latest_commit)
 """
 
-def query_client_states(session: Session, report_time: datetime = None, auth_state: AuthStateQuery = 'ANY', latest_commit: bool = None) -> list[DbClientStateView]:
-    """ Query the database for the last-reported state of every client at the given timestamp,
-    optionally filtering on a given state """
-    report_timestamp = report_time or datetime.now()
+# SQL literal for generating a report on the current state of each client from the
+# incrementally maintained client_latest_state table. Mirrors the semantics of REPORT_SQL
+LATEST_STATE_SQL = """
+SELECT
+    client.id, client.name,
+    CASE
+        WHEN latest.auth_state = 'SUCCESSFUL' AND latest.expires < :report_time THEN 'EXPIRED'
+        ELSE latest.auth_state
+    END auth_state,
+    latest.initiated, latest.expires,
+    latest.commit_hash, latest.repo, latest.access_time
+FROM client
+LEFT JOIN client_latest_state latest ON latest.client_id = client.id
+WHERE (:auth_state = 'ANY' OR latest.auth_state = :auth_state OR (:auth_state IS NULL AND latest.auth_state is NULL))
+AND   (:latest_commit IS NULL OR """ + ON_LATEST_COMMIT_SQL.format(access='latest') + """ = :latest_commit)
+"""
+
+# SQL literal for restricting a client state report to valid clients
+VALID_CLIENTS_SQL = """
+AND   client.valid
+"""
 
-    commit_hash = session.scalars(select(DbGitCommit)
-        .where(DbGitCommit.commit_time <= report_timestamp)
-        .order_by(DbGitCommit.commit_time.desc())
-        .limit(1)).first().commit_hash if latest_commit is not None else None
+# SQL literal for paginating a client state report by client name
+PAGINATION_SQL = """
+AND   client.name > :after
+ORDER BY client.name
+LIMIT :limit
+"""
 
-    return session.query(DbClientStateView).from_statement(text(REPORT_SQL)).params({
-        'report_time': report_timestamp,
+# SQL literal for repopulating client_latest_state from the full history
+REBUILD_LATEST_STATE_SQL = """
+INSERT INTO client_latest_state (client_id, auth_event_id, auth_state, initiated, expires, commit_hash, repo, access_time)
+""" + LATEST_STATE_CTE_SQL + """
+SELECT
+    client.id, latest_auth.id, latest_auth.auth_state, latest_auth.initiated, latest_auth.expires,
+    latest_commit.commit_hash, latest_commit.repo, latest_commit.access_time
+FROM client
+LEFT JOIN latest_auth ON latest_auth.client_id = client.id
+LEFT JOIN latest_commit ON latest_commit.client_id = client.id
+"""
+
+# SQL literal for counting clients in each auth state on each commit, over the rows of a client state
+# report. Followed in the same query by a 'latest' row with the newest commit of each repo as of the
+# report time, so that the summary can tell which clients are on the latest commit
+SUMMARY_SQL = """
+SELECT 'count' AS kind, COALESCE(report.auth_state, 'NONE') AS auth_state, report.repo, report.commit_hash, count(*) AS client_count
+FROM ({report_sql}) AS report
+GROUP BY 2, 3, 4
+UNION ALL
+-- SQLite takes the bare commit_hash column from the row with the max commit_time.
+-- Commits with no repo are skipped, since they would have no key in the summary
+SELECT 'latest', NULL, repo, commit_hash, max(commit_time)
+FROM repo_commits
+WHERE commit_time <= :report_time AND repo IS NOT NULL
+GROUP BY repo
+"""
+
+def _client_states_query(report_time: datetime, auth_state: AuthStateQuery, latest_commit: bool,
+                         after: str, limit: int) -> tuple[str, dict]:
+    """ Get the SQL and parameters of a client state report """
+    return REPORT_SQL if report_time else LATEST_STATE_SQL, {
+        'report_time': report_time or datetime.now(),
         'auth_state': None if auth_state == AuthStateQuery.NONE else auth_state.value,
         'latest_commit': latest_commit,
-        'commit_hash': commit_hash
-    }).all()
- 
+        # Every client name sorts after the empty string, and a negative limit is no limit
+        'after': after or '',
+        'limit': -1 if limit is None else limit
+    }
+
+def client_states_statement(report_time: datetime = None, auth_state: AuthStateQuery = AuthStateQuery.ANY,
+                            latest_commit: bool = None, after: str = None, limit: int = None,
+                            valid_only: bool = False) -> TextClause:
+    """ Build the query for the last-reported state of every client at the given timestamp,
+    optionally filtering on a given state, and to valid clients. Clients are ordered by name,
+    starting after the given name and returning at most limit clients. The current state is read
+    from client_latest_state, historical states are computed from the full history """
+    sql, params = _client_states_query(report_time, auth_state, latest_commit, after, limit)
+    return text(sql + (VALID_CLIENTS_SQL if valid_only else "") + PAGINATION_SQL).bindparams(**params)
+
+def query_client_states(session: Session, report_time: datetime = None, auth_state: AuthStateQuery = AuthStateQuery.ANY,
+                        latest_commit: bool = None, after: str = None, limit: int = None,
+                        valid_only: bool = False) -> list[DbClientStateView]:
+    """ Query the database for the last-reported state of every client at the given timestamp,
+    optionally filtering on a given state and to valid clients, and paginating by client name """
+    statement = client_states_statement(report_time, auth_state, latest_commit, after, limit, valid_only)
+    return session.query(DbClientStateView).from_statement(statement).all()
+
+
+def summarize_client_states(session: Session, report_time: datetime = None, auth_state: AuthStateQuery = AuthStateQuery.ANY,
+                            latest_commit: bool = None) -> tuple[dict[str, str], list[tuple[str, str, str, int]]]:
+    """ Count the clients in each (auth state, repo, commit hash) among the clients that
+    query_client_states would return. Returns the latest commit hash of each repo as of
+    report_time, and the counts """
+    sql, params = _client_states_query(report_time, auth_state, latest_commit, None, None)
+    latest_commits, counts = {}, []
+    for kind, auth_state_name, repo, commit_hash, client_count in session.execute(text(SUMMARY_SQL.format(report_sql=sql)), params):
+        if kind == 'latest':
+            latest_commits[repo] = commit_hash
+        else:
+            counts.append((auth_state_name, repo, commit_hash, client_count))
+    return latest_commits, counts
+
+
+def update_latest_auth_state(session: Session, auth_event: DbClientAuthEvent):
+    """ Record the given auth session in the client's latest state, unless a more recently
+    initiated session has already been recorded """
+    values = {
+        'auth_event_id': auth_event.id,
+        'auth_state': auth_event.auth_state,
+        'initiated': auth_event.initiated,
+        'expires': auth_event.expires,
+    }
+    stmt = insert(DbClientLatestState).values(client_id=auth_event.client_id, **values)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[DbClientLatestState.client_id],
+        set_=values,
+        where=or_(
+            DbClientLatestState.auth_event_id == auth_event.id,
+            DbClientLatestState.initiated == None,
+            DbClientLatestState.initiated <= stmt.excluded.initiated)))
+
+
+def update_latest_repo_access(session: Session, client_access: DbClientCommitAccess):
+    """ Record the given repo access in the client's latest state, unless a more recent
+    access has already been recorded """
+    update_latest_repo_accesses(session, [client_access])
+
+
+def update_latest_repo_accesses(session: Session, client_accesses: list[DbClientCommitAccess]):
+    """ Record a batch of repo accesses in their clients' latest states, keeping the most recent
+    access of each client """
+    stmt = insert(DbClientLatestState.__table__)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[DbClientLatestState.client_id],
+        set_={'commit_hash': stmt.excluded.commit_hash, 'repo': stmt.excluded.repo, 'access_time': stmt.excluded.access_time},
+        where=or_(
+            DbClientLatestState.access_time == None,
+            DbClientLatestState.access_time <= stmt.excluded.access_time)),
+        [{'client_id': a.client_id, 'commit_hash': a.commit_hash, 'repo': a.repo, 'access_time': a.access_time}
+         for a in client_accesses])
+
+
+def rebuild_latest_states(session: Session):
+    """ Repopulate client_latest_state from the full auth session and repo access history """
+    session.execute(delete(DbClientLatestState))
+    session.execute(text(REBUILD_LATEST_STATE_SQL), {'report_time': datetime.max})
+
+
+def check_latest_states(session: Session) -> list[tuple[str, tuple, tuple]]:
+    """ Compare the current report generated from client_latest_state against the report
+    generated from the full history. Returns (client name, expected, actual) for each mismatch """
+    params = {
+        'report_time': datetime.now(),
+        'auth_state': 'ANY',
+        'latest_commit': None,
+    }
+    expected = {row.name: tuple(row) for row in session.execute(text(REPORT_SQL), params)}
+    actual = {row.name: tuple(row) for row in session.execute(text(LATEST_STATE_SQL), params)}
+
+    return [(name, expected.get(name), actual.get(name))
+            for name in sorted(expected.keys() | actual.keys())
+            if expected.get(name) != actual.get(name)]
+
+
+if __name__ == '__main__':
+    # Maintenance commands for client_latest_state, run from the webapp directory:
+    # python3 -m db.client_state_report [rebuild|check]
+    import sys
+    from db.db import DbSession
 
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    with DbSession() as session:
+        if command == 'rebuild':
+            rebuild_latest_states(session)
+            session.commit()
+            print("Rebuilt client_latest_state from history")
+        elif command == 'check':
+            mismatches = check_latest_states(session)
+            for name, expected, actual in mismatches:
+                print(f"{name}: expected {expected}, found {actual}")
+            print(f"{len(mismatches)} inconsistent client(s)")
+            sys.exit(1 if mismatches else 0)
+        else:
+            sys.exit(f"Unknown command {command}, expected one of: rebuild, check")
@@ -0,0 +1,53 @@
+from contextlib import contextmanager
+from typing import Iterator
+import asyncio
+import threading
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+class CommandNotifier:
+    """ Wakes requests that are waiting on a client's command queue when it changes, so that
+    clients can long-poll rather than repeatedly polling an empty queue. Waiters subscribe on the
+    event loop, and writers notify from the writer thread once their transaction is committed.
+    Only changes made through this process are seen, so waiters should still recheck the queue
+    after a timeout.
+    """
+    def __init__(self):
+        # client name -> futures to resolve on the next change to that client's queue
+        self._waiters: dict[str, set[asyncio.Future]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def subscribe(self, client_name: str) -> Iterator[asyncio.Future]:
+        """ Get a future that resolves on the next change to the given client's queue. Subscribe
+        before reading the queue, so that a change made in between isn't missed. Must be called
+        from the event loop """
+        future = asyncio.get_running_loop().create_future()
+        with self._lock:
+            self._waiters.setdefault(client_name, set()).add(future)
+        try:
+            yield future
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(client_name)
+                if waiters is not None:
+                    waiters.discard(future)
+                    if not waiters:
+                        del self._waiters[client_name]
+
+    def notify(self, client_name: str):
+        """ Wake every request waiting on the given client's queue. Safe to call from any thread """
+        with self._lock:
+            waiters = self._waiters.pop(client_name, set())
+        for future in waiters:
+            future.get_loop().call_soon_threadsafe(_resolve, future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'clients': len(self._waiters),
+                'waiters': sum(len(waiters) for waiters in self._waiters.values()),
+            }
@@ -0,0 +1,100 @@
+from sqlalchemy import select, update, bindparam, text
+from sqlalchemy.orm import Session
+from db.db_schema import DbClient, DbCommandQueueEntry
+from datetime import datetime, timedelta
+from os import environ
+
+# How long a client has to complete a command it's been handed before it's handed out again
+COMMAND_LEASE = timedelta(seconds=float(environ.get('COMMAND_LEASE_SECONDS', 600)))
+# A command whose lease expires after it's been handed out this many times is failed instead
+COMMAND_MAX_ATTEMPTS = int(environ.get('COMMAND_MAX_ATTEMPTS', 3))
+
+# SQL literal for recounting the incomplete commands of each client whose counter has drifted
+REPAIR_QUEUE_LENGTHS_SQL = """
+UPDATE client SET queue_length = (
+    SELECT count(*) FROM client_command_queue
+    WHERE client_command_queue.client_id = client.id
+    AND client_command_queue.completed IS NULL
+)
+WHERE queue_length != (
+    SELECT count(*) FROM client_command_queue
+    WHERE client_command_queue.client_id = client.id
+    AND client_command_queue.completed IS NULL
+)
+"""
+
+# SQL literal for comparing each client's counter against its incomplete commands
+CHECK_QUEUE_LENGTHS_SQL = """
+SELECT client.name, client.queue_length, count(client_command_queue.id) AS pending
+FROM client
+LEFT JOIN client_command_queue ON client_command_queue.client_id = client.id
+    AND client_command_queue.completed IS NULL
+GROUP BY client.id
+HAVING client.queue_length != pending
+"""
+
+def supports_returning(session: Session) -> bool:
+    """ UPDATE ... RETURNING needs SQLite 3.35, which is newer than some distributions ship """
+    return session.get_bind().dialect.update_returning
+
+def adjust_queue_length(session: Session, client_id: str, delta: int) -> int:
+    """ Add delta to the client's count of incomplete commands, returning the new count """
+    client = DbClient.__table__
+    adjust = (update(client)
+        .where(client.c.id == client_id)
+        .values(queue_length=client.c.queue_length + delta))
+    if supports_returning(session):
+        return session.scalar(adjust.returning(client.c.queue_length))
+    session.execute(adjust)
+    return session.scalar(select(client.c.queue_length).where(client.c.id == client_id))
+
+def adjust_queue_lengths(session: Session, deltas: dict[str, int]):
+    """ Add to the counts of incomplete commands of many clients, given as client id -> delta """
+    if not deltas:
+        return
+    client = DbClient.__table__
+    session.execute(update(client)
+        .where(client.c.id == bindparam('client_id'))
+        .values(queue_length=client.c.queue_length + bindparam('delta')),
+        [{'client_id': client_id, 'delta': delta} for client_id, delta in deltas.items()])
+
+def lease_in_progress_commands(session: Session) -> int:
+    """ Give each command that was handed out before leases were tracked a lease starting now,
+    returning the number of commands leased """
+    queue = DbCommandQueueEntry.__table__
+    return session.execute(update(queue)
+        .where(queue.c.completed == None)
+        .where(queue.c.acknowledged != None)
+        .where(queue.c.lease_expires == None)
+        .values(lease_expires=datetime.now() + COMMAND_LEASE, attempts=1)).rowcount
+
+def repair_queue_lengths(session: Session) -> int:
+    """ Recount the incomplete commands of every client from client_command_queue, returning
+    the number of clients whose count was wrong """
+    return session.execute(text(REPAIR_QUEUE_LENGTHS_SQL)).rowcount
+
+def check_queue_lengths(session: Session) -> list[tuple[str, int, int]]:
+    """ Returns (client name, stored count, actual count) for each client whose count is wrong """
+    return [tuple(row) for row in session.execute(text(CHECK_QUEUE_LENGTHS_SQL))]
+
+
+if __name__ == '__main__':
+    # Maintenance commands for the per-client queue length counters, run from the webapp directory:
+    # python3 -m db.command_queue [repair|check]
+    import sys
+    from db.db import DbSession
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    with DbSession() as session:
+        if command == 'repair':
+            repaired = repair_queue_lengths(session)
+            session.commit()
+            print(f"Repaired the queue length of {repaired} client(s)")
+        elif command == 'check':
+            mismatches = check_queue_lengths(session)
+            for name, stored, actual in mismatches:
+                print(f"{name}: stored {stored}, found {actual}")
+            print(f"{len(mismatches)} inconsistent client(s)")
+            sys.exit(1 if mismatches else 0)
+        else:
+            sys.exit(f"Unknown command {command}, expected one of: repair, check")
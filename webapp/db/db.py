@@ -1,35 +1,155 @@
-from sqlalchemy import create_engine, select, func
+from sqlalchemy import create_engine, select, insert, update, union_all, func, case, bindparam, event, tuple_, Engine
 from sqlalchemy.orm import sessionmaker, Session
-from .db_schema import Base, DbClient, DbClientAuthEvent, DbAuthState, DbClientCommitAccess, DbClientAuthChallenge, DbGitCommit, DbCommandQueueEntry, DbCommandStatus
-from .client_state_report import query_client_states
+from .db_schema import _gen_uuid, Base, DbClient, DbClientAuthEvent, DbAuthState, DbClientCommitAccess, DbClientAuthChallenge, DbGitCommit, DbCommandQueueEntry, DbCommandArchiveEntry, DbCommandStatus, DbClientLatestState, DbRepoSync
+from .client_state_report import query_client_states, summarize_client_states, update_latest_auth_state, update_latest_repo_access, update_latest_repo_accesses
+from .migrations import migrate
+from .client_registry import ClientRegistry
+from .access_buffer import RepoAccessBuffer
+from .command_queue import supports_returning, adjust_queue_length, adjust_queue_lengths, COMMAND_LEASE, COMMAND_MAX_ATTEMPTS
+from .command_notifier import CommandNotifier
+from .queue_metrics import QueueMetricsCache
+from util.repos import DEFAULT_REPO
 from os import environ
 from models import models
 from fastapi import HTTPException
 from secrets import token_urlsafe
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import wraps
+import threading
 from datetime import datetime
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
 
 logger = logging.getLogger()
 
-engine = create_engine(f"sqlite:///{environ['DATA_DIR']}/db.sqlite")
+# SQLite performance profile applied to each new connection
+SQLITE_PRAGMAS = {
+    # Readers see a consistent snapshot without blocking on, or blocking, the writer
+    'journal_mode': environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    # How long a connection waits on another process's write lock before failing
+    'busy_timeout': environ.get('SQLITE_BUSY_TIMEOUT_MS', '5000'),
+    # Only fsync at WAL checkpoints. Durable across application crashes, but not power loss
+    'synchronous': environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)),
+    # Negative values are in KiB rather than pages
+    'cache_size': environ.get('SQLITE_CACHE_SIZE', str(-64 * 1024)),
+}
+
+def apply_sqlite_pragmas(engine: Engine, pragmas: dict[str, str]):
+    """ Apply the given pragmas to every new connection made by the engine """
+    @event.listens_for(engine, "connect")
+    def _apply_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+def create_db_engine(db_url: str, pragmas: dict[str, str] = SQLITE_PRAGMAS) -> Engine:
+    """ Create an engine for the given SQLite database with the given performance profile """
+    engine = create_engine(db_url)
+    apply_sqlite_pragmas(engine, pragmas)
+    return engine
+
+
+# Key in Session.info for callbacks to run once a write transaction is committed
+AFTER_COMMIT_KEY = 'after_commit'
+
+def after_commit(session: Session, callback):
+    """ Run the given callback once the current write transaction has been committed """
+    session.info.setdefault(AFTER_COMMIT_KEY, []).append(callback)
+
+
+class SerializedWriter:
+    """ Runs write transactions one at a time on a dedicated thread. Writers queue up in-process
+    rather than contending for SQLite's single write lock, and never hold it while waiting on
+    each other, so readers aren't stalled behind a pile-up of writers
+    """
+    def __init__(self, session_factory: sessionmaker):
+        self._session_factory = session_factory
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._thread_id = None
+
+    def _transaction(self, func, *args, **kwargs):
+        self._thread_id = threading.get_ident()
+        with self._session_factory() as session:
+            result = func(session, *args, **kwargs)
+            session.commit()
+            for callback in session.info.get(AFTER_COMMIT_KEY, []):
+                callback()
+            return result
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """ Queue func(session, *args, **kwargs) to run in its own transaction """
+        return self._executor.submit(self._transaction, func, *args, **kwargs)
+
+    def run(self, func, *args, **kwargs):
+        """ Run func(session, *args, **kwargs) in its own transaction and return its result """
+        if threading.get_ident() == self._thread_id:
+            raise RuntimeError("Write transactions can't be nested")
+        return self.submit(func, *args, **kwargs).result()
+
 
-Base.metadata.create_all(engine)
+engine = create_db_engine(f"sqlite:///{environ['DATA_DIR']}/db.sqlite")
+
+migrate(engine)
 
 DbSession = sessionmaker(bind=engine)
 
-def _get_client_by_name(session: Session, client_name: str) -> DbClient:
-    """ Get a client by name """
-    return session.scalar(select(DbClient).where(DbClient.name == client_name).where(DbClient.valid == True))
+writer = SerializedWriter(DbSession)
+
+client_registry = ClientRegistry(float(environ.get('CLIENT_REGISTRY_TTL_SECONDS', 60)))
+
+command_notifier = CommandNotifier()
+
+# Latencies in the command queue metrics are of commands handled within this window
+queue_metrics = QueueMetricsCache(timedelta(minutes=float(environ.get('QUEUE_METRICS_WINDOW_MINUTES', 60))))
+
+def write_transaction(func):
+    """ Run the decorated function in its own transaction on the writer thread. The function
+    takes the session as its first argument, which is omitted by callers. The undecorated
+    function remains available as __wrapped__ """
+    @wraps(func)
+    def _write(*args, **kwargs):
+        return writer.run(func, *args, **kwargs)
+    return _write
+
+def _get_client_id(session: Session, client_name: str) -> str:
+    """ Get the id of a valid client by name, or None if there isn't one """
+    return client_registry.get_client_id(session, client_name)
+
+def refresh_queue_metrics():
+    """ Recompute the cached command queue metrics """
+    with DbSession() as session:
+        queue_metrics.refresh(session)
+
+def load_client_registry():
+    """ Populate the client registry with every client in the database """
+    with DbSession() as session:
+        client_registry.load(session)
+
+@write_transaction
+def add_client(session: Session, client_name: str) -> str:
+    """ Register a new client, returning its id """
+    client = DbClient(client_name)
+    client_id = client.id
+    session.add(client)
+    after_commit(session, lambda: client_registry.set(client_name, client_id, True))
+    return client_id
+
+@write_transaction
+def invalidate_client(session: Session, client_name: str):
+    """ Revoke a client's permission to connect to the server """
+    session.execute(update(DbClient).where(DbClient.name == client_name).values(valid=False))
+    after_commit(session, lambda: client_registry.invalidate(client_name))
 
 def _get_pending_auth_session(session: Session, client_name: str, challenge_secret: str) -> DbClientAuthEvent:
-    client = _get_client_by_name(session, client_name)
-    if client is None:
+    client_id = _get_client_id(session, client_name)
+    if client_id is None:
         raise HTTPException(401, "Given client name is invalid")
 
     auth_session : DbClientAuthEvent = session.scalar(select(DbClientAuthEvent)
         .join(DbClientAuthEvent.challenge)
-        .where(DbClientAuthEvent.client_id == client.id)
+        .where(DbClientAuthEvent.client_id == client_id)
         .where(DbClientAuthEvent.auth_state == DbAuthState.PENDING)
         .where(DbClientAuthChallenge.challenge_secret  == challenge_secret))
     if auth_session is None:
@@ -37,137 +157,384 @@ def _get_pending_auth_session(session: Session, client_name: str, challenge_secr
     return auth_session
 
 
-def create_auth_session(client_name: str) -> models.ChallengeInitiateResponse:
+@write_transaction
+def create_auth_session(session: Session, client_name: str) -> models.ChallengeInitiateResponse:
     """ Create a new challenge session in the database """
-    with DbSession() as session:
-        client = _get_client_by_name(session, client_name)
-        if client is None:
-            raise HTTPException(404, "Given client name is invalid")
-        
-        auth_event = DbClientAuthEvent(client.id)
-        auth_challenge = DbClientAuthChallenge(auth_event.id, token_urlsafe(16), token_urlsafe(16))
-
-        session.add(auth_event)
-        session.add(auth_challenge)
-
-        session.commit()
-
-        return models.ChallengeInitiateResponse(
-            id_secret=auth_challenge.id_secret, challenge_secret=auth_challenge.challenge_secret)
-        
-
-def activate_auth_session(client_name: str, challenge_secret: str, expires: datetime):
+    client_id = _get_client_id(session, client_name)
+    if client_id is None:
+        raise HTTPException(404, "Given client name is invalid")
+    
+    auth_event = DbClientAuthEvent(client_id)
+    auth_challenge = DbClientAuthChallenge(auth_event.id, token_urlsafe(16), token_urlsafe(16))
+
+    session.add(auth_event)
+    session.add(auth_challenge)
+    update_latest_auth_state(session, auth_event)
+
+    return models.ChallengeInitiateResponse(
+        id_secret=auth_challenge.id_secret, challenge_secret=auth_challenge.challenge_secret)
+    
+
+@write_transaction
+def activate_auth_session(session: Session, client_name: str, challenge_secret: str, expires: datetime):
     """ Activate an auth session in the database after the handshake protocol succeeds """
-    with DbSession() as session:
-        auth_session = _get_pending_auth_session(session, client_name, challenge_secret)
-        auth_session.activate(expires)
-        session.add(auth_session)
-        session.delete(auth_session.challenge)
-        session.commit()
-
-        return True # TODO what other information do we need here?
-
-def fail_auth_session(client_name: str, challenge_secret: str):
-    """ Fail an auth session in the database after the handshake protocol fails 
-    # TODO clear these out on a regular basis
+    auth_session = _get_pending_auth_session(session, client_name, challenge_secret)
+    auth_session.activate(expires)
+    session.add(auth_session)
+    update_latest_auth_state(session, auth_session)
+    session.delete(auth_session.challenge)
+
+    return True # TODO what other information do we need here?
+
+@write_transaction
+def fail_auth_session(session: Session, client_name: str, challenge_secret: str):
+    """ Fail an auth session in the database after the handshake protocol fails. Challenges
+    of handshakes that never complete are cleared out by the retention job (see retention.py)
     """
-    with DbSession() as session:
-        auth_session = _get_pending_auth_session(session, client_name, challenge_secret)
-        auth_session.fail()
-        session.add(auth_session)
-        session.delete(auth_session.challenge)
-        session.commit()
+    auth_session = _get_pending_auth_session(session, client_name, challenge_secret)
+    auth_session.fail()
+    session.add(auth_session)
+    update_latest_auth_state(session, auth_session)
+    session.delete(auth_session.challenge)
 
-        return True # TODO what other information do we need here?
+    return True # TODO what other information do we need here?
 
-def log_client_repo_access(client_name: str, git_hash: str):
+@write_transaction
+def log_client_repo_access(session: Session, client_name: str, git_hash: str, repo: str = DEFAULT_REPO):
     """ Update the state of the given client's latest access to the given repo """
-    with DbSession() as session:
-        client = _get_client_by_name(session, client_name)
-        if client is None:
-            raise HTTPException(404, "Given client name is invalid")
-        client_access = session.scalar(select(DbClientCommitAccess)
-            .where(DbClientCommitAccess.client_id == client.id)
-            .where(DbClientCommitAccess.commit_hash == git_hash))
+    client_id = _get_client_id(session, client_name)
+    if client_id is None:
+        raise HTTPException(404, "Given client name is invalid")
+    client_access = session.scalar(select(DbClientCommitAccess)
+        .where(DbClientCommitAccess.client_id == client_id)
+        .where(DbClientCommitAccess.commit_hash == git_hash)
+        .where(DbClientCommitAccess.repo == repo))
+    if client_access is None:
+        client_access = DbClientCommitAccess(client_id, git_hash, repo=repo)
+    
+    client_access.access_time = datetime.now()
+
+    session.add(client_access)
+    update_latest_repo_access(session, client_access)
+
+@write_transaction
+def log_client_repo_accesses(session: Session, accesses: dict[tuple[str, str, str], datetime]):
+    """ Record a batch of repo accesses, given as (client id, repo, commit hash) -> access time """
+    access_keys = list(accesses.keys())
+    existing = {}
+    # Stay well below SQLite's limit on bound parameters per statement
+    for i in range(0, len(access_keys), 300):
+        existing.update({(a.client_id, a.repo, a.commit_hash): a for a in session.scalars(select(DbClientCommitAccess)
+            .where(tuple_(DbClientCommitAccess.client_id, DbClientCommitAccess.repo, DbClientCommitAccess.commit_hash)
+                   .in_(access_keys[i:i + 300])))})
+
+    client_accesses = []
+    for (client_id, repo, commit_hash), access_time in accesses.items():
+        client_access = existing.get((client_id, repo, commit_hash))
         if client_access is None:
-            client_access = DbClientCommitAccess(client.id, git_hash)
-        
-        client_access.access_time = datetime.now()
+            client_access = DbClientCommitAccess(client_id, commit_hash, repo=repo)
+            session.add(client_access)
+        if client_access.access_time is None or client_access.access_time < access_time:
+            client_access.access_time = access_time
+        client_accesses.append(client_access)
 
-        session.add(client_access)
-        session.commit()
+    session.flush()
+    update_latest_repo_accesses(session, client_accesses)
 
-def log_commit_fetch(commit_hash: str, commit_time: datetime):
-    """ Log that a new commit has been pulled from the upstream """
-    with DbSession() as session:
-        exiting_commit = session.scalar(select(DbGitCommit).where(DbGitCommit.commit_hash == commit_hash))
-        if exiting_commit is not None:
-            return # No-op
-        
-        session.add(DbGitCommit(commit_hash, commit_time))
-        session.commit()
+# Optionally buffer client repo access reports in memory and write them out in batches
+REPO_ACCESS_WRITE_BEHIND = environ.get('REPO_ACCESS_WRITE_BEHIND', 'false').lower() == 'true'
 
+access_buffer = RepoAccessBuffer(
+    int(environ.get('REPO_ACCESS_FLUSH_MS', 1000)),
+    int(environ.get('REPO_ACCESS_FLUSH_ENTRIES', 1000)),
+    log_client_repo_accesses)
 
-def get_client_status_report(report_time: datetime = None, auth_state: models.AuthStateQuery = None, latest_commit: bool = None) -> list[models.ClientAccessStatus]:
+def buffer_client_repo_access(client_name: str, git_hash: str, repo: str = DEFAULT_REPO):
+    """ Queue a report of the given client's access to the given repo for the next batch write """
+    with DbSession() as session:
+        client_id = _get_client_id(session, client_name)
+    if client_id is None:
+        raise HTTPException(404, "Given client name is invalid")
+    access_buffer.record(client_id, repo, git_hash)
+
+@write_transaction
+def log_commit_fetch(session: Session, commit_hash: str, commit_time: datetime, repo: str = DEFAULT_REPO):
+    """ Log that a new commit has been pulled from the upstream of the given repo """
+    exiting_commit = session.get(DbGitCommit, (commit_hash, repo))
+    if exiting_commit is not None:
+        return # No-op
+    
+    session.add(DbGitCommit(commit_hash, commit_time, repo))
+
+@write_transaction
+def log_repo_sync(session: Session, repo: str, started: datetime, changed: bool, commit_hash: str, stage_seconds: dict[str, float]):
+    """ Record a sync of the given repo with its upstream, and the time taken by each of its stages """
+    session.add(DbRepoSync(repo, started, changed, commit_hash, stage_seconds))
+
+
+def get_client_status_report(report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                             latest_commit: bool = None, after: str = None, limit: int = None) -> list[models.ClientStatus]:
     """ Get the current auth token status and repo access times for each client """
     with DbSession() as session:
-        client_states = query_client_states(session, report_time, auth_state, latest_commit)
+        client_states = query_client_states(session, report_time, auth_state, latest_commit, after, limit)
         return [models.ClientStatus.from_db(s) for s in client_states]
 
 
-def _get_queue_info(session: Session, client_name: str) -> tuple[int, DbCommandQueueEntry]:
-    """ Return the queue length and head of the command queue for a given client """
-    client = _get_client_by_name(session, client_name)
-    queue_length = session.scalar(select(func.count()).select_from(DbCommandQueueEntry)
-        .where(DbCommandQueueEntry.client_id == client.id)
-        .where(DbCommandQueueEntry.completed == None))
-    next_command = session.scalar(select(DbCommandQueueEntry)
-        .where(DbCommandQueueEntry.client_id == client.id)
-        .where(DbCommandQueueEntry.completed == None)
-        .order_by(DbCommandQueueEntry.priority.desc(), DbCommandQueueEntry.created.asc()))
-    return queue_length, next_command
-
-def enqueue_command(client_name: str, command: str, priority: int = 1, created: datetime = None):
-    with DbSession() as session:
-        client = _get_client_by_name(session, client_name)
-        queue_entry = DbCommandQueueEntry(client.id, command, priority)
-        queue_entry.created = created or datetime.now()
-        session.add(queue_entry)
-        session.commit()
-
-def get_next_command(client_name: str) -> models.CommandQueueResponse:
-    """ Get the next incomplete command in the client's command queue """
+def get_client_status_summary(report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                              latest_commit: bool = None) -> models.ClientStatusSummary:
+    """ Get the number of clients in each auth state and on each commit """
     with DbSession() as session:
-        queue_length, next_command = _get_queue_info(session, client_name)
+        return models.ClientStatusSummary.from_counts(
+            *summarize_client_states(session, report_time, auth_state, latest_commit))
 
-        # Mark the command as acknowledged if it isn't yet
-        if next_command and not next_command.acknowledged:
-            next_command.acknowledged = datetime.now()
-            next_command.status = DbCommandStatus.IN_PROGRESS
-            session.add(next_command)
 
-        session.commit()
+# Aliased copy of the command queue table, so subqueries of an UPDATE on the queue aren't
+# correlated with the row being updated
+_queued = DbCommandQueueEntry.__table__.alias('queued')
 
-        return models.CommandQueueResponse(
-            queue_length=queue_length, 
-            command=next_command.command if next_command else None)
+def _queue_client_id(session: Session, client_name: str) -> str:
+    client_id = _get_client_id(session, client_name)
+    if client_id is None:
+        raise HTTPException(404, "Given client name is invalid")
+    return client_id
+
+def _queue_head_id(client_id: str):
+    """ Subquery selecting the id of the first incomplete command in the client's queue """
+    return (select(_queued.c.id)
+        .where(_queued.c.client_id == client_id)
+        .where(_queued.c.completed == None)
+        .order_by(_queued.c.priority.desc(), _queued.c.created.asc())
+        .limit(1)
+        .scalar_subquery())
 
-def dequeue_command(client_name: str, command_status: DbCommandStatus) -> models.CommandQueueResponse:
+def _get_queue_info(session: Session, client_name: str) -> tuple[int, DbCommandQueueEntry]:
+    """ Return the queue length and head of the command queue for a given client. The length is
+    read from the client's counter, so both come back from a single indexed lookup """
+    client_id = _queue_client_id(session, client_name)
+    row = session.execute(select(DbClient.queue_length, DbCommandQueueEntry)
+        .select_from(DbClient)
+        .outerjoin(DbCommandQueueEntry, DbCommandQueueEntry.id == _queue_head_id(client_id))
+        .where(DbClient.id == client_id)).first()
+    return (row.queue_length, row.DbCommandQueueEntry) if row else (0, None)
+
+@write_transaction
+def enqueue_command(session: Session, client_name: str, command: str, priority: int = 1, created: datetime = None):
+    client_id = _queue_client_id(session, client_name)
+    queue_entry = DbCommandQueueEntry(client_id, command, priority)
+    queue_entry.created = created or datetime.now()
+    session.add(queue_entry)
+    adjust_queue_length(session, client_id, 1)
+    after_commit(session, lambda: command_notifier.notify(client_name))
+
+@write_transaction
+def enqueue_commands(session: Session, command: str, priority: int = 1, client_names: list[str] = None,
+                     report_time: datetime = None, auth_state: models.AuthStateQuery = models.AuthStateQuery.ANY,
+                     latest_commit: bool = None) -> int:
+    """ Enqueue a command for each of the given clients or, if no clients are given, for each valid
+    client matching the given client status report filters. All commands are inserted in a single
+    transaction. Returns the number of commands enqueued """
+    if client_names is not None:
+        client_ids = {name: _get_client_id(session, name) for name in client_names}
+        unknown_names = [name for name, client_id in client_ids.items() if client_id is None]
+        if unknown_names:
+            raise HTTPException(404, f"Given client names are invalid: {', '.join(unknown_names)}")
+    else:
+        client_states = query_client_states(session, report_time, auth_state, latest_commit, valid_only=True)
+        client_ids = {state.name: state.id for state in client_states}
+
+    created = datetime.now()
+    if client_ids:
+        session.execute(insert(DbCommandQueueEntry), [
+            {'id': _gen_uuid(), 'client_id': client_id, 'command': command, 'priority': priority,
+             'created': created, 'status': DbCommandStatus.PENDING}
+            for client_id in client_ids.values()])
+        adjust_queue_lengths(session, {client_id: 1 for client_id in client_ids.values()})
+    after_commit(session, lambda: [command_notifier.notify(name) for name in client_ids])
+    return len(client_ids)
+
+def _claim_values(queue) -> dict:
+    """ Values that hand out a command: a command that hasn't been handed out yet is marked as
+    acknowledged and counts an attempt, and the lease is renewed either way, since a client polling
+    its head is still working on it """
+    first_claim = queue.c.acknowledged == None
+    now = datetime.now()
+    return dict(
+        acknowledged=func.coalesce(queue.c.acknowledged, now),
+        status=case((first_claim, DbCommandStatus.IN_PROGRESS), else_=queue.c.status),
+        attempts=queue.c.attempts + case((first_claim, 1), else_=0),
+        lease_expires=now + COMMAND_LEASE)
+
+@write_transaction
+def get_next_command(session: Session, client_name: str) -> models.CommandQueueResponse:
+    """ Get the next incomplete command in the client's command queue, marking it as acknowledged
+    if it isn't yet. The head is claimed by a single UPDATE, so concurrent polls can't race on it """
+    client_id = _queue_client_id(session, client_name)
+    queue = DbCommandQueueEntry.__table__
+    claim = (update(queue)
+        .where(queue.c.id == _queue_head_id(client_id))
+        .values(
+            **_claim_values(queue)))
+
+    if not supports_returning(session):
+        session.execute(claim)
+        queue_length, next_command = _get_queue_info(session, client_name)
+        return models.CommandQueueResponse(
+            queue_length=queue_length,
+            command=next_command.command if next_command else None,
+            id=next_command.id if next_command else None)
+
+    queue_length = select(DbClient.queue_length).where(DbClient.id == client_id).scalar_subquery()
+    claimed = session.execute(claim.returning(queue.c.id, queue.c.command, queue_length.label('queue_length'))).first()
+    return models.CommandQueueResponse(
+        queue_length=claimed.queue_length if claimed else 0,
+        command=claimed.command if claimed else None,
+        id=claimed.id if claimed else None)
+
+@write_transaction
+def check_in(session: Session, client_name: str, commit_hash: str = None, repo: str = DEFAULT_REPO) -> models.CommandQueueResponse:
+    """ Record the client's access to the given commit of the given repo, if any, and get the
+    next command in its command queue, in a single transaction """
+    if commit_hash is not None:
+        log_client_repo_access.__wrapped__(session, client_name, commit_hash, repo)
+    return get_next_command.__wrapped__(session, client_name)
+
+@write_transaction
+def get_next_commands(session: Session, client_name: str, max_commands: int) -> models.CommandQueueBatchResponse:
+    """ Get up to max_commands incomplete commands from the head of the client's command queue,
+    marking each as acknowledged if it isn't yet """
+    client_id = _queue_client_id(session, client_name)
+    queue = DbCommandQueueEntry.__table__
+    head = (select(_queued.c.id)
+        .where(_queued.c.client_id == client_id)
+        .where(_queued.c.completed == None)
+        .order_by(_queued.c.priority.desc(), _queued.c.created.asc())
+        .limit(max_commands))
+    claim = (update(queue)
+        .where(queue.c.id.in_(head))
+        .values(
+            **_claim_values(queue)))
+
+    if supports_returning(session):
+        claimed = session.execute(claim.returning(queue.c.id, queue.c.command, queue.c.priority, queue.c.created)).all()
+        # RETURNING doesn't preserve the order of the head subquery
+        claimed.sort(key=lambda command: (-command.priority, command.created))
+    else:
+        session.execute(claim)
+        claimed = session.execute(select(queue.c.id, queue.c.command).where(queue.c.id.in_(head))
+            .order_by(queue.c.priority.desc(), queue.c.created.asc())).all()
+
+    return models.CommandQueueBatchResponse(
+        queue_length=session.scalar(select(DbClient.queue_length).where(DbClient.id == client_id)),
+        commands=[models.QueuedCommand(id=command.id, command=command.command) for command in claimed])
+
+@write_transaction
+def dequeue_command(session: Session, client_name: str, command_status: DbCommandStatus) -> models.CommandQueueResponse:
     """ Mark a command as either successful or failed, then return the count of commands left in the queue"""
     if command_status not in (DbCommandStatus.SUCCESSFUL, DbCommandStatus.FAILED):
         raise HTTPException(400, "Command status must be either SUCCESSFUL or FAILED")
+    client_id = _queue_client_id(session, client_name)
+    # Wake any stream waiting to hand out the next command
+    after_commit(session, lambda: command_notifier.notify(client_name))
+    queue = DbCommandQueueEntry.__table__
+    # Only the head can be completed, and only once it's been handed out
+    complete = (update(queue)
+        .where(queue.c.id == _queue_head_id(client_id))
+        .where(queue.c.acknowledged != None)
+        .values(completed=datetime.now(), status=command_status))
+
+    if session.execute(complete).rowcount == 0:
+        raise HTTPException(400, "Cannot dequeue an unread command")
+    return models.CommandQueueResponse(queue_length=adjust_queue_length(session, client_id, -1), command=None)
+
+@write_transaction
+def dequeue_commands(session: Session, client_name: str, completions: list[tuple[str, DbCommandStatus]]) -> models.CommandQueueResponse:
+    """ Mark each of the given commands, given as (command id, status), as either successful or
+    failed, then return the count of commands left in the queue. Either every command is completed,
+    or none are """
+    if any(status not in (DbCommandStatus.SUCCESSFUL, DbCommandStatus.FAILED) for _, status in completions):
+        raise HTTPException(400, "Command status must be either SUCCESSFUL or FAILED")
+    client_id = _queue_client_id(session, client_name)
+    after_commit(session, lambda: command_notifier.notify(client_name))
+    if not completions:
+        return models.CommandQueueResponse(
+            queue_length=session.scalar(select(DbClient.queue_length).where(DbClient.id == client_id)), command=None)
+
+    queue = DbCommandQueueEntry.__table__
+    # Only commands that have been handed out to this client, and aren't yet complete, can be completed
+    completed = session.execute(update(queue)
+        .where(queue.c.id == bindparam('command_id'))
+        .where(queue.c.client_id == client_id)
+        .where(queue.c.acknowledged != None)
+        .where(queue.c.completed == None)
+        .values(completed=datetime.now(), status=bindparam('command_status')),
+        [{'command_id': command_id, 'command_status': status} for command_id, status in completions]).rowcount
+    if completed != len(completions):
+        raise HTTPException(400, "Cannot dequeue an unread, completed or unknown command")
+    return models.CommandQueueResponse(queue_length=adjust_queue_length(session, client_id, -completed), command=None)
+
+@write_transaction
+def expire_command_leases(session: Session) -> dict[str, int]:
+    """ Return every in-progress command whose lease has expired to its client's queue, or fail it
+    if it's already been handed out COMMAND_MAX_ATTEMPTS times. All expired leases are handled by a
+    single UPDATE. Returns the number of commands requeued and failed """
+    now = datetime.now()
+    queue = DbCommandQueueEntry.__table__
+    expired = (queue.c.completed == None) & (queue.c.lease_expires < now)
+    exhausted = queue.c.attempts >= COMMAND_MAX_ATTEMPTS
+    reaped_status = case((exhausted, DbCommandStatus.FAILED), else_=DbCommandStatus.PENDING)
+    # Requeued commands keep their priority and creation time, so they're next to be handed out
+    reap = (update(queue)
+        .where(expired)
+        .values(
+            status=reaped_status,
+            acknowledged=case((exhausted, queue.c.acknowledged), else_=None),
+            completed=case((exhausted, now), else_=None),
+            lease_expires=None))
+
+    if supports_returning(session):
+        reaped = session.execute(reap.returning(queue.c.client_id, queue.c.status)).all()
+    else:
+        reaped = session.execute(select(queue.c.client_id, reaped_status.label('status')).where(expired)).all()
+        session.execute(reap)
+
+    failed = {}
+    for client_id, status in reaped:
+        if status == DbCommandStatus.FAILED:
+            failed[client_id] = failed.get(client_id, 0) - 1
+    adjust_queue_lengths(session, failed)
+
+    if reaped:
+        client_names = session.scalars(select(DbClient.name).where(DbClient.id.in_({client_id for client_id, _ in reaped}))).all()
+        def _notify():
+            for client_name in client_names:
+                command_notifier.notify(client_name)
+        after_commit(session, _notify)
+
+    failed_count = -sum(failed.values())
+    return {'requeued': len(reaped) - failed_count, 'failed': failed_count}
+
+def query_command_history(session: Session, client_name: str, status: DbCommandStatus, before: datetime, limit: int):
+    """ Completed commands from both the queue and the archive, newest first """
+    selects = []
+    for table in (DbCommandQueueEntry.__table__, DbCommandArchiveEntry.__table__):
+        query = (select(DbClient.name.label('client_name'), table.c.id, table.c.command, table.c.priority,
+                        table.c.status, table.c.created, table.c.acknowledged, table.c.completed, table.c.attempts)
+            .join(DbClient, DbClient.id == table.c.client_id)
+            .where(table.c.completed != None))
+        if client_name is not None:
+            query = query.where(DbClient.name == client_name)
+        if status is not None:
+            query = query.where(table.c.status == status)
+        if before is not None:
+            query = query.where(table.c.completed < before)
+        selects.append(query)
+    history = union_all(*selects).subquery()
+    return session.execute(select(history).order_by(history.c.completed.desc()).limit(limit)).all()
+
+def get_command_history(client_name: str = None, status: DbCommandStatus = None, before: datetime = None,
+                        limit: int = 100) -> list[models.CommandHistoryEntry]:
+    """ Get completed commands, newest first, including those moved to the archive. Pass the
+    completion time of the last command in a page as 'before' to fetch the next page """
     with DbSession() as session:
-        queue_length, active_command = _get_queue_info(session, client_name)
-
-        # Mark the command as acknowledged if it isn't yet
-        if not active_command or not active_command.acknowledged:
-            raise HTTPException(400, "Cannot dequeue an unread command")
-
-        active_command.completed = datetime.now()
-        active_command.status = command_status
-        session.add(active_command)
-
-        session.commit()
-
-        return models.CommandQueueResponse(queue_length=queue_length - 1, command=None)
-
+        return [models.CommandHistoryEntry.model_validate(row, from_attributes=True)
+                for row in query_command_history(session, client_name, status, before, limit)]
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Boolean, Integer, Float, DateTime, ForeignKey
+from sqlalchemy import Column, String, Boolean, Integer, Float, DateTime, ForeignKey, ForeignKeyConstraint, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, relationship, mapped_column
 from uuid import uuid4
 from datetime import datetime
@@ -17,15 +17,20 @@ class DbClient(Base):
     id = Column(String, primary_key=True, default = _gen_uuid)
     name = Column(String, unique=True, nullable=False)
     valid = Column(Boolean, default=True)
+    # Number of incomplete commands in the client's command queue, kept up to date alongside it
+    queue_length = Column(Integer, nullable=False, default=0, server_default='0')
 
     auth_sessions: Mapped[list["DbClientAuthEvent"]] = relationship(cascade="delete")
 
     repo_access: Mapped[list["DbClientCommitAccess"]] = relationship(cascade="delete")
 
+    latest_state: Mapped["DbClientLatestState"] = relationship(cascade="delete")
+
     def __init__(self, name):
         self.id = _gen_uuid()
         self.name = name
         self.valid = True
+        self.queue_length = 0
 
 class DbAuthState(str, Enum):
     PENDING = 'PENDING'
@@ -44,6 +49,11 @@ class DbClientAuthEvent(Base):
 
     challenge: Mapped["DbClientAuthChallenge"] = relationship(cascade="delete")
 
+    __table_args__ = (
+        # Latest auth session per client
+        Index('ix_client_auth_sessions_client_initiated', 'client_id', 'initiated'),
+    )
+
     def __init__(self, client_id):
         self.id = _gen_uuid()
         self.client_id = client_id
@@ -72,21 +82,69 @@ class DbClientAuthChallenge(Base):
 
 
 class DbGitCommit(Base):
-    """ Table for tracking the Git Commits that have been the HEAD """
+    """ Table for tracking the Git Commits that have been the HEAD of each repo """
 
     __tablename__ = "repo_commits"
 
     commit_hash = Column(String, primary_key=True)
 
-    commit_time = Column(DateTime)
+    # Name of the repo the commit was synced into. Part of the key, since repos that share
+    # history (forks and mirrors) have commits in common
+    repo = Column(String, primary_key=True)
+
+    commit_time = Column(DateTime, index=True)
 
     sync_time = Column(DateTime)
 
-    def __init__(self, commit_hash, commit_time):
+    __table_args__ = (
+        # Latest commit per repo
+        Index('ix_repo_commits_repo_commit_time', 'repo', 'commit_time', 'commit_hash'),
+    )
+
+    def __init__(self, commit_hash, commit_time, repo):
         self.commit_hash = commit_hash
         self.commit_time = commit_time
+        self.repo = repo
         self.sync_time = datetime.now()
 
+class DbRepoSync(Base):
+    """ Table for the history of syncs of each repo with its upstream, with the time taken by
+    each stage of the sync. Stages that a sync skipped have no time """
+
+    __tablename__ = "repo_syncs"
+
+    id = Column(String, primary_key=True, default = _gen_uuid)
+
+    repo = Column(String)
+
+    started = Column(DateTime, index=True)
+
+    # Whether the upstream had moved, so the repo was fetched and reset
+    changed = Column(Boolean)
+
+    # HEAD after the sync
+    commit_hash = Column(String)
+
+    ls_remote_seconds = Column(Float)
+    fetch_seconds = Column(Float)
+    reset_seconds = Column(Float)
+    log_commit_seconds = Column(Float)
+    total_seconds = Column(Float)
+
+    __table_args__ = (
+        # Latest sync per repo, kept by the retention job
+        Index('ix_repo_syncs_repo_started', 'repo', 'started'),
+    )
+
+    def __init__(self, repo: str, started: datetime, changed: bool, commit_hash: str, stage_seconds: dict[str, float]):
+        self.id = _gen_uuid()
+        self.repo = repo
+        self.started = started
+        self.changed = changed
+        self.commit_hash = commit_hash
+        for stage, seconds in stage_seconds.items():
+            setattr(self, f"{stage}_seconds", seconds)
+
 class DbClientCommitAccess(Base):
     """ Table for tracking the latest version of the git repo accessed by a client """
     __tablename__ = "client_commit_access"
@@ -94,14 +152,50 @@ class DbClientCommitAccess(Base):
     id = Column(String, primary_key=True, default = _gen_uuid)
     client_id: Mapped[String] = mapped_column(ForeignKey('client.id'))
     
-    commit_hash: Mapped[String] = mapped_column(ForeignKey('repo_commits.commit_hash'))
-    access_time = Column(DateTime)
-
-    def __init__(self, client_id, commit_hash, access_time = None):
+    commit_hash = Column(String)
+    # Name of the repo the client pulled
+    repo = Column(String)
+    # Indexed for the retention job
+    access_time = Column(DateTime, index=True)
+
+    __table_args__ = (
+        ForeignKeyConstraint(['commit_hash', 'repo'], ['repo_commits.commit_hash', 'repo_commits.repo']),
+        # Access record lookup when a client reports a pull
+        Index('ix_client_commit_access_client_commit', 'client_id', 'commit_hash'),
+        # Latest repo access per client
+        Index('ix_client_commit_access_client_access_time', 'client_id', 'access_time'),
+    )
+
+    def __init__(self, client_id, commit_hash, access_time = None, repo = None):
         self.id = _gen_uuid()
         self.client_id = client_id
         self.commit_hash = commit_hash
         self.access_time = access_time
+        self.repo = repo
+
+
+class DbClientLatestState(Base):
+    """ Table tracking the latest auth session and repo access of each client. Kept up to date in
+    the same transaction as writes to client_auth_sessions and client_commit_access so that the
+    current client status report doesn't need to search the full history (see client_state_report.py).
+    Like the report, it holds the client's most recent access of any repo. Its latest access of each
+    repo stays in client_commit_access, where the retention job keeps it
+    """
+    __tablename__ = "client_latest_state"
+
+    client_id: Mapped[String] = mapped_column(ForeignKey('client.id'), primary_key=True)
+
+    auth_event_id = Column(String)
+    auth_state = Column(String)
+    initiated = Column(DateTime)
+    expires   = Column(DateTime)
+
+    commit_hash = Column(String)
+    repo = Column(String)
+    access_time = Column(DateTime)
+
+    def __init__(self, client_id):
+        self.client_id = client_id
 
 
 class DbCommandStatus(str, Enum):
@@ -123,7 +217,20 @@ class DbCommandQueueEntry(Base):
     status = Column(String)
 
     acknowledged = Column(DateTime)
-    completed = Column(DateTime)
+    # Indexed for the archive job
+    completed = Column(DateTime, index=True)
+
+    # A command that's handed out is returned to the queue if it isn't completed by this time
+    lease_expires = Column(DateTime)
+    # Number of times the command has been handed out
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # Incomplete commands per client, in the order they're handed out
+        Index('ix_client_command_queue_client_pending', 'client_id', 'completed', priority.desc(), 'created'),
+        # Expired leases, for the lease reaper
+        Index('ix_client_command_queue_lease', 'completed', 'lease_expires'),
+    )
 
     def __init__(self, client_id: str, command: str, priority: int):
         self.id = _gen_uuid()
@@ -132,6 +239,27 @@ class DbCommandQueueEntry(Base):
         self.priority = priority
         self.created = datetime.now()
         self.status = DbCommandStatus.PENDING
+        self.attempts = 0
+
+class DbCommandArchiveEntry(Base):
+    """ Table for commands that were completed long enough ago to be moved out of the
+    command queue. Has the same columns as client_command_queue (see retention.py) """
+    __tablename__ = "client_command_archive"
+
+    id = Column(String, primary_key=True)
+    client_id: Mapped[String] = mapped_column(ForeignKey('client.id'))
+    command = Column(String)
+    priority = Column(Integer)
+    created = Column(DateTime)
+    status = Column(String)
+    acknowledged = Column(DateTime)
+    completed = Column(DateTime, index=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        # Command history per client, newest first
+        Index('ix_client_command_archive_client_completed', 'client_id', 'completed'),
+    )
 
 
 class DbClientStateView(Base):
@@ -152,6 +280,7 @@ class DbClientStateView(Base):
     expires   = Column(DateTime, default=datetime.now())
 
     commit_hash = Column(String)
+    repo = Column(String)
     access_time = Column(DateTime)
 
 
@@ -0,0 +1,147 @@
+from sqlalchemy import Engine, Connection, MetaData, Table, select, inspect, text
+from sqlalchemy.schema import CreateColumn, CreateTable
+from sqlalchemy.orm import Session
+from .db_schema import Base, DbClientLatestState
+from .client_state_report import rebuild_latest_states
+from .command_queue import repair_queue_lengths, lease_in_progress_commands
+from util.repos import DEFAULT_REPO
+
+import logging
+logger = logging.getLogger()
+
+
+def _enable_incremental_vacuum(engine: Engine):
+    """ Allow space freed by the retention job to be returned to the filesystem a little at a time.
+    Changing auto_vacuum only takes effect after a full VACUUM, which is instant for a new database.
+    An existing one is left to the one-time vacuum command below, as it rewrites the whole database """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == 2: # INCREMENTAL
+            return
+        if inspect(conn).get_table_names():
+            logger.warning("Incremental vacuum isn't enabled, so space freed by pruning history is kept "
+                           "by the database. Enable it with: python3 -m db.migrations vacuum")
+            return
+    enable_incremental_vacuum(engine)
+
+def enable_incremental_vacuum(engine: Engine):
+    """ Enable incremental vacuum on an existing database. The full VACUUM this takes blocks every
+    other connection, and may take a while for a large database """
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.exec_driver_sql("VACUUM")
+
+def _add_missing_columns(engine: Engine) -> set[str]:
+    """ create_all only creates columns alongside new tables, so add any columns that were
+    introduced after an existing table was created. Returns the added columns as 'table.column' """
+    added = set()
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    logger.info(f"Adding column {table.name}.{column.name}")
+                    # SQLite can't add a NOT NULL column without a default, so a new key column is
+                    # added nullable, and made NOT NULL once the table is rebuilt with its new key
+                    column_ddl = (f"{column.name} {column.type.compile(conn.dialect)}" if column.primary_key
+                                  else CreateColumn(column).compile(conn))
+                    conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}")
+                    added.add(f"{table.name}.{column.name}")
+    return added
+
+def _create_missing_indexes(engine: Engine):
+    """ create_all only creates indexes alongside new tables, so add any indexes that were
+    introduced after an existing table was created """
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def _populate_latest_states(engine: Engine):
+    """ Fill client_latest_state from history if it was just created for an existing database """
+    with Session(engine) as session:
+        if session.scalar(select(DbClientLatestState.client_id).limit(1)) is None:
+            rebuild_latest_states(session)
+            session.commit()
+
+def _populate_queue_lengths(engine: Engine):
+    """ Count each client's incomplete commands into the queue_length column it was just given """
+    with Session(engine) as session:
+        repair_queue_lengths(session)
+        session.commit()
+
+def _populate_command_leases(engine: Engine):
+    """ Lease the commands that were in progress when lease_expires was added, so that ones
+    abandoned before the upgrade are eventually handed out again """
+    with Session(engine) as session:
+        lease_in_progress_commands(session)
+        session.commit()
+
+def _populate_repo_columns(engine: Engine, tables: list[str]):
+    """ Attribute the rows of the given tables, recorded when only a single repo was served, to
+    what's now the default repo """
+    with engine.begin() as conn:
+        for table in tables:
+            conn.execute(text(f"UPDATE {table} SET repo = :repo WHERE repo IS NULL"), {'repo': DEFAULT_REPO})
+
+def _rebuild_table(conn: Connection, table: Table):
+    """ SQLite can't change the keys of an existing table, so create the table afresh under a
+    temporary name, copy the rows over and swap it in place of the old one """
+    logger.info(f"Rebuilding table {table.name} with its current keys")
+    # The copy's foreign keys need the tables they refer to in the same metadata
+    metadata = MetaData()
+    for other_table in Base.metadata.sorted_tables:
+        other_table.to_metadata(metadata)
+    rebuilt_name = f"{table.name}_rebuilt"
+    # CREATE TABLE alone, since the indexes of the copy would clash with the old table's
+    conn.execute(CreateTable(table.to_metadata(metadata, name=rebuilt_name)))
+    columns = ', '.join(column.name for column in table.columns)
+    conn.exec_driver_sql(f"INSERT INTO {rebuilt_name} ({columns}) SELECT {columns} FROM {table.name}")
+    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {rebuilt_name} RENAME TO {table.name}")
+    for index in table.indexes:
+        index.create(conn)
+
+def _rebuild_rekeyed_tables(engine: Engine):
+    """ Rebuild any tables whose primary key, or one of whose foreign keys, has changed since they were created """
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in Base.metadata.sorted_tables:
+            primary_key = inspector.get_pk_constraint(table.name)['constrained_columns']
+            foreign_keys = [sorted(fk['constrained_columns']) for fk in inspector.get_foreign_keys(table.name)]
+            current_foreign_keys = [sorted(fk.column_keys) for fk in table.foreign_key_constraints]
+            if (sorted(primary_key) != sorted(column.name for column in table.primary_key)
+                    or any(fk not in current_foreign_keys for fk in foreign_keys)):
+                _rebuild_table(conn, table)
+
+def migrate(engine: Engine):
+    """ Bring a new or existing database up to date with the schema in db_schema.py.
+    Each step is idempotent, so this is safe to run on every startup """
+    _enable_incremental_vacuum(engine)
+    Base.metadata.create_all(engine)
+    added_columns = _add_missing_columns(engine)
+    _create_missing_indexes(engine)
+    _populate_latest_states(engine)
+    if 'client.queue_length' in added_columns:
+        _populate_queue_lengths(engine)
+    if 'client_command_queue.lease_expires' in added_columns:
+        _populate_command_leases(engine)
+    repo_columns = [column.removesuffix('.repo') for column in sorted(added_columns) if column.endswith('.repo')]
+    if repo_columns:
+        _populate_repo_columns(engine, repo_columns)
+    # After the repo columns are populated, since repo is now part of the key of repo_commits
+    _rebuild_rekeyed_tables(engine)
+
+
+if __name__ == '__main__':
+    # One-time maintenance commands, run from the webapp directory with the app stopped:
+    # python3 -m db.migrations vacuum
+    import sys
+    from db.db import engine
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'vacuum':
+        enable_incremental_vacuum(engine)
+        print("Enabled incremental vacuum")
+    else:
+        sys.exit(f"Unknown command {command}, expected one of: vacuum")
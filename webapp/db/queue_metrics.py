@@ -0,0 +1,109 @@
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from models import models
+from datetime import datetime, timedelta
+import threading
+
+# SQL literal for the number of live commands in each state, and the oldest live command
+QUEUE_DEPTH_SQL = """
+SELECT
+    count(*) AS depth,
+    coalesce(sum(acknowledged IS NULL), 0) AS pending,
+    coalesce(sum(acknowledged IS NOT NULL), 0) AS in_progress,
+    min(created) AS oldest_created
+FROM client_command_queue
+WHERE completed IS NULL
+"""
+
+# SQL literal for the depth and oldest live command of each client with a non-empty queue
+CLIENT_QUEUE_DEPTH_SQL = """
+SELECT client.name, client.queue_length, min(client_command_queue.created) AS oldest_created
+FROM client
+JOIN client_command_queue ON client_command_queue.client_id = client.id
+    AND client_command_queue.completed IS NULL
+WHERE client.queue_length > 0
+GROUP BY client.id
+ORDER BY client.name
+"""
+
+# SQL literal for the created -> acknowledged and acknowledged -> completed times, in seconds, of
+# commands that were acknowledged or completed within the window. Commands completed earlier than
+# the archive age are only in client_command_archive
+LATENCY_SQL = """
+SELECT
+    (julianday(acknowledged) - julianday(created)) * 86400 AS ack_latency,
+    (julianday(completed) - julianday(acknowledged)) * 86400 AS completion_latency,
+    acknowledged >= :window_start AS acknowledged_in_window
+FROM {table}
+WHERE completed >= :window_start
+{live_commands}
+"""
+
+LIVE_COMMANDS_SQL = """
+UNION ALL
+SELECT (julianday(acknowledged) - julianday(created)) * 86400, NULL, 1
+FROM client_command_queue
+WHERE completed IS NULL
+AND acknowledged >= :window_start
+"""
+
+def _percentiles(values: list[float]) -> models.LatencyPercentiles:
+    """ Nearest-rank p50/p95/p99 of the given values """
+    values = sorted(values)
+    def _rank(percentile: int) -> float:
+        return values[max(0, -(-percentile * len(values) // 100) - 1)] if values else None
+    return models.LatencyPercentiles(count=len(values), p50=_rank(50), p95=_rank(95), p99=_rank(99))
+
+def _age(now: datetime, created: str) -> float:
+    return (now - datetime.fromisoformat(created)).total_seconds() if created else None
+
+def compute_queue_metrics(session: Session, window: timedelta) -> models.CommandQueueMetrics:
+    """ Compute the depth of every client's command queue and the whole fleet's, the age of the
+    oldest incomplete commands, and the latency of commands handled within the window """
+    now = datetime.now()
+    params = {'window_start': now - window}
+
+    depth = session.execute(text(QUEUE_DEPTH_SQL)).one()
+    clients = [models.ClientQueueMetrics(client_name=name, depth=queue_length, oldest_pending_age=_age(now, oldest_created))
+               for name, queue_length, oldest_created in session.execute(text(CLIENT_QUEUE_DEPTH_SQL))]
+
+    ack_latencies, completion_latencies = [], []
+    for table, live_commands in (('client_command_queue', LIVE_COMMANDS_SQL), ('client_command_archive', '')):
+        for ack_latency, completion_latency, acknowledged_in_window in session.execute(
+                text(LATENCY_SQL.format(table=table, live_commands=live_commands)), params):
+            if acknowledged_in_window and ack_latency is not None:
+                ack_latencies.append(ack_latency)
+            if completion_latency is not None:
+                completion_latencies.append(completion_latency)
+
+    return models.CommandQueueMetrics(
+        generated=now,
+        window_seconds=window.total_seconds(),
+        depth=depth.depth,
+        pending=depth.pending,
+        in_progress=depth.in_progress,
+        oldest_pending_age=_age(now, depth.oldest_created),
+        ack_latency=_percentiles(ack_latencies),
+        completion_latency=_percentiles(completion_latencies),
+        clients=clients)
+
+
+class QueueMetricsCache:
+    """ Holds the latest snapshot of the command queue metrics, so that serving them doesn't
+    run the aggregations on every request. Refreshed periodically by the scheduler """
+    def __init__(self, window: timedelta):
+        self._window = window
+        self._metrics: models.CommandQueueMetrics = None
+        self._lock = threading.Lock()
+
+    def refresh(self, session: Session) -> models.CommandQueueMetrics:
+        """ Recompute the metrics and replace the cached snapshot """
+        metrics = compute_queue_metrics(session, self._window)
+        with self._lock:
+            self._metrics = metrics
+        return metrics
+
+    def get(self) -> models.CommandQueueMetrics:
+        """ Get the cached snapshot, or None if the metrics haven't been computed yet """
+        with self._lock:
+            return self._metrics
@@ -0,0 +1,152 @@
+from sqlalchemy import text, bindparam
+from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+from os import environ
+import time
+import logging
+from .db import writer
+
+logger = logging.getLogger()
+
+# How long to keep auth session and repo access history. The latest auth session of each client, and
+# its latest access of each repo, are always kept
+HISTORY_RETENTION = timedelta(days=float(environ.get('HISTORY_RETENTION_DAYS', 30)))
+# How long a challenge/response handshake can be left incomplete before its challenge is deleted
+AUTH_CHALLENGE_TTL = timedelta(minutes=float(environ.get('AUTH_CHALLENGE_TTL_MINUTES', 60)))
+# Maximum number of rows deleted per write transaction
+RETENTION_BATCH_SIZE = int(environ.get('RETENTION_BATCH_SIZE', 1000))
+# How long completed commands stay in the command queue before they're moved to the archive
+COMMAND_ARCHIVE_AGE = timedelta(hours=float(environ.get('COMMAND_ARCHIVE_AGE_HOURS', 24)))
+# Maximum number of free pages returned to the filesystem per turn on the writer thread
+VACUUM_BATCH_PAGES = int(environ.get('VACUUM_BATCH_PAGES', 1000))
+
+# SQL literals deleting one batch of expired rows from each history table
+PRUNE_SQL = {
+    # Challenges of handshakes that never completed
+    'client_auth_challenges': """
+        DELETE FROM client_auth_challenges WHERE auth_event_id IN (
+            SELECT client_auth_challenges.auth_event_id FROM client_auth_challenges
+            JOIN client_auth_sessions ON client_auth_sessions.id = client_auth_challenges.auth_event_id
+            WHERE client_auth_sessions.initiated < :challenge_cutoff
+            LIMIT :batch_size
+        )""",
+    'client_auth_sessions': """
+        DELETE FROM client_auth_sessions WHERE id IN (
+            SELECT id FROM client_auth_sessions AS old
+            WHERE old.initiated < :history_cutoff
+            AND old.initiated < (
+                SELECT max(initiated) FROM client_auth_sessions
+                WHERE client_auth_sessions.client_id = old.client_id
+            )
+            AND NOT EXISTS (SELECT 1 FROM client_auth_challenges WHERE auth_event_id = old.id)
+            LIMIT :batch_size
+        )""",
+    'client_commit_access': """
+        DELETE FROM client_commit_access WHERE id IN (
+            SELECT id FROM client_commit_access AS old
+            WHERE old.access_time < :history_cutoff
+            AND old.access_time < (
+                SELECT max(access_time) FROM client_commit_access
+                WHERE client_commit_access.client_id = old.client_id
+                AND client_commit_access.repo IS old.repo
+            )
+            LIMIT :batch_size
+        )""",
+    'repo_syncs': """
+        DELETE FROM repo_syncs WHERE id IN (
+            SELECT id FROM repo_syncs
+            WHERE started < :history_cutoff
+            AND started < (SELECT max(started) FROM repo_syncs latest WHERE latest.repo = repo_syncs.repo)
+            LIMIT :batch_size
+        )""",
+}
+
+# Columns shared by client_command_queue and client_command_archive
+COMMAND_COLUMNS = "id, client_id, command, priority, created, status, acknowledged, completed, attempts"
+
+# Ids of a batch of completed commands old enough to archive, oldest first. The batch is selected
+# once and moved by id, since with ties on completed two selections could pick different rows
+ARCHIVE_BATCH_SQL = """
+    SELECT id FROM client_command_queue
+    WHERE completed < :archive_cutoff
+    AND status IN ('SUCCESSFUL', 'FAILED')
+    ORDER BY completed
+    LIMIT :batch_size"""
+
+ARCHIVE_INSERT_SQL = f"""
+    INSERT INTO client_command_archive ({COMMAND_COLUMNS})
+    SELECT {COMMAND_COLUMNS} FROM client_command_queue WHERE id IN :ids"""
+
+ARCHIVE_DELETE_SQL = "DELETE FROM client_command_queue WHERE id IN :ids"
+
+def _archive_batch(session: Session, params: dict) -> int:
+    ids = session.scalars(text(ARCHIVE_BATCH_SQL), params).all()
+    if not ids:
+        return 0
+    session.execute(text(ARCHIVE_INSERT_SQL).bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+    return session.execute(text(ARCHIVE_DELETE_SQL).bindparams(bindparam('ids', expanding=True)), {'ids': ids}).rowcount
+
+def archive_commands(age: timedelta = COMMAND_ARCHIVE_AGE, batch_size: int = RETENTION_BATCH_SIZE) -> dict:
+    """ Move commands that were completed more than the given age ago from the command queue to
+    the archive, so that the queue only holds live and recent work. Rows are moved in batches of at
+    most batch_size, each in its own write transaction. Returns the number of commands moved and
+    the time taken
+    """
+    start = time.monotonic()
+    params = {'archive_cutoff': datetime.now() - age, 'batch_size': batch_size}
+
+    report = {'client_command_queue': 0}
+    while (moved := writer.run(_archive_batch, params)) > 0:
+        report['client_command_queue'] += moved
+        if moved < batch_size:
+            break
+
+    report['elapsed_seconds'] = round(time.monotonic() - start, 3)
+    logger.info(f"Archived commands completed more than {age} ago: {report}")
+    return report
+
+def _delete_batch(session: Session, sql: str, params: dict) -> int:
+    return session.execute(text(sql), params).rowcount
+
+def _incremental_vacuum(session: Session, batch_pages: int) -> int:
+    # pysqlite only steps a statement once, so each pragma frees a single page, and is committed on
+    # its own. Does nothing until incremental vacuum has been enabled, see migrations.py
+    conn = session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'})
+    if conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2: # INCREMENTAL
+        return 0
+    pages = min(conn.exec_driver_sql("PRAGMA freelist_count").scalar(), batch_pages)
+    for _ in range(pages):
+        conn.exec_driver_sql("PRAGMA incremental_vacuum(1)")
+    return pages
+
+def prune_history(retention: timedelta = HISTORY_RETENTION, batch_size: int = RETENTION_BATCH_SIZE) -> dict:
+    """ Delete history older than the retention window, other than the latest entry of each client,
+    along with abandoned auth challenges. Rows are deleted in batches of at most batch_size, each in its
+    own write transaction, so that other writers are only held up for a batch at a time. The pages freed
+    are then returned to the filesystem. Returns the number of rows removed from each table, the
+    number of pages returned and the time taken
+    """
+    start = time.monotonic()
+    now = datetime.now()
+    params = {
+        'history_cutoff': now - retention,
+        'challenge_cutoff': now - AUTH_CHALLENGE_TTL,
+        'batch_size': batch_size,
+    }
+
+    report = {}
+    for table, sql in PRUNE_SQL.items():
+        report[table] = 0
+        while (deleted := writer.run(_delete_batch, sql, params)) > 0:
+            report[table] += deleted
+            if deleted < batch_size:
+                break
+
+    report['vacuumed_pages'] = 0
+    while (vacuumed := writer.run(_incremental_vacuum, VACUUM_BATCH_PAGES)) > 0:
+        report['vacuumed_pages'] += vacuumed
+        if vacuumed < VACUUM_BATCH_PAGES:
+            break
+    report['elapsed_seconds'] = round(time.monotonic() - start, 3)
+    logger.info(f"Pruned history older than {retention}: {report}")
+    return report
@@ -3,6 +3,7 @@ from enum import Enum
 from typing import Optional
 from datetime import datetime
 from db.db_schema import DbClientCommitAccess, DbClientAuthEvent, DbClientStateView, DbCommandStatus
+from util.repos import DEFAULT_REPO
 
 
 
@@ -33,6 +34,7 @@ class RepoListing(BaseModel):
 class ClientAccessStatus(BaseModel):
     access_time: datetime
     commit_hash: str
+    repo: Optional[str] = Field(default=None, description="Name of the repository that was accessed")
 
     @classmethod
     def from_db(cls, entity: DbClientCommitAccess):
@@ -41,7 +43,8 @@ class ClientAccessStatus(BaseModel):
         
         return ClientAccessStatus(
             access_time=entity.access_time,
-            commit_hash=entity.commit_hash
+            commit_hash=entity.commit_hash,
+            repo=entity.repo
         )
 
 class ClientAuthState(BaseModel):
@@ -74,10 +77,48 @@ class ClientStatus(BaseModel):
                 expires=entity.expires) if entity.auth_state else None,
             repo_access=ClientAccessStatus(
                 access_time=entity.access_time,
-                commit_hash=entity.commit_hash) if entity.commit_hash else None)
+                commit_hash=entity.commit_hash,
+                repo=entity.repo) if entity.commit_hash else None)
 
 
 
+class ClientStatusSummary(BaseModel):
+    """ Aggregate counts of the clients in a client status report """
+    total: int = Field(description="Number of clients in the report")
+    auth_states: dict[str, int] = Field(description="Number of clients in each auth state, including EXPIRED and NONE")
+    latest_commit: Optional[str] = Field(description="Hash of the latest commit of the default repo synced from upstream as of the report time")
+    latest_commits: dict[str, str] = Field(default={}, description="Hash of the latest commit of each repo synced from upstream as of the report time")
+    on_latest_commit: int = Field(description="Number of clients whose last reported access was of the latest commit of its repo")
+    behind_latest_commit: int = Field(description="Number of clients whose last reported access was of an older commit of its repo")
+    no_repo_access: int = Field(description="Number of clients that have never reported accessing the repo")
+    commits: dict[str, int] = Field(description="Number of clients whose last reported access was of each commit")
+
+    @classmethod
+    def from_counts(cls, latest_commits: dict[str, str], counts: list[tuple[str, Optional[str], Optional[str], int]]):
+        """ Build a summary from the (auth state, repo, commit hash, client count) groups of a
+        report, given the latest commit of each repo """
+        auth_states = {state.value: 0 for state in AuthStateQuery if state != AuthStateQuery.ANY}
+        commits = {}
+        on_latest_commit = 0
+        for auth_state, repo, commit_hash, client_count in counts:
+            auth_states[auth_state] = auth_states.get(auth_state, 0) + client_count
+            if commit_hash is not None:
+                commits[commit_hash] = commits.get(commit_hash, 0) + client_count
+                if commit_hash == latest_commits.get(repo):
+                    on_latest_commit += client_count
+
+        total = sum(auth_states.values())
+        return ClientStatusSummary(
+            total=total,
+            auth_states=auth_states,
+            latest_commit=latest_commits.get(DEFAULT_REPO),
+            latest_commits=latest_commits,
+            on_latest_commit=on_latest_commit,
+            behind_latest_commit=sum(commits.values()) - on_latest_commit,
+            no_repo_access=total - sum(commits.values()),
+            commits=commits)
+
+
 class SecretVersion(BaseModel):
     """ TODO this might just be a JWT in the future """
     secret: str
@@ -105,8 +146,90 @@ class CommandQueueResponse(BaseModel):
     """
     queue_length: int
     command: Optional[str]
+    id: Optional[str] = Field(default=None, description="Id of the command, for completing it in a batch")
 
 class CommandQueueCompletionRequest(BaseModel):
     """ Request sent by a client indicating the completion status of the 
     first command in its queue """
     status: DbCommandStatus
+
+class QueuedCommand(BaseModel):
+    id: str
+    command: str
+
+class CommandQueueBatchResponse(BaseModel):
+    """ Response containing the queue length of a client's command queue, and the
+    commands claimed from the head of the queue in order """
+    queue_length: int
+    commands: list[QueuedCommand]
+
+class CommandCompletion(BaseModel):
+    id: str = Field(description="Id of a command handed out to the client")
+    status: DbCommandStatus
+
+class CommandQueueBatchCompletionRequest(BaseModel):
+    """ Request sent by a client indicating the completion status of several commands
+    that it's been handed """
+    completions: list[CommandCompletion]
+
+class CommandBroadcastRequest(BaseModel):
+    """ Request to enqueue a command for many clients at once. Targets either the given
+    clients, or every client matching the given client status report filters """
+    command: str = Field(description="Command to enqueue")
+    priority: int = Field(default=1, description="Priority of the command in each client's queue")
+    client_names: Optional[list[str]] = Field(default=None, description="Clients to enqueue the command for. Overrides the filters below")
+    report_time: Optional[datetime] = Field(default=None, description="Filter on client state as of this time")
+    auth_state: AuthStateQuery = Field(default=AuthStateQuery.ANY, description="Filter on client auth state")
+    latest_commit: Optional[bool] = Field(default=None, description="Filter on whether clients last accessed the latest commit")
+
+class CommandBroadcastResponse(BaseModel):
+    """ Response containing the number of clients a command was enqueued for """
+    enqueued: int
+
+class CommandHistoryEntry(BaseModel):
+    """ A command that a client has completed """
+    client_name: str
+    id: str
+    command: str
+    priority: int
+    status: DbCommandStatus
+    created: datetime
+    acknowledged: Optional[datetime]
+    completed: datetime
+    attempts: int = Field(description="Number of times the command was handed out")
+
+class LatencyPercentiles(BaseModel):
+    """ Distribution of a command queue latency, in seconds """
+    count: int = Field(description="Number of commands measured")
+    p50: Optional[float]
+    p95: Optional[float]
+    p99: Optional[float]
+
+class ClientQueueMetrics(BaseModel):
+    client_name: str
+    depth: int = Field(description="Number of incomplete commands in the client's queue")
+    oldest_pending_age: Optional[float] = Field(description="Seconds since the oldest incomplete command was enqueued")
+
+class CommandQueueMetrics(BaseModel):
+    """ Snapshot of the depth and latency of every client's command queue """
+    generated: datetime = Field(description="Time the snapshot was computed")
+    window_seconds: float = Field(description="Latencies are of commands acknowledged or completed this many seconds before the snapshot")
+    depth: int = Field(description="Number of incomplete commands across all clients")
+    pending: int = Field(description="Number of commands that haven't been handed out yet")
+    in_progress: int = Field(description="Number of commands that have been handed out but not completed")
+    oldest_pending_age: Optional[float] = Field(description="Seconds since the oldest incomplete command was enqueued")
+    ack_latency: LatencyPercentiles = Field(description="Time from a command being enqueued to being handed out")
+    completion_latency: LatencyPercentiles = Field(description="Time from a command being handed out to being completed")
+    clients: list[ClientQueueMetrics] = Field(description="Depth of each client's queue, for clients with incomplete commands")
+
+class CheckInRequest(BaseModel):
+    """ Request sent by a client at the start of each cycle """
+    commit_hash: Optional[str] = Field(default=None, description="Hash of the commit the client currently has checked out, if any")
+    repo: Optional[str] = Field(default=None, description="Name of the repository the client pulls, if not the default repository")
+
+class CheckInResponse(BaseModel):
+    """ Everything a client needs at the start of a cycle, in place of separate calls to
+    /private/verify-auth, /public/repo-status, /private/log-repo-access and /private/command-queue """
+    whoami: str
+    repo: RepoListing
+    command_queue: CommandQueueResponse
@@ -1,12 +1,59 @@
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.triggers.date import DateTrigger
 from apscheduler.schedulers.background import BackgroundScheduler
 
-from util.git_utils import REPO_URL, SSH_KEY, sync_repo
+from util.git_utils import sync_repo, sync_repos, get_repo
+from util.sync_hook import SYNC_HOOK_SECRET
+from db.retention import prune_history, archive_commands
+from db.db import refresh_queue_metrics, expire_command_leases
+from datetime import datetime, timedelta
+from os import environ
 
+# How long to wait after a push notification for more before syncing, so that a burst of pushes
+# leads to a single sync
+SYNC_HOOK_DEBOUNCE = timedelta(seconds=float(environ.get('SYNC_HOOK_DEBOUNCE_SECONDS', 5)))
+# The longest a sync is pushed back from the first request pending for it, so that a steady stream
+# of pushes still leads to regular syncs
+SYNC_HOOK_MAX_DELAY = timedelta(seconds=float(environ.get('SYNC_HOOK_MAX_DELAY_SECONDS', 60)))
+# With push notifications set up, the scheduled sync is only a fallback for missed ones
+SYNC_FALLBACK_MINUTES = int(environ.get('SYNC_FALLBACK_MINUTES', 10))
 
+# Id of the pending sync requested by push notifications, suffixed with the repo for a single repo
+SYNC_HOOK_JOB_ID = 'sync-hook'
 
+# When the first request pending for each sync job id arrived
+_first_requests: dict[str, datetime] = {}
 
-def init_scheduler():
+# The running scheduler, set by init_scheduler
+scheduler: BackgroundScheduler = None
+
+
+def request_sync(repo_name: str = None):
+    """ Sync the given repo, or every repo if none is given, once no push notification for it has
+    arrived for SYNC_HOOK_DEBOUNCE. Each request replaces the pending sync, pushing it back, but no
+    further than SYNC_HOOK_MAX_DELAY after the first request pending for it """
+    job_id = SYNC_HOOK_JOB_ID if repo_name is None else f"{SYNC_HOOK_JOB_ID}-{repo_name}"
+    now = datetime.now()
+    if scheduler.get_job(job_id) is None:
+        _first_requests[job_id] = now
+    run_date = min(now + SYNC_HOOK_DEBOUNCE, _first_requests[job_id] + SYNC_HOOK_MAX_DELAY)
+    # A request arriving while the previous sync runs may come after that sync asked the upstream,
+    # so a second sync is allowed to queue up behind it, on the repo's sync lock
+    job_options = {'id': job_id, 'replace_existing': True, 'max_instances': 2, 'coalesce': True}
+    if repo_name is None:
+        scheduler.add_job(sync_repos, DateTrigger(run_date=run_date), kwargs={'wait_for_running': True}, **job_options)
+    else:
+        scheduler.add_job(sync_repo, DateTrigger(run_date=run_date), args=[get_repo(repo_name)], **job_options)
+
+def init_scheduler() -> BackgroundScheduler:
+    global scheduler
     scheduler = BackgroundScheduler()
-    scheduler.add_job(sync_repo, CronTrigger(minute="*", hour="*"))
+    sync_minutes = f"*/{SYNC_FALLBACK_MINUTES}" if SYNC_HOOK_SECRET else "*"
+    scheduler.add_job(sync_repos, CronTrigger(minute=sync_minutes, hour="*"))
+    scheduler.add_job(prune_history, CronTrigger(minute="30", hour="*"))
+    scheduler.add_job(archive_commands, CronTrigger(minute="*/10", hour="*"))
+    scheduler.add_job(expire_command_leases, IntervalTrigger(seconds=float(environ.get('COMMAND_LEASE_REAP_SECONDS', 60))))
+    scheduler.add_job(refresh_queue_metrics, IntervalTrigger(seconds=float(environ.get('QUEUE_METRICS_REFRESH_SECONDS', 60))))
     scheduler.start()
+    return scheduler
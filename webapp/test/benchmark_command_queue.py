@@ -0,0 +1,98 @@
+""" Per-poll latency of the command queue as the queue gets deeper. For each depth, fills one
+client's queue, then times claiming the head (get_next_command) and completing it (dequeue_command),
+topping the queue back up between polls so that its depth stays constant. Optionally loads a history
+of completed commands first, and moves it to the archive before polling.
+
+Run from the webapp directory: python3 -m test.benchmark_command_queue [--depths 10 1000 100000] [--history 1000000 [--archive]] ...
+Runs against a temporary database, so it's safe to run alongside a live server.
+"""
+from os import environ
+from tempfile import mkdtemp
+environ['DATA_DIR'] = mkdtemp(prefix='gmfs-benchmark-')
+
+import argparse
+import time
+from datetime import datetime, timedelta
+from statistics import quantiles
+from sqlalchemy import insert, delete
+from db import db
+from db.db import DbSession, DbClient, DbCommandQueueEntry, DbCommandStatus
+from db.db_schema import _gen_uuid
+from db.command_queue import repair_queue_lengths
+from db.retention import archive_commands
+
+CLIENT_NAME = "benchmark-client"
+
+def _percentile_ms(latencies: list[float], percentile: int) -> float:
+    if len(latencies) < 2:
+        return 1000 * latencies[0]
+    return 1000 * quantiles(latencies, n=100, method='inclusive')[percentile - 1]
+
+def _fill_queue(client_id: str, depth: int):
+    start = datetime.now()
+    with DbSession() as session:
+        session.execute(delete(DbCommandQueueEntry).where(DbCommandQueueEntry.completed == None))
+        for chunk_start in range(0, depth, 10000):
+            session.execute(insert(DbCommandQueueEntry), [
+                {'id': _gen_uuid(), 'client_id': client_id, 'command': f"command-{i}", 'priority': i % 3,
+                 'created': start + timedelta(microseconds=i), 'status': DbCommandStatus.PENDING}
+                for i in range(chunk_start, min(chunk_start + 10000, depth))])
+        repair_queue_lengths(session)
+        session.commit()
+
+def _fill_history(client_id: str, history: int):
+    """ Add commands that were completed before the archive cutoff """
+    completed = datetime.now() - timedelta(days=7)
+    with DbSession() as session:
+        for chunk_start in range(0, history, 10000):
+            session.execute(insert(DbCommandQueueEntry), [
+                {'id': _gen_uuid(), 'client_id': client_id, 'command': f"completed-{i}", 'priority': 1,
+                 'created': completed, 'acknowledged': completed, 'completed': completed + timedelta(microseconds=i),
+                 'status': DbCommandStatus.SUCCESSFUL}
+                for i in range(chunk_start, min(chunk_start + 10000, history))])
+        session.commit()
+
+def run_depth(client_id: str, depth: int, polls: int) -> dict:
+    _fill_queue(client_id, depth)
+    claims, completions = [], []
+    for _ in range(polls):
+        start = time.perf_counter()
+        claimed = db.get_next_command(CLIENT_NAME)
+        claims.append(time.perf_counter() - start)
+        assert claimed.queue_length == depth
+
+        start = time.perf_counter()
+        db.dequeue_command(CLIENT_NAME, DbCommandStatus.SUCCESSFUL)
+        completions.append(time.perf_counter() - start)
+        db.enqueue_command(CLIENT_NAME, "refill", 0)
+
+    return {kind: (_percentile_ms(latencies, 50), _percentile_ms(latencies, 99))
+            for kind, latencies in (('claim', claims), ('complete', completions))}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depths', type=int, nargs='+', default=[10, 1000, 10000, 100000], help="Queue depths to benchmark")
+    parser.add_argument('--polls', type=int, default=200, help="Polls timed at each depth")
+    parser.add_argument('--history', type=int, default=0, help="Completed commands to load before polling")
+    parser.add_argument('--archive', action='store_true', help="Move the completed commands to the archive before polling")
+    args = parser.parse_args()
+
+    client_id = db.add_client(CLIENT_NAME)
+    if args.history:
+        _fill_history(client_id, args.history)
+        print(f"Loaded {args.history} completed commands")
+    if args.archive:
+        print(f"Archived: {archive_commands()}")
+    print(f"SQLite UPDATE ... RETURNING supported: {db.engine.dialect.update_returning}")
+    print(f"{'depth':>8} {'claim p50':>10} {'claim p99':>10} {'complete p50':>13} {'complete p99':>13}")
+    for depth in args.depths:
+        results = run_depth(client_id, depth, args.polls)
+        print(f"{depth:>8} {results['claim'][0]:>8.3f}ms {results['claim'][1]:>8.3f}ms "
+              f"{results['complete'][0]:>11.3f}ms {results['complete'][1]:>11.3f}ms")
+
+    start = time.perf_counter()
+    db.get_command_history(CLIENT_NAME, limit=100)
+    print(f"Latest 100 commands of command history: {1000 * (time.perf_counter() - start):.3f}ms")
+
+if __name__ == '__main__':
+    main()
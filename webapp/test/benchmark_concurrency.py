@@ -0,0 +1,129 @@
+""" Concurrent read/write benchmark comparing SQLite's default settings, where every thread writes
+directly, against the tuned profile with writes routed through the serialized writer.
+
+Run from the webapp directory: python3 -m test.benchmark_concurrency [--readers N] [--writers N] ...
+Runs against temporary database files, so it's safe to run alongside a live server.
+"""
+from os import environ
+from tempfile import mkdtemp
+environ.setdefault('DATA_DIR', mkdtemp())
+
+import argparse
+import threading
+import time
+from statistics import quantiles
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+from db import db
+from db.db import DbClient, SerializedWriter, SQLITE_PRAGMAS, create_db_engine
+from db.migrations import migrate
+from db.client_state_report import query_client_states
+from models.models import AuthStateQuery
+
+# Write transactions exercised by the benchmark, run with an explicit session
+WRITES = [
+    lambda session, name, i: db.log_client_repo_access.__wrapped__(session, name, f"commit-{i % 10}"),
+    lambda session, name, i: db.enqueue_command.__wrapped__(session, name, f"command-{i}"),
+]
+
+def _populate(session_factory: sessionmaker, client_count: int) -> list[str]:
+    names = [f"client-{i}" for i in range(client_count)]
+    with session_factory() as session:
+        session.add_all(DbClient(name) for name in names)
+        session.commit()
+    return names
+
+def _percentile_ms(latencies: list[float], percentile: int) -> float:
+    if len(latencies) < 2:
+        return 1000 * latencies[0] if latencies else 0.0
+    return 1000 * quantiles(latencies, n=100)[percentile - 1]
+
+def run_profile(label: str, pragmas: dict[str, str], serialize_writes: bool, args) -> dict:
+    engine = create_db_engine(f"sqlite:///{mkdtemp()}/db.sqlite", pragmas)
+    migrate(engine)
+    session_factory = sessionmaker(bind=engine)
+    writer = SerializedWriter(session_factory) if serialize_writes else None
+    names = _populate(session_factory, args.clients)
+    # Client ids differ between the databases of each profile
+    db.client_registry.invalidate()
+
+    stop = threading.Event()
+    results = {'read': [], 'write': [], 'errors': 0}
+    lock = threading.Lock()
+
+    def _record(kind: str, latency: float):
+        with lock:
+            results[kind].append(latency)
+
+    def _direct_write(func, *func_args):
+        with session_factory() as session:
+            func(session, *func_args)
+            session.commit()
+
+    def _reader():
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with session_factory() as session:
+                    query_client_states(session, auth_state=AuthStateQuery.ANY)
+                _record('read', time.perf_counter() - start)
+            except OperationalError:
+                with lock:
+                    results['errors'] += 1
+
+    def _writer(thread_index: int):
+        i = 0
+        while not stop.is_set():
+            func = WRITES[i % len(WRITES)]
+            func_args = (names[(thread_index + i) % len(names)], i)
+            start = time.perf_counter()
+            try:
+                if writer:
+                    writer.run(func, *func_args)
+                else:
+                    _direct_write(func, *func_args)
+                _record('write', time.perf_counter() - start)
+            except OperationalError:
+                with lock:
+                    results['errors'] += 1
+            i += 1
+
+    threads = [threading.Thread(target=_reader) for _ in range(args.readers)]
+    threads += [threading.Thread(target=_writer, args=(i,)) for i in range(args.writers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    return {
+        'profile': label,
+        'reads/s': len(results['read']) / args.duration,
+        'writes/s': len(results['write']) / args.duration,
+        'read p50 ms': _percentile_ms(results['read'], 50),
+        'read p99 ms': _percentile_ms(results['read'], 99),
+        'write p50 ms': _percentile_ms(results['write'], 50),
+        'write p99 ms': _percentile_ms(results['write'], 99),
+        'lock errors': results['errors'],
+    }
+
+def print_results(rows: list[dict]):
+    columns = list(rows[0].keys())
+    print(" | ".join(f"{c:>12}" for c in columns))
+    for row in rows:
+        print(" | ".join(f"{v:>12.1f}" if isinstance(v, float) else f"{v:>12}" for v in row.values()))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=8)
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds to run each profile for")
+    args = parser.parse_args()
+
+    print_results([
+        run_profile('default', {}, False, args),
+        run_profile('tuned', SQLITE_PRAGMAS, True, args),
+    ])
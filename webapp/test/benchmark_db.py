@@ -1,120 +1,227 @@
-from db.db import DbSession
-from sqlalchemy import select, text
-from db.db_schema import DbClient, DbGitCommit, DbClientCommitAccess, DbClientAuthEvent, DbAuthState, DbClientStateView
-from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
-from functools import wraps
+""" Benchmark suite for the database layer. Builds a temporary SQLite database at the given scale,
+times every public function in db/db.py plus each filter of query_client_states, and reports
+p50/p95/p99 latencies. Results can be written as JSON and compared against a previous run.
+
+Run from the webapp directory:
+    python3 -m test.benchmark_db --clients 1000 --history 100 --output new.json --compare old.json
+"""
+from os import environ
+from tempfile import mkdtemp
+# Always run against a throwaway database rather than the live one
+environ['DATA_DIR'] = mkdtemp(prefix='gmfs-benchmark-')
 
-CLIENT_COUNT = 100
-COMMIT_COUNT = 75
-AUTH_COUNT = 500
+import argparse
+import itertools
+import json
+import platform
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta
+from statistics import mean, quantiles
+from sqlalchemy import insert
+from db import db
+from db.db import DbSession, DbClient, DbGitCommit, DbClientCommitAccess, DbClientAuthEvent, DbAuthState, DbCommandQueueEntry, DbCommandStatus
+from db.db_schema import _gen_uuid
+from db.client_state_report import query_client_states, rebuild_latest_states
+from db.command_queue import repair_queue_lengths
+from models.models import AuthStateQuery
 
 START_TIME = datetime.now()
 
-def with_time_logging(func):
-    @wraps(func)
-    def _log_time(*args,**kwargs):
-        start_time = datetime.now()
-        print(f"Starting {func} at {start_time}")
-        try:
-            func(*args, **kwargs)
-        finally:
-            print(f"Elapsed: {datetime.now() - start_time }")
-    return _log_time
-
-
-def _add_git_commits(session: Session, client: DbClient):
-    for i in range(COMMIT_COUNT):
-        session.add(DbClientCommitAccess(client.id, f"{i}", START_TIME - timedelta(days = i)))
-
-
-def _add_access_logs(session: Session, client: DbClient):
-    for i in range(AUTH_COUNT):
-        auth_event = DbClientAuthEvent(client.id)
-        auth_event.auth_state = DbAuthState.SUCCESSFUL
-        auth_event.initiated = START_TIME - timedelta(hours=2*i)
-        auth_event.expires = auth_event.initiated + timedelta(hours=2)
-        session.add(auth_event)
-
-@with_time_logging
-def populate_db():
+# Auth state of the latest session of each client, cycled through by client index
+LATEST_AUTH_STATES = [DbAuthState.SUCCESSFUL, DbAuthState.FAILED, DbAuthState.PENDING, 'EXPIRED']
+
+
+def client_name(i: int) -> str:
+    return f"client-{i:06}"
+
+def commit_hash(i: int) -> str:
+    return f"commit-{i:06}"
+
+def populate_db(args):
+    """ Bulk-load clients, commits, auth history, repo access history and command queues """
     with DbSession() as session:
-        # Add Git Commits
-        for i in range(COMMIT_COUNT):
-            session.add(DbGitCommit(f"{i}", START_TIME - timedelta(days = i)))
-
-        for i in range(CLIENT_COUNT):
-            client = DbClient(f"{i}")
-            session.add(client)
-            _add_git_commits(session, client)
-            _add_access_logs(session, client)
+        session.execute(insert(DbGitCommit), [
+            {'commit_hash': commit_hash(i), 'repo': db.DEFAULT_REPO, 'commit_time': START_TIME - timedelta(days=i), 'sync_time': START_TIME}
+            for i in range(args.history)])
+
+        for chunk_start in range(0, args.clients, 100):
+            clients, auth_events, accesses, commands = [], [], [], []
+            for c in range(chunk_start, min(chunk_start + 100, args.clients)):
+                client_id = _gen_uuid()
+                clients.append({'id': client_id, 'name': client_name(c), 'valid': True})
+                for i in range(args.history):
+                    initiated = START_TIME - timedelta(hours=2 * i + 1)
+                    state = LATEST_AUTH_STATES[c % len(LATEST_AUTH_STATES)] if i == 0 else DbAuthState.SUCCESSFUL
+                    auth_events.append({
+                        'id': _gen_uuid(), 'client_id': client_id, 'initiated': initiated,
+                        'auth_state': DbAuthState.SUCCESSFUL if state == 'EXPIRED' else state,
+                        'expires': initiated + (timedelta(minutes=30) if state == 'EXPIRED' else timedelta(hours=2))})
+                    # Spread clients across the most recent commits
+                    accesses.append({
+                        'id': _gen_uuid(), 'client_id': client_id, 'commit_hash': commit_hash(i + c % 3), 'repo': db.DEFAULT_REPO,
+                        'access_time': START_TIME - timedelta(days=i, minutes=c % 60)})
+                for i in range(args.queue_depth):
+                    commands.append({
+                        'id': _gen_uuid(), 'client_id': client_id, 'command': f"command-{i}", 'priority': i % 3,
+                        'created': START_TIME - timedelta(minutes=i), 'status': DbCommandStatus.PENDING})
+            session.execute(insert(DbClient), clients)
+            if auth_events:
+                session.execute(insert(DbClientAuthEvent), auth_events)
+                session.execute(insert(DbClientCommitAccess), accesses)
+            if commands:
+                session.execute(insert(DbCommandQueueEntry), commands)
         session.commit()
 
-def print_db_stats():
-    with DbSession() as session:
-        print(f"Client Count: {session.query(DbClient.id).count()}")
-        print(f"Commit Access Count: {session.query(DbClientCommitAccess.id).count()}")
-        print(f"Auth Event Count: {session.query(DbClientAuthEvent.id).count()}")
+        rebuild_latest_states(session)
+        repair_queue_lengths(session)
+        session.commit()
+    db.load_client_registry()
 
-@with_time_logging
-def find_latest_auth_iter():
-    with DbSession() as session:
-        auth_sessions = []
-        client_ids = session.scalars(select(DbClient.id))
-        for id in client_ids:
-            auth_sessions.append(session.scalar(select(DbClientAuthEvent)
-                .where(DbClientAuthEvent.client_id == id)
-                .order_by(DbClientAuthEvent.initiated.desc())
-                .limit(1)))
-        print(len(auth_sessions))
-
-@with_time_logging
-def find_latest_auth_window():
-    with DbSession() as session:
-        auth_sessions = session.query(DbClientAuthEvent).from_statement(text("""
-            WITH ordered_auth AS (
-                SELECT *, row_number() over (partition by client_id order by initiated desc) as row_num
-                FROM client_auth_sessions
-            )
-            SELECT * FROM ordered_auth where row_num = 1"""
-        )).all()
-        print(len(auth_sessions))
-
-@with_time_logging
-def find_latest_auth_inner_query():
+
+def _clients(args):
+    """ Cycle through client names so that writes are spread across the fleet """
+    return itertools.cycle(client_name(i) for i in range(args.clients))
+
+def benchmarks(args) -> dict:
+    """ Map of benchmark name -> (setup, func). setup is called untimed before each call of func,
+    and returns the arguments to pass to it """
+    clients = _clients(args)
+    commit_counter = itertools.count()
+    added_clients = itertools.count()
+
+    def _next_client():
+        return (next(clients),)
+
+    def _pending_session():
+        name = next(clients)
+        return name, db.create_auth_session(name).challenge_secret
+
+    def _acknowledged_head():
+        name = next(clients)
+        db.enqueue_command(name, "benchmark-command")
+        db.get_next_command(name)
+        return name, DbCommandStatus.SUCCESSFUL
+
+    def _access_batch():
+        return ({(db.client_registry.get_client_id(None, next(clients)), db.DEFAULT_REPO, commit_hash(0)): datetime.now()
+                 for _ in range(100)},)
+
+    suite = {
+        'add_client': (lambda: (f"added-{next(added_clients)}",), db.add_client),
+        'invalidate_client': (lambda: (f"added-{next(added_clients)}",), lambda name: (db.add_client(name), db.invalidate_client(name))),
+        'load_client_registry': (None, db.load_client_registry),
+        'create_auth_session': (_next_client, db.create_auth_session),
+        'activate_auth_session': (_pending_session, lambda name, secret: db.activate_auth_session(name, secret, datetime.now() + timedelta(hours=2))),
+        'fail_auth_session': (_pending_session, db.fail_auth_session),
+        'log_client_repo_access': (lambda: (next(clients), commit_hash(0)), db.log_client_repo_access),
+        'log_client_repo_accesses[100]': (_access_batch, db.log_client_repo_accesses),
+        'buffer_client_repo_access': (lambda: (next(clients), commit_hash(0)), db.buffer_client_repo_access),
+        'log_commit_fetch[new]': (lambda: (f"new-commit-{next(commit_counter)}", datetime.now()), db.log_commit_fetch),
+        'log_commit_fetch[existing]': (lambda: (commit_hash(0), START_TIME), db.log_commit_fetch),
+        'get_client_status_report': (None, db.get_client_status_report),
+        'get_client_status_report[page]': (lambda: (None, AuthStateQuery.ANY, None, client_name(args.clients // 2), 100), db.get_client_status_report),
+        'get_client_status_summary': (None, db.get_client_status_summary),
+        'enqueue_command': (lambda: (next(clients), "benchmark-command"), db.enqueue_command),
+        'enqueue_commands[fleet]': (None, lambda: db.enqueue_commands("benchmark-command")),
+        'enqueue_commands[behind latest]': (None, lambda: db.enqueue_commands("benchmark-command", latest_commit=False)),
+        'get_next_command': (_next_client, db.get_next_command),
+        'dequeue_command': (_acknowledged_head, db.dequeue_command),
+    }
+
+    # query_client_states with each filter, for both the current and a historical report
+    historical_time = START_TIME - timedelta(hours=5)
+    for report_label, report_time in (('now', None), ('historical', historical_time)):
+        for auth_state in AuthStateQuery:
+            for latest_commit in (None, True, False):
+                name = f"query_client_states[{report_label},{auth_state.value},latest_commit={latest_commit}]"
+                suite[name] = (None, lambda *_, r=report_time, a=auth_state, l=latest_commit: _query_client_states(r, a, l))
+    return suite
+
+def _query_client_states(report_time, auth_state, latest_commit):
     with DbSession() as session:
-        auth_sessions = session.query(DbClientStateView).from_statement(text("""
-        WITH latest_auth AS (
-            SELECT client_auth_sessions.* FROM client
-            LEFT JOIN client_auth_sessions ON client.id = client_auth_sessions.client_id
-            WHERE client_auth_sessions.id = (
-                SELECT id FROM client_auth_sessions
-                WHERE client_auth_sessions.client_id = client.id
-                ORDER BY initiated DESC
-                LIMIT 1
-            )
-        ), latest_commit AS (
-            SELECT client_commit_access.* FROM client
-            LEFT JOIN client_commit_access ON client.id = client_commit_access.client_id
-            WHERE client_commit_access.id = (
-                SELECT id FROM client_commit_access
-                WHERE client_commit_access.client_id = client.id
-                ORDER BY access_time DESC
-                LIMIT 1
-            )
-        )
-        SELECT 
-            client.id, client.name,
-            latest_auth.auth_state, latest_auth.initiated, latest_auth.expires,
-            latest_commit.commit_hash, latest_commit.access_time
-        FROM client
-        LEFT JOIN latest_auth ON latest_auth.client_id = client.id
-        LEFT JOIN latest_commit ON latest_commit.client_id = client.id
-        """)).all()
-        print(len(auth_sessions))
+        return query_client_states(session, report_time, auth_state, latest_commit)
+
+
+def _percentile_ms(timings: list[float], percentile: int) -> float:
+    if len(timings) < 2:
+        return 1000 * timings[0]
+    return 1000 * quantiles(timings, n=100, method='inclusive')[percentile - 1]
+
+def run_benchmark(setup, func, iterations: int, warmup: int) -> dict:
+    timings = []
+    for i in range(warmup + iterations):
+        func_args = setup() if setup else ()
+        start = time.perf_counter()
+        func(*func_args)
+        elapsed = time.perf_counter() - start
+        if i >= warmup:
+            timings.append(elapsed)
+    return {
+        'iterations': iterations,
+        'mean_ms': 1000 * mean(timings),
+        'p50_ms': _percentile_ms(timings, 50),
+        'p95_ms': _percentile_ms(timings, 95),
+        'p99_ms': _percentile_ms(timings, 99),
+    }
+
+def compare(results: dict, baseline: dict, threshold: float) -> bool:
+    """ Print the change in p50/p95 against a baseline run, returning whether any benchmark's
+    p95 regressed by more than the given ratio """
+    if baseline['params'] != results['params']:
+        print(f"Warning: baseline was run with different parameters: {baseline['params']}")
+
+    regressed = False
+    print(f"\n{'benchmark':<70} {'p50 base':>9} {'p50 new':>9} {'p95 base':>9} {'p95 new':>9} {'ratio':>6}")
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        ratio = result['p95_ms'] / base['p95_ms'] if base['p95_ms'] else float('inf')
+        flag = "  REGRESSION" if ratio > threshold else ""
+        regressed |= bool(flag)
+        print(f"{name:<70} {base['p50_ms']:>9.3f} {result['p50_ms']:>9.3f} {base['p95_ms']:>9.3f} {result['p95_ms']:>9.3f} {ratio:>6.2f}{flag}")
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000, help="Number of clients")
+    parser.add_argument('--history', type=int, default=50, help="Auth sessions, repo accesses and commits per client")
+    parser.add_argument('--queue-depth', type=int, default=20, help="Pending commands per client")
+    parser.add_argument('--iterations', type=int, default=50, help="Timed calls per benchmark")
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed calls per benchmark before timing")
+    parser.add_argument('--filter', default='', help="Only run benchmarks whose name contains this string")
+    parser.add_argument('--output', help="Write results to this JSON file")
+    parser.add_argument('--compare', help="Compare results against this JSON file from a previous run")
+    parser.add_argument('--threshold', type=float, default=1.25, help="p95 ratio above which a benchmark counts as a regression")
+    args = parser.parse_args()
+
+    populate_start = time.perf_counter()
+    populate_db(args)
+    print(f"Populated {environ['DATA_DIR']} in {time.perf_counter() - populate_start:.1f}s")
+
+    results = {
+        'params': {k: getattr(args, k) for k in ('clients', 'history', 'queue_depth', 'iterations', 'warmup')},
+        'environment': {'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform()},
+        'timestamp': datetime.now().isoformat(),
+        'results': {},
+    }
+    for name, (setup, func) in benchmarks(args).items():
+        if args.filter not in name:
+            continue
+        result = run_benchmark(setup, func, args.iterations, args.warmup)
+        results['results'][name] = result
+        print(f"{name:<70} p50 {result['p50_ms']:>9.3f}ms  p95 {result['p95_ms']:>9.3f}ms  p99 {result['p99_ms']:>9.3f}ms")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
 if __name__ == '__main__':
-    populate_db()
-    print_db_stats()
-    find_latest_auth_iter()
-    find_latest_auth_window()
-    find_latest_auth_inner_query()
+    main()
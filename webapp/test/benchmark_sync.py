@@ -0,0 +1,202 @@
+""" Per-sync fetch latency against an SSH upstream, with a new agent and SSH connection for each
+fetch as sync_repo used to do, versus the long-lived agent and multiplexed connection it uses now.
+Stands up a throwaway SSH server on localhost serving a bare repo, so no real upstream is needed.
+
+Run from the webapp directory: python3 -m test.benchmark_sync [--syncs 50] [--port 2222] [--server sshd|paramiko]
+With the default sshd server, needs sshd, and must run as a user that sshd will accept logins for
+by key. Where sshd isn't available, --server paramiko stands up a minimal server built on paramiko
+instead, which needs paramiko installed.
+
+50 fetches over localhost, with --server paramiko, on 1 CPU:
+                      mode  fetch p50  fetch p99
+            agent per sync    130.8ms    159.4ms
+ shared agent, multiplexed    108.1ms    128.4ms
+Against a remote upstream, each SSH handshake also costs network round trips, so the gap widens.
+"""
+import argparse
+import base64
+import getpass
+import importlib.util
+import multiprocessing
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from statistics import quantiles
+from tempfile import mkdtemp
+from util.ssh_agent import SshAgent
+
+SSHD_PATHS = ['/usr/sbin/sshd', '/usr/bin/sshd']
+
+
+def _percentile_ms(latencies: list[float], percentile: int) -> float:
+    if len(latencies) < 2:
+        return 1000 * latencies[0]
+    return 1000 * quantiles(latencies, n=100, method='inclusive')[percentile - 1]
+
+def _git(cwd: Path, *args, env: dict[str, str] = None):
+    subprocess.run(['git', '-c', 'user.name=benchmark', '-c', 'user.email=benchmark@example.com', *args],
+                   cwd=cwd, env=env, check=True, capture_output=True)
+
+def _start_sshd(root: Path, port: int, client_key: Path) -> subprocess.Popen:
+    sshd = next((path for path in SSHD_PATHS if Path(path).exists()), shutil.which('sshd'))
+    if sshd is None:
+        sys.exit("sshd is not available, can't stand up a local upstream")
+
+    host_key = root / 'host_key'
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', str(host_key)], check=True)
+    authorized_keys = root / 'authorized_keys'
+    authorized_keys.write_text(Path(f"{client_key}.pub").read_text())
+    authorized_keys.chmod(0o600)
+    config = root / 'sshd_config'
+    config.write_text(f"Port {port}\nListenAddress 127.0.0.1\nHostKey {host_key}\n"
+                      f"AuthorizedKeysFile {authorized_keys}\nPasswordAuthentication no\n"
+                      f"StrictModes no\nPidFile {root / 'sshd.pid'}\n")
+    process = subprocess.Popen([sshd, '-D', '-e', '-f', str(config)], stderr=subprocess.DEVNULL)
+    time.sleep(0.5)
+    return process
+
+def _serve_paramiko(port: int, host_key: Path, client_key: Path, listening):
+    """ Accept SSH logins by the client key, running each exec request, such as git-upload-pack,
+    in a shell with its stdin and stdout connected to the channel. Sets listening once it's listening """
+    import paramiko
+
+    key_type, key_data = Path(f"{client_key}.pub").read_text().split()[:2]
+    authorized_key = paramiko.PKey.from_type_string(key_type, base64.b64decode(key_data))
+
+    def _run(channel, command: str):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        def _pump_stdin():
+            while data := channel.recv(65536):
+                process.stdin.write(data)
+                process.stdin.flush()
+            process.stdin.close()
+        threading.Thread(target=_pump_stdin, daemon=True).start()
+        while data := process.stdout.read1(65536):
+            channel.sendall(data)
+        channel.send_exit_status(process.wait())
+        channel.close()
+
+    class _Server(paramiko.ServerInterface):
+        def get_allowed_auths(self, username):
+            return 'publickey'
+
+        def check_auth_publickey(self, username, key):
+            return paramiko.AUTH_SUCCESSFUL if key == authorized_key else paramiko.AUTH_FAILED
+
+        def check_channel_request(self, kind, chanid):
+            return paramiko.OPEN_SUCCEEDED if kind == 'session' else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+        def check_channel_exec_request(self, channel, command):
+            threading.Thread(target=_run, args=(channel, command.decode()), daemon=True).start()
+            return True
+
+    server_key = paramiko.Ed25519Key.from_private_key_file(str(host_key))
+    def _handle(client: socket.socket):
+        transport = paramiko.Transport(client)
+        transport.add_server_key(server_key)
+        transport.start_server(server=_Server())
+        while transport.is_active():
+            transport.join(1)
+
+    listener = socket.create_server(('127.0.0.1', port))
+    listening.set()
+    while True:
+        client, _ = listener.accept()
+        threading.Thread(target=_handle, args=(client,), daemon=True).start()
+
+def _start_paramiko_server(root: Path, port: int, client_key: Path) -> multiprocessing.Process:
+    if importlib.util.find_spec('paramiko') is None:
+        sys.exit("paramiko is not installed, can't stand up a local upstream with --server paramiko")
+
+    host_key = root / 'host_key'
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', str(host_key)], check=True)
+    listening = multiprocessing.Event()
+    process = multiprocessing.Process(target=_serve_paramiko, args=(port, host_key, client_key, listening), daemon=True)
+    process.start()
+    # Importing paramiko takes a while
+    if not listening.wait(10):
+        process.terminate()
+        sys.exit("The paramiko server didn't start listening")
+    return process
+
+def _time_fetches(clone: Path, syncs: int, env_for_sync) -> list[float]:
+    latencies = []
+    for _ in range(syncs):
+        # Includes starting and stopping the agent, where a sync does that
+        start = time.perf_counter()
+        with env_for_sync() as env:
+            _git(clone, 'fetch', '--all', env=env)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+class _AgentPerSync:
+    """ A fresh agent and SSH connection for each sync, as sync_repo did before """
+    def __init__(self, key: Path, root: Path, ssh_options: str):
+        self._agent = SshAgent(str(key), root / 'unused-control', '0')
+        self._ssh_options = ssh_options
+
+    def __enter__(self) -> dict[str, str]:
+        self._agent.start()
+        return {**self._agent.env(), 'GIT_SSH_COMMAND': f"ssh -o ControlMaster=no {self._ssh_options}"}
+
+    def __exit__(self, *_):
+        self._agent.stop()
+
+class _SharedAgent:
+    """ The long-lived agent and multiplexed connection that sync_repo uses now """
+    def __init__(self, agent: SshAgent, ssh_options: str):
+        self._agent = agent
+        self._ssh_options = ssh_options
+
+    def __enter__(self) -> dict[str, str]:
+        env = self._agent.env()
+        return {**env, 'GIT_SSH_COMMAND': f"{env['GIT_SSH_COMMAND']} {self._ssh_options}"}
+
+    def __exit__(self, *_):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--syncs', type=int, default=50, help="Fetches timed in each mode")
+    parser.add_argument('--port', type=int, default=2222, help="Port for the local SSH server")
+    parser.add_argument('--server', choices=['sshd', 'paramiko'], default='sshd', help="Local SSH server to fetch from")
+    args = parser.parse_args()
+
+    root = Path(mkdtemp(prefix='gmfs-benchmark-sync-'))
+    key = root / 'id_ed25519'
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', str(key)], check=True)
+    start_server = _start_sshd if args.server == 'sshd' else _start_paramiko_server
+    server = start_server(root, args.port, key)
+    ssh_options = f"-p {args.port} -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o LogLevel=ERROR"
+    # Not under root, whose path is too long for the control sockets' to fit in a socket address
+    control_dir = Path(mkdtemp(prefix='gmfs-ssh-'))
+    agent = SshAgent(str(key), control_dir, '10m')
+    try:
+        upstream = root / 'upstream.git'
+        _git(root, 'init', '--bare', str(upstream))
+        work = root / 'work'
+        _git(root, 'init', str(work))
+        _git(work, 'commit', '--allow-empty', '-m', 'commit')
+        _git(work, 'push', str(upstream), 'HEAD:refs/heads/main')
+
+        clone = root / 'clone'
+        _git(root, 'init', str(clone))
+        _git(clone, 'remote', 'add', 'origin', f"{getpass.getuser()}@127.0.0.1:{upstream}")
+
+        agent.start()
+        print(f"{'mode':>26} {'fetch p50':>10} {'fetch p99':>10}")
+        for mode, env_for_sync in (('agent per sync', lambda: _AgentPerSync(key, root, ssh_options)),
+                                   ('shared agent, multiplexed', lambda: _SharedAgent(agent, ssh_options))):
+            latencies = _time_fetches(clone, args.syncs, env_for_sync)
+            print(f"{mode:>26} {_percentile_ms(latencies, 50):>8.1f}ms {_percentile_ms(latencies, 99):>8.1f}ms")
+    finally:
+        agent.stop()
+        server.terminate()
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
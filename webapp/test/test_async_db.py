@@ -0,0 +1,75 @@
+import pytest
+import asyncio
+import time
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from db import db, async_db
+from models.models import AuthStateQuery
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+TEST_CMD = "Test Command!"
+TEST_COMMIT = "test-commit"
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, then delete that client """
+    populate_db()
+    yield
+    reset_db()
+
+def test_wait_for_commands_timeout():
+    """ Ensure that a batch long-poll of an empty queue returns an empty batch after the wait """
+    start = time.monotonic()
+    response = asyncio.run(async_db.wait_for_command(CLIENT_NAME, 0.2, max_commands=5))
+    assert time.monotonic() - start >= 0.2
+    assert (response.commands, response.queue_length) == ([], 0)
+
+def test_wait_for_commands_wakes_on_enqueue():
+    """ Ensure that a batch long-poll returns the enqueued commands as soon as they're enqueued """
+    async def _poll():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.2, loop.run_in_executor, None, db.enqueue_command, CLIENT_NAME, TEST_CMD)
+        start = loop.time()
+        response = await async_db.wait_for_command(CLIENT_NAME, 10, max_commands=5)
+        return response, loop.time() - start
+
+    response, elapsed = asyncio.run(_poll())
+    assert [command.command for command in response.commands] == [TEST_CMD]
+    assert elapsed < 5
+
+def test_report_reads():
+    """ Ensure that the async report, streamed report and summary read what the writer wrote """
+    async def _write_then_read():
+        challenge = await async_db.create_auth_session(CLIENT_NAME)
+        await async_db.activate_auth_session(CLIENT_NAME, challenge.challenge_secret, datetime.now() + timedelta(hours=2))
+        await async_db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+        report = await async_db.get_client_status_report(auth_state=AuthStateQuery.SUCCESSFUL)
+        streamed = [status async for status in async_db.stream_client_status_report()]
+        summary = await async_db.get_client_status_summary()
+        return report, streamed, summary
+
+    report, streamed, summary = asyncio.run(_write_then_read())
+    assert report == streamed == db.get_client_status_report()
+    assert [(status.client_name, status.repo_access.commit_hash) for status in report] == [(CLIENT_NAME, TEST_COMMIT)]
+    assert summary == db.get_client_status_summary()
+    assert (summary.total, summary.commits) == (1, {TEST_COMMIT: 1})
+
+def test_command_history():
+    """ Ensure that commands completed through the async API are read back in its history """
+    async def _complete():
+        await async_db.enqueue_command(CLIENT_NAME, TEST_CMD)
+        assert (await async_db.get_next_command(CLIENT_NAME)).command == TEST_CMD
+        await async_db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+        return await async_db.get_command_history(CLIENT_NAME)
+
+    history = asyncio.run(_complete())
+    assert [(entry.command, entry.status) for entry in history] == [(TEST_CMD, db.DbCommandStatus.SUCCESSFUL)]
+    assert history == db.get_command_history(CLIENT_NAME)
+
+def test_unknown_client():
+    """ Ensure that an access report of an unknown client is rejected before it's buffered """
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(async_db.buffer_client_repo_access("not-a-client", TEST_COMMIT))
+    assert e.value.status_code == 404
+    assert db.access_buffer.pending() == 0
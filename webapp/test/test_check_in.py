@@ -0,0 +1,50 @@
+import pytest
+from db import db
+from fastapi import HTTPException
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME, CLIENT_ID
+
+TEST_CMD = "Test Command!"
+TEST_COMMIT = "test-commit"
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client with a queued command, then delete that client """
+    populate_db()
+    db.log_commit_fetch(TEST_COMMIT, datetime.now() - timedelta(minutes=1))
+    db.enqueue_command(CLIENT_NAME, TEST_CMD)
+    yield
+    reset_db()
+
+def _accessed_commits() -> list[str]:
+    with db.DbSession() as session:
+        return session.scalars(db.select(db.DbClientCommitAccess.commit_hash)
+            .where(db.DbClientCommitAccess.client_id == CLIENT_ID)).all()
+
+def test_check_in():
+    """ Ensure that a check-in records the access and claims the head of the queue """
+    response = db.check_in(CLIENT_NAME, TEST_COMMIT)
+    assert (response.queue_length, response.command) == (1, TEST_CMD)
+    assert _accessed_commits() == [TEST_COMMIT]
+    # The command was handed out, so it can be completed
+    assert db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL).queue_length == 0
+
+def test_check_in_without_returning(monkeypatch):
+    """ Ensure that a check-in hands out the command's id on SQLite versions without UPDATE ... RETURNING """
+    monkeypatch.setattr(db.engine.dialect, 'update_returning', False)
+    response = db.check_in(CLIENT_NAME, TEST_COMMIT)
+    assert (response.queue_length, response.command) == (1, TEST_CMD)
+    assert response.id is not None
+    assert db.dequeue_commands(CLIENT_NAME, [(response.id, db.DbCommandStatus.SUCCESSFUL)]).queue_length == 0
+
+def test_check_in_without_commit():
+    """ Ensure that a client without a repo can still check in """
+    assert db.check_in(CLIENT_NAME).command == TEST_CMD
+    assert _accessed_commits() == []
+
+def test_check_in_unknown_client():
+    """ Ensure that an unknown client's check-in is rejected """
+    with pytest.raises(HTTPException) as e:
+        db.check_in("not-a-client", TEST_COMMIT)
+    assert e.value.status_code == 404
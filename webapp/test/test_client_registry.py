@@ -0,0 +1,77 @@
+import pytest
+import time
+from db import db
+from db.client_registry import ClientRegistry
+from .test_util import populate_db, reset_db, CLIENT_NAME, CLIENT_ID
+
+NEW_CLIENT = "registry-test-client"
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, then delete every client and empty the registry """
+    populate_db()
+    yield
+    reset_db()
+    db.client_registry.invalidate()
+
+def _lookup(registry: ClientRegistry, name: str) -> str:
+    with db.DbSession() as session:
+        return registry.get_client_id(session, name)
+
+def _stats(registry: ClientRegistry) -> tuple[int, int]:
+    stats = registry.stats()
+    return stats['hits'], stats['misses']
+
+def test_hit():
+    """ Ensure that a loaded client is resolved from memory """
+    registry = ClientRegistry(60)
+    with db.DbSession() as session:
+        registry.load(session)
+    assert _lookup(registry, CLIENT_NAME) == CLIENT_ID
+    assert _lookup(registry, CLIENT_NAME) == CLIENT_ID
+    assert _stats(registry) == (2, 0)
+
+def test_miss_after_ttl():
+    """ Ensure that an entry is looked up again once its TTL has passed, picking up changes made
+    outside the registry """
+    registry = ClientRegistry(0.1)
+    assert _lookup(registry, CLIENT_NAME) == CLIENT_ID
+    assert _lookup(registry, CLIENT_NAME) == CLIENT_ID
+    assert _stats(registry) == (1, 1)
+
+    with db.DbSession() as session:
+        session.execute(db.update(db.DbClient).where(db.DbClient.id == CLIENT_ID).values(valid=False))
+        session.commit()
+    # Still cached as valid until the TTL passes
+    assert _lookup(registry, CLIENT_NAME) == CLIENT_ID
+    time.sleep(0.15)
+    assert _lookup(registry, CLIENT_NAME) is None
+    assert _stats(registry) == (2, 2)
+
+def test_unknown_client_not_cached():
+    """ Ensure that an unknown name is looked up each time, so that a new client is found at once """
+    registry = ClientRegistry(60)
+    assert _lookup(registry, NEW_CLIENT) is None
+    assert _lookup(registry, NEW_CLIENT) is None
+    assert _stats(registry) == (0, 2)
+    assert registry.stats()['size'] == 0
+
+def test_add_client():
+    """ Ensure that adding a client records it in the registry, so its first lookup is a hit """
+    db.client_registry.invalidate()
+    hits, misses = _stats(db.client_registry)
+    client_id = db.add_client(NEW_CLIENT)
+    assert _lookup(db.client_registry, NEW_CLIENT) == client_id
+    assert _stats(db.client_registry) == (hits + 1, misses)
+
+def test_invalidate_client():
+    """ Ensure that invalidating a client drops it from the registry, so it's no longer resolved """
+    assert _lookup(db.client_registry, CLIENT_NAME) == CLIENT_ID
+    db.invalidate_client(CLIENT_NAME)
+    hits, misses = _stats(db.client_registry)
+    assert _lookup(db.client_registry, CLIENT_NAME) is None
+    assert _stats(db.client_registry) == (hits, misses + 1)
+    # The invalid client is cached as such
+    assert _lookup(db.client_registry, CLIENT_NAME) is None
+    assert _stats(db.client_registry) == (hits + 1, misses + 1)
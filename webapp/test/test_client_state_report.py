@@ -0,0 +1,193 @@
+import pytest
+import json
+from fastapi.testclient import TestClient
+import app
+from db import db
+from db.client_state_report import check_latest_states, rebuild_latest_states
+from models.models import AuthStateQuery
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME, CLIENT_ID
+
+TEST_COMMIT = "test-commit"
+# Clients besides the test client, for paginating the report
+PAGE_CLIENTS = [f"page-client-{i}" for i in range(6)]
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, then delete that client """
+    populate_db()
+    yield
+    reset_db()
+
+def _latest_state() -> db.DbClientLatestState:
+    with db.DbSession() as session:
+        return session.get(db.DbClientLatestState, CLIENT_ID)
+
+def test_latest_state_tracks_auth_session():
+    """ Ensure that each step of the auth handshake updates the client's latest state """
+    challenge = db.create_auth_session(CLIENT_NAME)
+    assert _latest_state().auth_state == db.DbAuthState.PENDING
+
+    expires = datetime.now() + timedelta(hours=2)
+    db.activate_auth_session(CLIENT_NAME, challenge.challenge_secret, expires)
+    state = _latest_state()
+    assert state.auth_state == db.DbAuthState.SUCCESSFUL
+    assert state.expires == expires
+
+    challenge = db.create_auth_session(CLIENT_NAME)
+    db.fail_auth_session(CLIENT_NAME, challenge.challenge_secret)
+    assert _latest_state().auth_state == db.DbAuthState.FAILED
+
+def test_latest_state_tracks_repo_access():
+    """ Ensure that logging a repo access updates the client's latest state """
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+    state = _latest_state()
+    assert state.commit_hash == TEST_COMMIT
+    assert abs(datetime.now() - state.access_time) < timedelta(seconds=5)
+
+def test_latest_state_matches_history():
+    """ Ensure that the current report matches the report generated from the full history,
+    both before and after rebuilding client_latest_state """
+    challenge = db.create_auth_session(CLIENT_NAME)
+    db.activate_auth_session(CLIENT_NAME, challenge.challenge_secret, datetime.now() + timedelta(hours=2))
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+
+    with db.DbSession() as session:
+        assert check_latest_states(session) == []
+        rebuild_latest_states(session)
+        session.commit()
+        assert check_latest_states(session) == []
+
+    status = db.get_client_status_report(auth_state=AuthStateQuery.SUCCESSFUL)
+    assert len(status) == 1
+    assert status[0].repo_access.commit_hash == TEST_COMMIT
+
+def test_buffered_repo_access():
+    """ Ensure that buffered repo access reports are coalesced into one row per commit, and
+    that flushing them keeps the client's latest state consistent with the history """
+    for commit_hash in ("commit-1", TEST_COMMIT, "commit-1", TEST_COMMIT):
+        db.buffer_client_repo_access(CLIENT_NAME, commit_hash)
+    assert db.access_buffer.pending() == 2
+    assert db.access_buffer.flush() == 2
+
+    with db.DbSession() as session:
+        reports = session.scalars(db.select(db.DbClientCommitAccess)
+            .where(db.DbClientCommitAccess.client_id == CLIENT_ID)).all()
+        assert len(reports) == 2
+        assert check_latest_states(session) == []
+    assert _latest_state().commit_hash == TEST_COMMIT
+
+def test_access_of_unknown_repo():
+    """ Ensure that an access of a repo that isn't served is rejected, whether it's reported on its
+    own or with a check-in, and that nothing is recorded for it """
+    client = TestClient(app.app)
+    auth = (CLIENT_NAME, "password")
+    response = client.post('/private/log-repo-access', auth=auth,
+                           json={'name': 'not-a-repo', 'upstream': None, 'commit_hash': TEST_COMMIT})
+    assert response.status_code == 404
+    response = client.post('/private/check-in', auth=auth, json={'commit_hash': TEST_COMMIT, 'repo': 'not-a-repo'})
+    assert response.status_code == 404
+    assert db.access_buffer.flush() == 0
+    assert _latest_state() is None
+
+    response = client.post('/private/log-repo-access', auth=auth,
+                           json={'name': db.DEFAULT_REPO, 'upstream': None, 'commit_hash': TEST_COMMIT})
+    assert response.status_code == 200
+    db.access_buffer.flush()
+    assert _latest_state().commit_hash == TEST_COMMIT
+
+def test_latest_commit_per_repo():
+    """ Ensure that a client is on the latest commit if it has the latest commit of the repo it
+    pulls, even if another repo has a newer commit """
+    db.log_commit_fetch(TEST_COMMIT, datetime.now() - timedelta(minutes=2))
+    db.log_commit_fetch("other-commit", datetime.now() - timedelta(minutes=1), "other-repo")
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+
+    status, = db.get_client_status_report(latest_commit=True)
+    assert status.repo_access.repo == db.DEFAULT_REPO
+    assert db.get_client_status_report(latest_commit=False) == []
+    assert db.get_client_status_report(datetime.now(), latest_commit=True) == [status]
+
+    summary = db.get_client_status_summary()
+    assert summary.latest_commit == TEST_COMMIT
+    assert summary.latest_commits == {db.DEFAULT_REPO: TEST_COMMIT, "other-repo": "other-commit"}
+    assert (summary.on_latest_commit, summary.behind_latest_commit) == (1, 0)
+
+    # A newer commit of the client's own repo puts it behind
+    db.log_commit_fetch("newer-commit", datetime.now())
+    assert db.get_client_status_summary().behind_latest_commit == 1
+
+def test_summary_with_unknown_repo():
+    """ Ensure that an access recorded without a repo is counted, rather than breaking the summary """
+    db.log_commit_fetch(TEST_COMMIT, datetime.now() - timedelta(minutes=1))
+    with db.DbSession() as session:
+        session.add(db.DbClientCommitAccess(CLIENT_ID, TEST_COMMIT, datetime.now()))
+        session.commit()
+        rebuild_latest_states(session)
+        session.commit()
+
+    summary = db.get_client_status_summary()
+    assert (summary.commits, summary.on_latest_commit, summary.behind_latest_commit) == ({TEST_COMMIT: 1}, 0, 1)
+
+def test_summary_counts():
+    """ Ensure that the summary counts clients by auth state and commit, matching the report """
+    db.log_commit_fetch("old-commit", datetime.now() - timedelta(minutes=2))
+    db.log_commit_fetch(TEST_COMMIT, datetime.now() - timedelta(minutes=1))
+    challenge = db.create_auth_session(CLIENT_NAME)
+    db.activate_auth_session(CLIENT_NAME, challenge.challenge_secret, datetime.now() + timedelta(hours=2))
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+    for name in ("behind-client", "failed-client", "new-client"):
+        db.add_client(name)
+    db.log_client_repo_access("behind-client", "old-commit")
+    challenge = db.create_auth_session("failed-client")
+    db.fail_auth_session("failed-client", challenge.challenge_secret)
+
+    for report_time in (None, datetime.now()):
+        summary = db.get_client_status_summary(report_time)
+        assert summary.total == 4
+        assert summary.auth_states == {'PENDING': 0, 'SUCCESSFUL': 1, 'FAILED': 1, 'EXPIRED': 0, 'NONE': 2}
+        assert summary.latest_commit == TEST_COMMIT
+        assert (summary.on_latest_commit, summary.behind_latest_commit, summary.no_repo_access) == (1, 1, 2)
+        assert summary.commits == {TEST_COMMIT: 1, "old-commit": 1}
+
+        summary = db.get_client_status_summary(report_time, AuthStateQuery.NONE, latest_commit=False)
+        assert (summary.total, summary.behind_latest_commit, summary.no_repo_access) == (2, 1, 1)
+        assert summary.total == len(db.get_client_status_report(report_time, AuthStateQuery.NONE, latest_commit=False))
+
+def _client_names(statuses) -> list[str]:
+    return [status.client_name for status in statuses]
+
+@pytest.mark.parametrize('report_time', [None, datetime.max])
+def test_report_pages(report_time):
+    """ Ensure that walking the report a page at a time returns every client once, in name order """
+    for name in PAGE_CLIENTS:
+        db.add_client(name)
+    everyone = _client_names(db.get_client_status_report(report_time))
+    assert everyone == sorted(PAGE_CLIENTS + [CLIENT_NAME])
+
+    pages, after = [], None
+    while page := _client_names(db.get_client_status_report(report_time, after=after, limit=3)):
+        pages.append(page)
+        after = page[-1]
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert sum(pages, []) == everyone
+
+    assert db.get_client_status_report(report_time, limit=0) == []
+    assert _client_names(db.get_client_status_report(report_time, after=everyone[-1])) == []
+
+def test_report_ndjson():
+    """ Ensure that the NDJSON report has one client per line, matching the JSON report """
+    for name in PAGE_CLIENTS:
+        db.add_client(name)
+    client = TestClient(app.app)
+    expected = client.get('/public/client-status', params={'after': PAGE_CLIENTS[0], 'limit': 4}).json()
+    assert len(expected) == 4
+
+    response = client.get('/public/client-status', params={'after': PAGE_CLIENTS[0], 'limit': 4, 'format': 'ndjson'})
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert [json.loads(line) for line in response.text.splitlines()] == expected
+    assert response.text.endswith('\n')
+
+    assert client.get('/public/client-status', params={'limit': 0, 'format': 'ndjson'}).text == ''
+    assert client.get('/public/client-status', params={'limit': 0}).json() == []
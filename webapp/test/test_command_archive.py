@@ -0,0 +1,72 @@
+import pytest
+from db import db
+from db.retention import archive_commands
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+COMMAND_COUNT = 5
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, complete a few commands, then delete that client """
+    populate_db()
+    for i in range(COMMAND_COUNT):
+        db.enqueue_command(CLIENT_NAME, f"command-{i}", 1, datetime.now() + timedelta(seconds=i))
+    for i in range(COMMAND_COUNT - 1):
+        db.get_next_command(CLIENT_NAME)
+        db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL if i % 2 else db.DbCommandStatus.FAILED)
+    yield
+    reset_db()
+
+def _row_counts() -> tuple[int, int]:
+    with db.DbSession() as session:
+        return (session.scalar(db.select(db.func.count()).select_from(db.DbCommandQueueEntry)),
+                session.scalar(db.select(db.func.count()).select_from(db.DbCommandArchiveEntry)))
+
+def test_archive_commands():
+    """ Ensure that only completed commands are moved to the archive, in batches """
+    history = db.get_command_history(CLIENT_NAME)
+    assert archive_commands(timedelta(hours=1))['client_command_queue'] == 0
+
+    report = archive_commands(timedelta(0), batch_size=3)
+    assert report['client_command_queue'] == COMMAND_COUNT - 1
+    assert _row_counts() == (1, COMMAND_COUNT - 1)
+
+    # The live command is unaffected, and the history reads the same from the archive
+    command = db.get_next_command(CLIENT_NAME)
+    assert command.queue_length == 1
+    assert command.command == f"command-{COMMAND_COUNT - 1}"
+    assert db.get_command_history(CLIENT_NAME) == history
+
+def test_archive_tied_completion_times():
+    """ Ensure that commands completed at the same time are each archived exactly once, even when
+    a batch boundary falls among them """
+    with db.DbSession() as session:
+        session.execute(db.update(db.DbCommandQueueEntry)
+            .where(db.DbCommandQueueEntry.completed != None)
+            .values(completed=datetime.now() - timedelta(hours=1)))
+        session.commit()
+
+    assert archive_commands(timedelta(0), batch_size=3)['client_command_queue'] == COMMAND_COUNT - 1
+    assert _row_counts() == (1, COMMAND_COUNT - 1)
+    assert archive_commands(timedelta(0), batch_size=3)['client_command_queue'] == 0
+
+def test_command_history():
+    """ Ensure that the history spans the queue and archive, newest first, with filters and paging """
+    archive_commands(timedelta(0), batch_size=2)
+    db.get_next_command(CLIENT_NAME)
+    db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+    assert _row_counts() == (1, COMMAND_COUNT - 1)
+
+    history = db.get_command_history()
+    assert [entry.command for entry in history] == [f"command-{i}" for i in reversed(range(COMMAND_COUNT))]
+    assert all(entry.client_name == CLIENT_NAME for entry in history)
+
+    failed = db.get_command_history(status=db.DbCommandStatus.FAILED)
+    assert [entry.command for entry in failed] == ["command-2", "command-0"]
+
+    page = db.get_command_history(CLIENT_NAME, limit=2)
+    next_page = db.get_command_history(CLIENT_NAME, before=page[-1].completed, limit=2)
+    assert page + next_page == history[:4]
+    assert db.get_command_history("not-a-client") == []
@@ -0,0 +1,54 @@
+import pytest
+from db import db
+from fastapi import HTTPException
+from models.models import AuthStateQuery
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+TEST_CMD = "Test Command!"
+TEST_COMMIT = "test-commit"
+OTHER_CLIENTS = [f"{CLIENT_NAME}-{i}" for i in range(3)]
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a few clients, one of which is on the latest commit, then delete them """
+    populate_db()
+    for name in OTHER_CLIENTS:
+        db.add_client(name)
+    db.log_commit_fetch(TEST_COMMIT, datetime.now() - timedelta(minutes=1))
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+    yield
+    reset_db()
+
+def _queue_lengths() -> dict[str, int]:
+    return {name: db.get_next_command(name).queue_length for name in [CLIENT_NAME, *OTHER_CLIENTS]}
+
+def _registry_lookups() -> int:
+    stats = db.client_registry.stats()
+    return stats['hits'] + stats['misses']
+
+def test_broadcast_to_names():
+    """ Ensure that a command is enqueued for exactly the named clients """
+    assert db.enqueue_commands(TEST_CMD, client_names=OTHER_CLIENTS[:2]) == 2
+    assert _queue_lengths() == {CLIENT_NAME: 0, OTHER_CLIENTS[0]: 1, OTHER_CLIENTS[1]: 1, OTHER_CLIENTS[2]: 0}
+    assert db.get_next_command(OTHER_CLIENTS[0]).command == TEST_CMD
+
+def test_broadcast_to_unknown_name():
+    """ Ensure that nothing is enqueued if any named client doesn't exist """
+    with pytest.raises(HTTPException) as e:
+        db.enqueue_commands(TEST_CMD, client_names=[CLIENT_NAME, "not-a-client"])
+    assert e.value.status_code == 404
+    assert sum(_queue_lengths().values()) == 0
+
+def test_broadcast_to_filter():
+    """ Ensure that a command is enqueued for every valid client matching a report filter """
+    assert db.enqueue_commands(TEST_CMD, latest_commit=False) == len(OTHER_CLIENTS)
+    assert _queue_lengths() == {CLIENT_NAME: 0, **{name: 1 for name in OTHER_CLIENTS}}
+
+    db.invalidate_client(OTHER_CLIENTS[0])
+    # Invalid clients are filtered out by the report query, rather than looked up one at a time
+    db.client_registry.invalidate()
+    lookups = _registry_lookups()
+    assert db.enqueue_commands(TEST_CMD, auth_state=AuthStateQuery.ANY) == len(OTHER_CLIENTS)
+    assert _registry_lookups() == lookups
@@ -0,0 +1,118 @@
+import pytest
+from db import db
+from fastapi import HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME, CLIENT_ID
+
+QUEUE_LENGTH = 50
+POLLERS = 8
+
+
+@pytest.fixture(autouse=True, params=[True, False], ids=['returning', 'no-returning'])
+def setup_teardown(request, monkeypatch):
+    """ Test setup/teardown: Create a client with a queue of commands, then delete that client.
+    Each test runs both with and without UPDATE ... RETURNING, which SQLite before 3.35 lacks """
+    monkeypatch.setattr(db.engine.dialect, 'update_returning', request.param)
+    populate_db()
+    now = datetime.now()
+    for i in range(QUEUE_LENGTH):
+        db.enqueue_command(CLIENT_NAME, f"command-{i}", 1, now + timedelta(seconds=i))
+    yield
+    reset_db()
+
+def _completed_commands() -> list[db.DbCommandQueueEntry]:
+    with db.DbSession() as session:
+        return session.scalars(db.select(db.DbCommandQueueEntry)
+            .where(db.DbCommandQueueEntry.client_id == CLIENT_ID)
+            .where(db.DbCommandQueueEntry.completed != None)).all()
+
+def _poll_until_empty(get_next_command, dequeue_command) -> int:
+    """ Claim and complete commands until the queue is empty, returning the number completed """
+    completed = 0
+    while get_next_command(CLIENT_NAME).command is not None:
+        try:
+            dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+            completed += 1
+        except HTTPException as e:
+            # Another poller completed the claimed command first, and the new head is unread
+            assert e.status_code == 400
+    return completed
+
+def _check_queue_drained(completions: int):
+    assert completions == QUEUE_LENGTH
+    commands = _completed_commands()
+    assert len(commands) == QUEUE_LENGTH
+    for command in commands:
+        assert command.status == db.DbCommandStatus.SUCCESSFUL
+        assert command.acknowledged is not None
+
+def test_concurrent_polls():
+    """ Ensure that concurrent polls through the writer complete each command exactly once """
+    with ThreadPoolExecutor(POLLERS) as pool:
+        futures = [pool.submit(_poll_until_empty, db.get_next_command, db.dequeue_command) for _ in range(POLLERS)]
+    _check_queue_drained(sum(future.result() for future in futures))
+
+def test_concurrent_polls_across_connections():
+    """ Ensure that polls made on separate connections, as from separate server processes,
+    neither race on the head nor fail to upgrade a read transaction to a write """
+    def _in_session(func):
+        def _call(*args):
+            with db.DbSession() as session:
+                result = func(session, *args)
+                session.commit()
+                return result
+        return _call
+
+    get_next_command = _in_session(db.get_next_command.__wrapped__)
+    dequeue_command = _in_session(db.dequeue_command.__wrapped__)
+    with ThreadPoolExecutor(POLLERS) as pool:
+        futures = [pool.submit(_poll_until_empty, get_next_command, dequeue_command) for _ in range(POLLERS)]
+    _check_queue_drained(sum(future.result() for future in futures))
+
+def test_sequential_claims():
+    """ Ensure that each command is handed out in turn, with its id and the queue length """
+    for i in range(QUEUE_LENGTH):
+        command = db.get_next_command(CLIENT_NAME)
+        assert command.queue_length == QUEUE_LENGTH - i
+        assert command.command == f"command-{i}"
+        assert command.id is not None
+        # The id is that of the claimed command, so it can be completed by id
+        assert db.get_next_commands(CLIENT_NAME, 1).commands[0].id == command.id
+        assert db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL).queue_length == QUEUE_LENGTH - i - 1
+    assert db.get_next_command(CLIENT_NAME).queue_length == 0
+    with pytest.raises(HTTPException):
+        db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+
+def test_batch_claim():
+    """ Ensure that a batch claim hands out commands from the head of the queue in order,
+    and that claiming again hands out the same commands until they're completed """
+    batch = db.get_next_commands(CLIENT_NAME, 10)
+    assert batch.queue_length == QUEUE_LENGTH
+    assert [command.command for command in batch.commands] == [f"command-{i}" for i in range(10)]
+    assert db.get_next_commands(CLIENT_NAME, 10) == batch
+    # The single command API hands out the same head, with its id
+    assert db.get_next_command(CLIENT_NAME).id == batch.commands[0].id
+
+    completions = [(command.id, db.DbCommandStatus.SUCCESSFUL) for command in batch.commands]
+    assert db.dequeue_commands(CLIENT_NAME, completions).queue_length == QUEUE_LENGTH - 10
+    assert db.get_next_commands(CLIENT_NAME, 1).commands[0].command == "command-10"
+
+def test_batch_completion_is_all_or_nothing():
+    """ Ensure that a batch completion including an unclaimed command completes nothing """
+    claimed = db.get_next_commands(CLIENT_NAME, 2).commands
+    unclaimed = db.get_next_commands(CLIENT_NAME, 3).commands[2]
+    completions = [(command.id, db.DbCommandStatus.SUCCESSFUL) for command in claimed[:1]]
+
+    with pytest.raises(HTTPException) as e:
+        db.dequeue_commands(CLIENT_NAME, completions + [("not-a-command", db.DbCommandStatus.FAILED)])
+    assert e.value.status_code == 400
+    with pytest.raises(HTTPException):
+        db.dequeue_commands(CLIENT_NAME, completions + completions)
+    assert _completed_commands() == []
+
+    # Commands can be completed out of order once they've been handed out
+    completions = [(unclaimed.id, db.DbCommandStatus.FAILED), (claimed[1].id, db.DbCommandStatus.SUCCESSFUL)]
+    assert db.dequeue_commands(CLIENT_NAME, completions).queue_length == QUEUE_LENGTH - 2
+    assert {command.id: command.status for command in _completed_commands()} == {
+        unclaimed.id: db.DbCommandStatus.FAILED, claimed[1].id: db.DbCommandStatus.SUCCESSFUL}
@@ -0,0 +1,90 @@
+import pytest
+from db import db
+from db.migrations import migrate
+from sqlalchemy import create_engine
+from tempfile import mkdtemp
+from datetime import timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+TEST_CMD = "Test Command!"
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown(monkeypatch):
+    """ Test setup/teardown: Create a client with a command whose lease expires as soon as it's
+    handed out, then delete that client """
+    populate_db()
+    monkeypatch.setattr(db, 'COMMAND_LEASE', timedelta(seconds=-1))
+    monkeypatch.setattr(db, 'COMMAND_MAX_ATTEMPTS', 2)
+    db.enqueue_command(CLIENT_NAME, TEST_CMD)
+    yield
+    reset_db()
+
+def _command() -> db.DbCommandQueueEntry:
+    with db.DbSession() as session:
+        return session.scalars(db.select(db.DbCommandQueueEntry)).one()
+
+def test_expired_lease_is_requeued():
+    """ Ensure that a command whose lease expires is handed out again """
+    claimed = db.get_next_command(CLIENT_NAME)
+    assert db.expire_command_leases() == {'requeued': 1, 'failed': 0}
+
+    command = _command()
+    assert (command.status, command.acknowledged, command.lease_expires, command.attempts) == (db.DbCommandStatus.PENDING, None, None, 1)
+    # The abandoned claim can no longer be completed
+    with pytest.raises(db.HTTPException):
+        db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+
+    reclaimed = db.get_next_command(CLIENT_NAME)
+    assert (reclaimed.id, reclaimed.queue_length) == (claimed.id, 1)
+    assert _command().attempts == 2
+
+def test_expired_lease_fails_after_max_attempts():
+    """ Ensure that a command is failed once its lease expires on the last attempt """
+    for _ in range(2):
+        db.get_next_command(CLIENT_NAME)
+        db.expire_command_leases()
+
+    command = _command()
+    assert (command.status, command.attempts) == (db.DbCommandStatus.FAILED, 2)
+    assert command.completed is not None
+    assert db.get_next_command(CLIENT_NAME).queue_length == 0
+    assert db.get_command_history(CLIENT_NAME)[0].attempts == 2
+
+def test_unexpired_lease_is_kept(monkeypatch):
+    """ Ensure that a command is left alone while its lease is current, and that re-reading the
+    head renews the lease without counting another attempt """
+    monkeypatch.setattr(db, 'COMMAND_LEASE', timedelta(hours=1))
+    db.get_next_command(CLIENT_NAME)
+    first_lease = _command().lease_expires
+    db.get_next_command(CLIENT_NAME)
+    assert db.expire_command_leases() == {'requeued': 0, 'failed': 0}
+
+    command = _command()
+    assert (command.status, command.attempts) == (db.DbCommandStatus.IN_PROGRESS, 1)
+    assert command.lease_expires > first_lease
+
+def test_expire_without_returning(monkeypatch):
+    """ Ensure that leases are expired correctly when UPDATE ... RETURNING isn't available """
+    monkeypatch.setattr(db.engine.dialect, 'update_returning', False)
+    db.enqueue_command(CLIENT_NAME, TEST_CMD)
+    for _ in range(2):
+        db.get_next_commands(CLIENT_NAME, 1)
+    db.expire_command_leases()
+    db.get_next_commands(CLIENT_NAME, 2)
+    assert db.expire_command_leases() == {'requeued': 1, 'failed': 1}
+    assert db.get_next_command(CLIENT_NAME).queue_length == 1
+
+def test_migrate_leases_in_progress_commands():
+    """ Ensure that commands in progress before leases were added are given one """
+    engine = create_engine(f"sqlite:///{mkdtemp()}/db.sqlite")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE client_command_queue (id VARCHAR PRIMARY KEY, client_id VARCHAR, "
+                             "command VARCHAR, priority INTEGER, created DATETIME, status VARCHAR, acknowledged DATETIME, completed DATETIME)")
+        conn.exec_driver_sql("INSERT INTO client_command_queue (id, command, acknowledged) VALUES "
+                             "('a', 'a', '2024-01-01 00:00:00'), ('b', 'b', NULL)")
+
+    migrate(engine)
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql("SELECT id, lease_expires IS NOT NULL, attempts FROM client_command_queue ORDER BY id").all()
+    assert [tuple(row) for row in rows] == [('a', 1, 1), ('b', 0, 0)]
@@ -0,0 +1,92 @@
+import pytest
+import asyncio
+import time
+from db import db, async_db
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+TEST_CMD = "Test Command!"
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, then delete that client """
+    populate_db()
+    yield
+    reset_db()
+
+async def _enqueue_later(delay: float):
+    """ Enqueue a command from another thread after a delay, as a request handler would """
+    await asyncio.sleep(delay)
+    await asyncio.get_running_loop().run_in_executor(None, db.enqueue_command, CLIENT_NAME, TEST_CMD)
+
+def test_long_poll_wakes_on_enqueue():
+    """ Ensure that a long-poll returns as soon as a command is enqueued """
+    async def _poll():
+        enqueue = asyncio.create_task(_enqueue_later(0.2))
+        start = time.monotonic()
+        response = await async_db.wait_for_command(CLIENT_NAME, 10)
+        await enqueue
+        return response, time.monotonic() - start
+
+    response, elapsed = asyncio.run(_poll())
+    assert response.command == TEST_CMD
+    assert response.queue_length == 1
+    assert elapsed < 5
+    assert db.command_notifier.stats()['waiters'] == 0
+
+def test_long_poll_timeout():
+    """ Ensure that a long-poll of an empty queue returns an empty response after the wait """
+    start = time.monotonic()
+    response = asyncio.run(async_db.wait_for_command(CLIENT_NAME, 0.2))
+    assert time.monotonic() - start >= 0.2
+    assert response.command is None
+    assert response.queue_length == 0
+
+def test_long_poll_sees_out_of_process_enqueue():
+    """ Ensure that a command enqueued during the wait without a notification, as by another
+    process, is returned once the wait times out """
+    def _enqueue_unnotified():
+        with db.DbSession() as session:
+            db.enqueue_command.__wrapped__(session, CLIENT_NAME, TEST_CMD)
+            # Committed outside the writer, so no notification is sent
+            session.commit()
+
+    async def _poll():
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, loop.run_in_executor, None, _enqueue_unnotified)
+        return await async_db.wait_for_command(CLIENT_NAME, 0.5)
+
+    assert asyncio.run(_poll()).command == TEST_CMD
+
+def test_stream():
+    """ Ensure that a stream sends the queue state when it changes, and keepalives otherwise """
+    async def _stream():
+        events = []
+        enqueue = asyncio.create_task(_enqueue_later(0.2))
+        async for response in async_db.stream_commands(CLIENT_NAME, keepalive=1):
+            events.append(response)
+            if response is not None and response.command == TEST_CMD:
+                await asyncio.to_thread(db.dequeue_command, CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+            if len(events) == 4:
+                break
+        await enqueue
+        return events
+
+    events = asyncio.run(_stream())
+    assert [(e.queue_length, e.command) if e else None for e in events] == [(0, None), (1, TEST_CMD), (0, None), None]
+
+def test_idle_stream_does_not_write(monkeypatch):
+    """ Ensure that keepalives on an idle stream don't reread the queue, which would be a write """
+    writes = []
+    submit = db.writer.submit
+    monkeypatch.setattr(db.writer, 'submit', lambda *args, **kwargs: writes.append(args) or submit(*args, **kwargs))
+
+    async def _stream():
+        events = []
+        async for response in async_db.stream_commands(CLIENT_NAME, keepalive=0.05):
+            events.append(response)
+            if len(events) == 5:
+                return events
+
+    assert asyncio.run(_stream())[1:] == [None] * 4
+    assert len(writes) == 1
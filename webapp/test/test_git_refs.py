@@ -0,0 +1,69 @@
+import pytest
+import subprocess
+from pathlib import Path
+from util.git_refs import GitRefResolver
+
+
+def _git(repo: Path, *args) -> str:
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+                          cwd=repo, check=True, capture_output=True, text=True).stdout.strip()
+
+def _commit(repo: Path) -> str:
+    _git(repo, 'commit', '--allow-empty', '-m', 'commit')
+    return _git(repo, 'rev-parse', 'HEAD')
+
+@pytest.fixture
+def repo(tmp_path) -> Path:
+    """ A git repo with a single commit on main """
+    _git(tmp_path, 'init', '--initial-branch=main')
+    _commit(tmp_path)
+    return tmp_path
+
+def test_loose_refs(repo):
+    """ Ensure that HEAD resolves through a loose branch ref, and picks up new commits """
+    refs = GitRefResolver(repo / '.git')
+    assert refs.resolve() == _git(repo, 'rev-parse', 'HEAD')
+    assert refs.current_branch() == 'main'
+
+    head = _commit(repo)
+    assert refs.resolve() == head
+
+def test_packed_refs(repo):
+    """ Ensure that refs are found once git gc has packed them, and that a loose ref written
+    after packing takes precedence """
+    refs = GitRefResolver(repo / '.git')
+    head = refs.resolve()
+    _git(repo, 'tag', '-a', 'v1', '-m', 'annotated')
+    _git(repo, 'pack-refs', '--all')
+    assert not (repo / '.git' / 'refs' / 'heads' / 'main').exists()
+    assert refs.resolve() == head
+    assert refs.resolve('refs/tags/v1') == _git(repo, 'rev-parse', 'refs/tags/v1')
+
+    new_head = _commit(repo)
+    assert refs.resolve() == new_head
+
+def test_detached_head(repo):
+    """ Ensure that a detached HEAD resolves to its commit """
+    refs = GitRefResolver(repo / '.git')
+    head = refs.resolve()
+    _commit(repo)
+    _git(repo, 'checkout', '--detach', head)
+    assert refs.resolve() == head
+    assert refs.current_branch() is None
+
+def test_missing_ref(repo):
+    """ Ensure that an unknown ref or missing repository is an error """
+    with pytest.raises(RuntimeError):
+        GitRefResolver(repo / '.git').resolve('refs/heads/not-a-branch')
+    with pytest.raises(RuntimeError):
+        GitRefResolver(repo / 'not-a-repo').resolve()
+
+def test_cache(repo):
+    """ Ensure that an unchanged ref is read from the cache """
+    refs = GitRefResolver(repo / '.git')
+    refs.resolve()
+    misses = refs.stats()['misses']
+    for _ in range(10):
+        refs.resolve()
+    assert refs.stats()['misses'] == misses
+    assert refs.stats()['hits'] >= 20
@@ -0,0 +1,90 @@
+import re
+import pytest
+from db import db
+from sqlalchemy import event
+from models.models import AuthStateQuery
+from db.retention import prune_history, archive_commands
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+TEST_COMMIT = "test-commit"
+
+# A query plan step that reads every row of a table rather than searching an index
+FULL_SCAN_RE = re.compile(r'^SCAN (\w+)$')
+
+# Tables that may be scanned in full: The client status report returns one row per client
+ALLOWED_SCANS = {'client'}
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, then delete that client """
+    populate_db()
+    yield
+    reset_db()
+
+def _run_workload():
+    """ Call each function in db.py that's on a request or sync path """
+    db.log_commit_fetch(TEST_COMMIT, datetime.now())
+    db.log_commit_fetch("other-repo-commit", datetime.now(), "other-repo")
+    db.log_repo_sync(db.DEFAULT_REPO, datetime.now(), False, TEST_COMMIT, {'ls_remote': 0.1})
+
+    challenge = db.create_auth_session(CLIENT_NAME)
+    db.activate_auth_session(CLIENT_NAME, challenge.challenge_secret, datetime.now() + timedelta(hours=2))
+    challenge = db.create_auth_session(CLIENT_NAME)
+    db.fail_auth_session(CLIENT_NAME, challenge.challenge_secret)
+
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+    db.log_client_repo_access(CLIENT_NAME, TEST_COMMIT)
+
+    db.enqueue_command(CLIENT_NAME, "Test Command!")
+    db.enqueue_commands("Test Command!", client_names=[CLIENT_NAME])
+    db.enqueue_commands("Test Command!", latest_commit=False)
+    db.get_next_command(CLIENT_NAME)
+    db.check_in(CLIENT_NAME, TEST_COMMIT)
+    db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+    batch = db.get_next_commands(CLIENT_NAME, 10)
+    db.dequeue_commands(CLIENT_NAME, [(command.id, db.DbCommandStatus.SUCCESSFUL) for command in batch.commands])
+
+    for report_time in (None, datetime.now()):
+        for auth_state in AuthStateQuery:
+            for latest_commit in (None, True, False):
+                db.get_client_status_report(report_time, auth_state, latest_commit)
+                db.get_client_status_report(report_time, auth_state, latest_commit, after=CLIENT_NAME, limit=10)
+                db.get_client_status_summary(report_time, auth_state, latest_commit)
+
+    prune_history()
+    archive_commands(timedelta(0))
+    db.get_command_history()
+    db.get_command_history(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL, datetime.now())
+    db.expire_command_leases()
+    db.refresh_queue_metrics()
+
+def _capture_statements() -> list[tuple[str, tuple]]:
+    """ Run the workload, returning each distinct statement it sent to the database """
+    statements = {}
+    def _capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            statements.setdefault(statement, parameters)
+
+    event.listen(db.engine, "before_cursor_execute", _capture)
+    try:
+        _run_workload()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _capture)
+    return list(statements.items())
+
+def test_no_full_table_scans():
+    """ Ensure that no query issued by db.py falls back to a full table scan """
+    statements = _capture_statements()
+    assert statements
+
+    full_scans = []
+    with db.engine.connect() as conn:
+        for statement, parameters in statements:
+            for step in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters):
+                scan = FULL_SCAN_RE.match(step.detail)
+                if scan and scan[1] not in ALLOWED_SCANS:
+                    full_scans.append((statement, step.detail))
+
+    assert full_scans == []
@@ -0,0 +1,64 @@
+import pytest
+from db import db
+from db.command_queue import check_queue_lengths, repair_queue_lengths
+from db.migrations import migrate
+from sqlalchemy import create_engine, text
+from tempfile import mkdtemp
+from .test_util import populate_db, reset_db, CLIENT_NAME, CLIENT_ID
+
+TEST_CMD = "Test Command!"
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client, then delete that client """
+    populate_db()
+    yield
+    reset_db()
+
+def _stored_queue_length() -> int:
+    with db.DbSession() as session:
+        return session.get(db.DbClient, CLIENT_ID).queue_length
+
+def test_queue_length_counter():
+    """ Ensure that the counter follows enqueues, broadcasts and completions """
+    db.enqueue_command(CLIENT_NAME, TEST_CMD)
+    db.enqueue_commands(TEST_CMD, client_names=[CLIENT_NAME])
+    assert _stored_queue_length() == 2
+    assert db.get_next_command(CLIENT_NAME).queue_length == 2
+
+    assert db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL).queue_length == 1
+    assert _stored_queue_length() == 1
+
+    # A rejected completion leaves the counter alone
+    with pytest.raises(Exception):
+        db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+    assert _stored_queue_length() == 1
+
+    with db.DbSession() as session:
+        assert check_queue_lengths(session) == []
+
+def test_repair_queue_lengths():
+    """ Ensure that a drifted counter is found and recomputed from the queue """
+    db.enqueue_command(CLIENT_NAME, TEST_CMD)
+    with db.DbSession() as session:
+        session.execute(text("UPDATE client SET queue_length = 5"))
+        assert check_queue_lengths(session) == [(CLIENT_NAME, 5, 1)]
+        assert repair_queue_lengths(session) == 1
+        session.commit()
+        assert check_queue_lengths(session) == []
+    assert _stored_queue_length() == 1
+
+def test_migrate_adds_queue_length():
+    """ Ensure that migrating a database from before the counter adds and populates it """
+    engine = create_engine(f"sqlite:///{mkdtemp()}/db.sqlite")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE client (id VARCHAR PRIMARY KEY, name VARCHAR UNIQUE NOT NULL, valid BOOLEAN)")
+        conn.exec_driver_sql("CREATE TABLE client_command_queue (id VARCHAR PRIMARY KEY, client_id VARCHAR REFERENCES client(id), "
+                             "command VARCHAR, priority INTEGER, created DATETIME, status VARCHAR, acknowledged DATETIME, completed DATETIME)")
+        conn.exec_driver_sql("INSERT INTO client VALUES ('client-id', 'client', 1)")
+        conn.exec_driver_sql("INSERT INTO client_command_queue (id, client_id, command) VALUES ('a', 'client-id', 'a'), ('b', 'client-id', 'b')")
+
+    migrate(engine)
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT queue_length FROM client").scalar() == 2
@@ -0,0 +1,65 @@
+import pytest
+import asyncio
+from db import db, async_db
+from db.retention import archive_commands
+from db.queue_metrics import compute_queue_metrics, _percentiles
+from datetime import datetime, timedelta
+from .test_util import populate_db, reset_db, CLIENT_NAME
+
+COMMAND_COUNT = 5
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client with a few commands in each state, then delete that client """
+    populate_db()
+    for i in range(COMMAND_COUNT):
+        db.enqueue_command(CLIENT_NAME, f"command-{i}", 1, datetime.now() - timedelta(seconds=COMMAND_COUNT - i))
+    # Complete two commands and claim a third
+    for _ in range(2):
+        db.get_next_command(CLIENT_NAME)
+        db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+    db.get_next_command(CLIENT_NAME)
+    yield
+    reset_db()
+
+def _metrics(window: timedelta = timedelta(hours=1)):
+    with db.DbSession() as session:
+        return compute_queue_metrics(session, window)
+
+def test_percentiles():
+    """ Ensure that percentiles use the nearest rank """
+    result = _percentiles([float(i) for i in range(100, 0, -1)])
+    assert (result.count, result.p50, result.p95, result.p99) == (100, 50, 95, 99)
+    assert _percentiles([]).p50 is None
+
+def test_queue_metrics():
+    """ Ensure that depth, age and latency reflect the state of the queue """
+    metrics = _metrics()
+    assert (metrics.depth, metrics.pending, metrics.in_progress) == (COMMAND_COUNT - 2, COMMAND_COUNT - 3, 1)
+    assert metrics.oldest_pending_age >= 2
+    assert [(c.client_name, c.depth) for c in metrics.clients] == [(CLIENT_NAME, COMMAND_COUNT - 2)]
+    assert metrics.ack_latency.count == 3
+    assert metrics.completion_latency.count == 2
+    assert metrics.completion_latency.p99 >= 0
+
+    # Archived commands are still counted
+    archive_commands(timedelta(0))
+    archived = _metrics()
+    assert archived.ack_latency.count == 3
+    assert archived.completion_latency.count == 2
+
+    # Commands handled before the window aren't
+    assert _metrics(timedelta(0)).completion_latency.count == 0
+
+def test_queue_metrics_cache():
+    """ Ensure that the snapshot is only recomputed when refreshed """
+    db.queue_metrics._metrics = None
+    first = asyncio.run(async_db.get_queue_metrics())
+    assert first.depth == COMMAND_COUNT - 2
+
+    db.dequeue_command(CLIENT_NAME, db.DbCommandStatus.SUCCESSFUL)
+    assert asyncio.run(async_db.get_queue_metrics()) is first
+
+    db.refresh_queue_metrics()
+    assert asyncio.run(async_db.get_queue_metrics()).depth == COMMAND_COUNT - 3
@@ -0,0 +1,91 @@
+import pytest
+import asyncio
+from fastapi.testclient import TestClient
+from models.models import RepoListing
+from util import git_utils
+from util.repo_status_cache import RepoStatusCache, etag_matches
+
+TEST_COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+
+class _Repo:
+    """ Stands in for the repo on disk, counting how often it's read """
+    def __init__(self):
+        self.commit_hash = TEST_COMMIT
+        self.loads = 0
+        # Whether each load ran on the event loop
+        self.loaded_on_loop = []
+
+    def load(self) -> RepoListing:
+        self.loads += 1
+        try:
+            asyncio.get_running_loop()
+            self.loaded_on_loop.append(True)
+        except RuntimeError:
+            self.loaded_on_loop.append(False)
+        return RepoListing(name="test-repo", upstream="git@example.com:test/test-repo.git", commit_hash=self.commit_hash)
+
+@pytest.fixture
+def repo(monkeypatch) -> _Repo:
+    repo = _Repo()
+    monkeypatch.setattr(git_utils.get_repo(), 'status_cache', RepoStatusCache(repo.load))
+    return repo
+
+def test_etag_matches():
+    """ Ensure that If-None-Match lists, weak tags and wildcards are handled """
+    etag = f'"{TEST_COMMIT}"'
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches('*', etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches(None, etag)
+
+def test_cache_invalidation(repo):
+    """ Ensure that the repo is only read again once the cache is invalidated """
+    cache = git_utils.get_repo().status_cache
+    for _ in range(5):
+        listing, etag, _ = cache.get()
+    assert (repo.loads, listing.commit_hash, etag) == (1, TEST_COMMIT, f'"{TEST_COMMIT}"')
+
+    repo.commit_hash = "new-commit"
+    assert cache.get()[0].commit_hash == TEST_COMMIT
+    cache.invalidate()
+    assert cache.get()[0].commit_hash == "new-commit"
+    assert repo.loads == 2
+
+def test_conditional_get(repo):
+    """ Ensure that the endpoint answers a matching If-None-Match with a bodiless 304 """
+    import app as appmod
+    client = TestClient(appmod.app)
+    response = client.get('/public/repo-status')
+    assert response.status_code == 200
+    assert response.json()['commit_hash'] == TEST_COMMIT
+    etag = response.headers['etag']
+
+    not_modified = client.get('/public/repo-status', headers={'If-None-Match': etag})
+    assert (not_modified.status_code, not_modified.content, not_modified.headers['etag']) == (304, b'', etag)
+
+    git_utils.get_repo().status_cache.invalidate()
+    repo.commit_hash = "new-commit"
+    assert client.get('/public/repo-status', headers={'If-None-Match': etag}).status_code == 200
+
+def test_named_repo_status(repo):
+    """ Ensure that each served repo's status is available by name, and that other names aren't found """
+    import app as appmod
+    client = TestClient(appmod.app)
+    response = client.get(f'/public/repo-status/{git_utils.get_repo().name}')
+    assert (response.status_code, response.json()['commit_hash']) == (200, TEST_COMMIT)
+    assert client.get(f'/public/repo-status/{git_utils.get_repo().name}',
+                      headers={'If-None-Match': response.headers['etag']}).status_code == 304
+    assert client.get('/public/repo-status/not-a-repo').status_code == 404
+
+def test_miss_loads_off_event_loop(repo):
+    """ Ensure that a cache miss reads the repo in the threadpool rather than on the event loop,
+    and that a hit doesn't read it at all """
+    import app as appmod
+    client = TestClient(appmod.app)
+    assert client.get('/public/repo-status').status_code == 200
+    assert client.get('/public/repo-status').status_code == 200
+    assert repo.loaded_on_loop == [False]
+    stats = git_utils.get_repo().status_cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
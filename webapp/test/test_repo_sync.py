@@ -0,0 +1,204 @@
+import pytest
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import mkdtemp
+from sqlalchemy import create_engine, inspect
+from db import db
+from db.migrations import migrate
+from util import git_utils
+from .test_util import reset_db
+
+
+def _git(repo: Path, *args) -> str:
+    return subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com', *args],
+                          cwd=repo, check=True, capture_output=True, text=True).stdout.strip()
+
+@contextmanager
+def _local_agent_session(ssh_key_path: str):
+    """ The upstream is a local path, so git doesn't need an agent """
+    yield dict(os.environ)
+
+@pytest.fixture
+def upstream(tmp_path, monkeypatch) -> Path:
+    """ A working copy of a local upstream, with the local clone of the upstream in place as the
+    server's repo. Yields the working copy, for pushing new commits upstream """
+    work = tmp_path / 'work'
+    work.mkdir()
+    _git(work, 'init', '--initial-branch=main')
+    _git(work, 'commit', '--allow-empty', '-m', 'first')
+    _git(tmp_path, 'clone', '--bare', str(work), 'upstream.git')
+    _git(work, 'remote', 'add', 'origin', str(tmp_path / 'upstream.git'))
+    _git(tmp_path, 'clone', str(tmp_path / 'upstream.git'), db.DEFAULT_REPO)
+
+    monkeypatch.setattr(git_utils, 'GIT_PROJECT_ROOT', tmp_path)
+    monkeypatch.setattr(git_utils, 'repos', {db.DEFAULT_REPO: git_utils.UpstreamRepo(git_utils.get_repo().url)})
+    monkeypatch.setattr(git_utils, 'ssh_agent_session', _local_agent_session)
+    yield work
+    reset_db()
+
+def _syncs() -> list[db.DbRepoSync]:
+    with db.DbSession() as session:
+        return session.scalars(db.select(db.DbRepoSync).order_by(db.DbRepoSync.started)).all()
+
+def test_sync_skips_unchanged_upstream(upstream):
+    """ Ensure that a sync with nothing new upstream stops after the ls-remote """
+    git_utils.sync_repo()
+    sync, = _syncs()
+    assert not sync.changed
+    assert sync.commit_hash == git_utils.get_latest_commit_hash()
+    assert sync.ls_remote_seconds is not None and sync.total_seconds >= sync.ls_remote_seconds
+    assert (sync.fetch_seconds, sync.reset_seconds, sync.log_commit_seconds) == (None, None, None)
+
+def test_sync_pulls_new_commit(upstream):
+    """ Ensure that a sync picks up a new upstream commit and logs it """
+    _git(upstream, 'commit', '--allow-empty', '-m', 'second')
+    _git(upstream, 'push', 'origin', 'main')
+    new_head = _git(upstream, 'rev-parse', 'HEAD')
+
+    git_utils.sync_repo()
+    sync, = _syncs()
+    assert sync.changed
+    assert sync.commit_hash == new_head == git_utils.get_latest_commit_hash()
+    assert None not in (sync.fetch_seconds, sync.reset_seconds, sync.log_commit_seconds)
+    with db.DbSession() as session:
+        assert session.get(db.DbGitCommit, (new_head, db.DEFAULT_REPO)) is not None
+
+def test_sync_retries_failed_commit_log(upstream, monkeypatch):
+    """ Ensure that a new commit whose logging failed after the reset is logged by the next sync,
+    even though the upstream no longer differs from HEAD """
+    _git(upstream, 'commit', '--allow-empty', '-m', 'second')
+    _git(upstream, 'push', 'origin', 'main')
+    new_head = _git(upstream, 'rev-parse', 'HEAD')
+
+    log_commit_fetch = git_utils.log_commit_fetch
+    def _fail_once(*args):
+        monkeypatch.setattr(git_utils, 'log_commit_fetch', log_commit_fetch)
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(git_utils, 'log_commit_fetch', _fail_once)
+    assert not git_utils.sync_repo()
+    assert git_utils.get_latest_commit_hash() == new_head
+
+    assert git_utils.sync_repo()
+    sync, = _syncs()
+    assert not sync.changed
+    with db.DbSession() as session:
+        assert session.get(db.DbGitCommit, (new_head, db.DEFAULT_REPO)) is not None
+
+def test_failed_commit_log_invalidates_status(upstream, monkeypatch):
+    """ Ensure that the cached repo status moves with HEAD even if logging the new commit fails """
+    git_utils.sync_repo()
+    repo = git_utils.get_repo()
+    old_head = repo.status_cache.get()[0].commit_hash
+    _git(upstream, 'commit', '--allow-empty', '-m', 'second')
+    _git(upstream, 'push', 'origin', 'main')
+    new_head = _git(upstream, 'rev-parse', 'HEAD')
+
+    def _fail(*args):
+        raise RuntimeError("database is locked")
+    monkeypatch.setattr(git_utils, 'log_commit_fetch', _fail)
+    assert not git_utils.sync_repo()
+    assert new_head != old_head
+    assert repo.status_cache.get()[0].commit_hash == new_head
+
+def test_sync_repos_waits_for_running(upstream, monkeypatch):
+    """ Ensure that a repo already being synced is skipped, unless waiting for running syncs """
+    synced = []
+    monkeypatch.setattr(git_utils, '_sync_repo', lambda repo: synced.append(repo.name))
+    repo = git_utils.get_repo()
+
+    repo.sync_lock.acquire()
+    git_utils.sync_repos()
+    assert synced == []
+    # The running sync finishes while the second waits for it
+    threading.Timer(0.2, repo.sync_lock.release).start()
+    git_utils.sync_repos(wait_for_running=True)
+    assert synced == [db.DEFAULT_REPO]
+
+@pytest.fixture
+def other_repo(upstream, tmp_path, monkeypatch) -> git_utils.UpstreamRepo:
+    """ A second repo, cloned from the same upstream """
+    _git(tmp_path, 'clone', str(tmp_path / 'upstream.git'), 'other-repo')
+    repo = git_utils.UpstreamRepo('git@example.com:test/other-repo.git')
+    monkeypatch.setitem(git_utils.repos, repo.name, repo)
+    return repo
+
+def test_sync_repos(upstream, other_repo):
+    """ Ensure that each repo is synced, and its syncs and commits are recorded under its name """
+    _git(upstream, 'commit', '--allow-empty', '-m', 'second')
+    _git(upstream, 'push', 'origin', 'main')
+    new_head = _git(upstream, 'rev-parse', 'HEAD')
+
+    git_utils.sync_repos()
+    assert sorted((sync.repo, sync.changed) for sync in _syncs()) == sorted([(db.DEFAULT_REPO, True), ('other-repo', True)])
+    assert git_utils.get_latest_commit_hash(other_repo) == new_head == git_utils.get_latest_commit_hash()
+    # The repos share the commit, and it's recorded under each of them
+    with db.DbSession() as session:
+        assert sorted(session.scalars(db.select(db.DbGitCommit.repo).where(db.DbGitCommit.commit_hash == new_head))) \
+            == sorted([db.DEFAULT_REPO, 'other-repo'])
+    assert git_utils.get_repo_status(other_repo).name == 'other-repo'
+
+def test_repos_sync_in_parallel(upstream, other_repo, monkeypatch):
+    """ Ensure that different repos sync at the same time, on separate workers """
+    running, overlaps = set(), []
+    lock = threading.Lock()
+    def _sync(repo):
+        with lock:
+            overlaps.append(len(running))
+            running.add(repo.name)
+        time.sleep(0.1)
+        with lock:
+            running.discard(repo.name)
+    monkeypatch.setattr(git_utils, '_sync_repo', _sync)
+
+    git_utils.sync_repos()
+    assert sorted(overlaps) == [0, 1]
+
+def test_failed_sync_backs_off(upstream, monkeypatch):
+    """ Ensure that a repo whose sync fails is skipped until its backoff passes, and that the
+    backoff doubles with each consecutive failure """
+    attempts = []
+    def _fail(repo):
+        attempts.append(repo.name)
+        raise subprocess.CalledProcessError(128, 'git fetch')
+    monkeypatch.setattr(git_utils, '_sync_repo', _fail)
+    monkeypatch.setattr(git_utils, 'SYNC_BACKOFF_SECONDS', 0.2)
+    repo = git_utils.get_repo()
+
+    git_utils.sync_repos()
+    git_utils.sync_repos()
+    assert attempts == [db.DEFAULT_REPO]
+    assert repo.backing_off()
+
+    time.sleep(0.3)
+    git_utils.sync_repos()
+    assert len(attempts) == 2
+    assert repo.retry_after - time.monotonic() > 0.3
+
+    monkeypatch.setattr(git_utils, '_sync_repo', lambda repo: None)
+    assert git_utils.sync_repo(repo)
+    assert (repo.failures, repo.backing_off()) == (0, False)
+
+def test_migrate_commit_keys():
+    """ Ensure that commits recorded when they were keyed by hash alone are rekeyed by repo, so
+    that another repo can record the same commit """
+    engine = create_engine(f"sqlite:///{mkdtemp()}/db.sqlite")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE repo_commits (commit_hash VARCHAR PRIMARY KEY, commit_time DATETIME, sync_time DATETIME)")
+        conn.exec_driver_sql("CREATE INDEX ix_repo_commits_commit_time ON repo_commits (commit_time)")
+        conn.exec_driver_sql("CREATE TABLE client_commit_access (id VARCHAR PRIMARY KEY, client_id VARCHAR, "
+                             "commit_hash VARCHAR REFERENCES repo_commits (commit_hash), access_time DATETIME)")
+        conn.exec_driver_sql("INSERT INTO repo_commits (commit_hash, commit_time) VALUES ('a', '2024-01-01 00:00:00')")
+        conn.exec_driver_sql("INSERT INTO client_commit_access (id, client_id, commit_hash) VALUES ('x', 'c', 'a')")
+
+    migrate(engine)
+    inspector = inspect(engine)
+    assert sorted(inspector.get_pk_constraint('repo_commits')['constrained_columns']) == ['commit_hash', 'repo']
+    assert ['commit_hash', 'repo'] in [sorted(fk['constrained_columns']) for fk in inspector.get_foreign_keys('client_commit_access')]
+    with engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO repo_commits (commit_hash, repo) VALUES ('a', 'other-repo')")
+        assert conn.exec_driver_sql("SELECT repo FROM repo_commits ORDER BY repo").scalars().all() == sorted([db.DEFAULT_REPO, 'other-repo'])
+        assert conn.exec_driver_sql("SELECT repo FROM client_commit_access").scalar() == db.DEFAULT_REPO
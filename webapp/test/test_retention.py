@@ -0,0 +1,105 @@
+import pytest
+from db import db
+from db import retention
+from db.retention import prune_history
+from db.migrations import migrate, enable_incremental_vacuum
+from db.client_state_report import check_latest_states, rebuild_latest_states
+from datetime import datetime, timedelta
+from sqlalchemy import create_engine
+from tempfile import mkdtemp
+from .test_util import populate_db, reset_db, CLIENT_ID
+
+HISTORY_LENGTH = 10
+
+
+@pytest.fixture(autouse=True)
+def setup_teardown():
+    """ Test setup/teardown: Create a client with a history of auth sessions and repo accesses,
+    one per day, then delete that client """
+    populate_db()
+    now = datetime.now()
+    with db.DbSession() as session:
+        for i in range(HISTORY_LENGTH):
+            auth_event = db.DbClientAuthEvent(CLIENT_ID)
+            auth_event.activate(now - timedelta(days=i) + timedelta(hours=2))
+            auth_event.initiated = now - timedelta(days=i)
+            session.add(auth_event)
+            session.add(db.DbClientCommitAccess(CLIENT_ID, f"commit-{i}", now - timedelta(days=i), db.DEFAULT_REPO))
+            session.add(db.DbRepoSync(db.DEFAULT_REPO, now - timedelta(days=i), False, f"commit-{i}", {'ls_remote': 0.1}))
+        # A handshake that was abandoned before it completed
+        abandoned = db.DbClientAuthEvent(CLIENT_ID)
+        abandoned.initiated = now - timedelta(days=HISTORY_LENGTH)
+        session.add(abandoned)
+        session.add(db.DbClientAuthChallenge(abandoned.id, "id-secret", "challenge-secret"))
+        session.commit()
+        rebuild_latest_states(session)
+        session.commit()
+    yield
+    reset_db()
+
+def _count(table) -> int:
+    with db.DbSession() as session:
+        return session.scalar(db.select(db.func.count()).select_from(table))
+
+def test_prune_history():
+    """ Ensure that history older than the retention window is removed in batches, and that the
+    client's current state is unaffected """
+    report = prune_history(timedelta(days=3, hours=12), batch_size=2)
+
+    assert report['client_auth_challenges'] == 1
+    assert report['client_auth_sessions'] == HISTORY_LENGTH - 4 + 1
+    assert report['client_commit_access'] == HISTORY_LENGTH - 4
+    assert report['repo_syncs'] == HISTORY_LENGTH - 4
+    assert _count(db.DbClientAuthChallenge) == 0
+    assert _count(db.DbClientAuthEvent) == 4
+    assert _count(db.DbClientCommitAccess) == 4
+
+    with db.DbSession() as session:
+        assert check_latest_states(session) == []
+
+def test_prune_keeps_latest():
+    """ Ensure that the latest entry of each client is kept even if it's older than the retention window """
+    prune_history(timedelta(0))
+    assert _count(db.DbClientAuthEvent) == 1
+    assert _count(db.DbClientCommitAccess) == 1
+    assert _count(db.DbRepoSync) == 1
+
+def test_prune_keeps_latest_per_repo():
+    """ Ensure that a client's latest access of each repo is kept, not only its latest access overall """
+    with db.DbSession() as session:
+        session.add(db.DbClientCommitAccess(CLIENT_ID, "other-commit", datetime.now() - timedelta(days=HISTORY_LENGTH), "other-repo"))
+        session.commit()
+
+    prune_history(timedelta(0))
+    with db.DbSession() as session:
+        assert sorted(session.scalars(db.select(db.DbClientCommitAccess.repo))) == sorted([db.DEFAULT_REPO, "other-repo"])
+        assert check_latest_states(session) == []
+
+def _pragma(engine, pragma: str) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(f"PRAGMA {pragma}").scalar()
+
+def test_prune_vacuums(monkeypatch):
+    """ Ensure that the pages freed by pruning are returned to the filesystem in batches """
+    monkeypatch.setattr(retention, 'VACUUM_BATCH_PAGES', 10)
+    with db.DbSession() as session:
+        for i in range(200):
+            session.add(db.DbClientCommitAccess(CLIENT_ID, f"old-commit-{i}" + "x" * 1000, datetime.now() - timedelta(days=HISTORY_LENGTH + i), db.DEFAULT_REPO))
+        session.commit()
+
+    assert _pragma(db.engine, "auto_vacuum") == 2 # INCREMENTAL
+    report = prune_history(timedelta(0))
+    assert report['vacuumed_pages'] > 10
+    assert _pragma(db.engine, "freelist_count") == 0
+
+def test_migrate_leaves_vacuum_to_command():
+    """ Ensure that migrating an existing database doesn't rewrite it to enable incremental vacuum,
+    leaving that to the one-time command """
+    engine = create_engine(f"sqlite:///{mkdtemp()}/db.sqlite")
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE client (id VARCHAR PRIMARY KEY, name VARCHAR UNIQUE NOT NULL, valid BOOLEAN)")
+
+    migrate(engine)
+    assert _pragma(engine, "auto_vacuum") == 0
+    enable_incremental_vacuum(engine)
+    assert _pragma(engine, "auto_vacuum") == 2
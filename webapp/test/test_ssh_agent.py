@@ -0,0 +1,72 @@
+import pytest
+import os
+import signal
+import subprocess
+import time
+from util.ssh_agent import SshAgent
+
+
+@pytest.fixture
+def agent(tmp_path) -> SshAgent:
+    """ An agent holding a freshly generated key, stopped at the end of the test """
+    key = tmp_path / 'id_ed25519'
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', str(key)], check=True)
+    agent = SshAgent(str(key), tmp_path / 'control', '1m')
+    agent.start()
+    yield agent
+    agent.stop()
+
+def _listed_keys(env: dict[str, str]) -> int:
+    return len(subprocess.run(['ssh-add', '-l'], env=env, capture_output=True, text=True).stdout.splitlines())
+
+def _wait_for_exit(env: dict[str, str]):
+    """ Wait for the agent to remove its socket as it exits """
+    for _ in range(100):
+        if not os.path.exists(env['SSH_AUTH_SOCK']):
+            return
+        time.sleep(0.01)
+
+def test_agent_env(agent):
+    """ Ensure that the agent holds the key and multiplexes ssh, without touching os.environ """
+    env = agent.env()
+    assert _listed_keys(env) == 1
+    assert 'ControlMaster=auto' in env['GIT_SSH_COMMAND']
+    assert os.environ.get('SSH_AGENT_PID') != env['SSH_AGENT_PID']
+    # The same agent is reused across syncs
+    assert agent.env() is env
+
+def test_agent_restarts(agent):
+    """ Ensure that an agent that has died is restarted on next use """
+    first_env = agent.env()
+    pid = int(first_env['SSH_AGENT_PID'])
+    os.kill(pid, signal.SIGTERM)
+    _wait_for_exit(first_env)
+    env = agent.env()
+    assert int(env['SSH_AGENT_PID']) != pid
+    assert _listed_keys(env) == 1
+
+def test_agent_stop(agent):
+    """ Ensure that stopping the agent kills it """
+    env = agent.env()
+    agent.stop()
+    assert not agent.running
+    _wait_for_exit(env)
+    assert _listed_keys(env) == 0
+
+def test_agent_stop_closes_own_connections(agent, tmp_path, monkeypatch):
+    """ Ensure that stopping an agent only closes the connections under its own control directory,
+    not those of other agents sharing the control directory """
+    other = SshAgent(agent._ssh_key_path, tmp_path / 'control', '1m')
+    other.start()
+    own_socket = agent._control_dir / 'own'
+    other_socket = other._control_dir / 'other'
+    own_socket.touch()
+    other_socket.touch()
+
+    closed = []
+    run = subprocess.run
+    monkeypatch.setattr(subprocess, 'run', lambda args, **kwargs: closed.append(args[2]) if '-O' in args else run(args, **kwargs))
+    agent.stop()
+    monkeypatch.undo()
+    other.stop()
+    assert closed == [f'ControlPath={own_socket}']
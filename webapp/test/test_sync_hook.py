@@ -0,0 +1,132 @@
+import pytest
+import hashlib
+import hmac
+import json
+import time
+import threading
+from apscheduler.schedulers.background import BackgroundScheduler
+from fastapi.testclient import TestClient
+import scheduler
+from util import git_utils
+from util.sync_hook import verify_signature, SIGNATURE_HEADER
+
+SECRET = "test-secret"
+BODY = b'{"ref": "refs/heads/main"}'
+
+
+def _sign(body: bytes, secret: str = SECRET) -> str:
+    return 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+@pytest.fixture
+def syncs(monkeypatch) -> list[tuple[str, float]]:
+    """ Run a scheduler whose syncs only record which repo they synced, if only one, and when they ran """
+    synced = []
+    monkeypatch.setattr(scheduler, 'sync_repos', lambda **kwargs: synced.append((None, time.monotonic())))
+    monkeypatch.setattr(scheduler, 'sync_repo', lambda repo: synced.append((repo.name, time.monotonic())))
+    monkeypatch.setattr(scheduler, 'SYNC_HOOK_DEBOUNCE', scheduler.timedelta(seconds=0.3))
+    monkeypatch.setattr(scheduler, 'SYNC_HOOK_MAX_DELAY', scheduler.timedelta(seconds=1))
+    monkeypatch.setattr(scheduler, 'scheduler', BackgroundScheduler())
+    scheduler.scheduler.start()
+    yield synced
+    scheduler.scheduler.shutdown()
+
+def _wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+def test_verify_signature():
+    """ Ensure that only a signature of the body under the secret is accepted """
+    assert verify_signature(SECRET, BODY, _sign(BODY))
+    assert not verify_signature(SECRET, BODY + b' ', _sign(BODY))
+    assert not verify_signature(SECRET, BODY, _sign(BODY, "other-secret"))
+    assert not verify_signature(SECRET, BODY, _sign(BODY).removeprefix('sha256='))
+    assert not verify_signature(SECRET, BODY, None)
+
+def test_burst_leads_to_one_sync(syncs):
+    """ Ensure that a burst of push notifications is coalesced into a single sync after the burst """
+    for _ in range(5):
+        scheduler.request_sync()
+        time.sleep(0.05)
+    last_request = time.monotonic()
+    assert len(scheduler.scheduler.get_jobs()) == 1
+
+    _wait_for(lambda: syncs)
+    time.sleep(0.5)
+    assert len(syncs) == 1
+    # Allow for the scheduler waking up slightly early
+    assert syncs[0][1] - last_request >= 0.2
+
+def test_steady_requests_sync_by_max_delay(syncs):
+    """ Ensure that requests arriving faster than the debounce period don't push the sync back past
+    the maximum delay from the first of them """
+    first_request = time.monotonic()
+    while not syncs and time.monotonic() - first_request < 3:
+        scheduler.request_sync()
+        time.sleep(0.1)
+    assert syncs
+    assert syncs[0][1] - first_request < 1.2
+
+def test_repos_debounced_separately(syncs):
+    """ Ensure that a push to one repo doesn't push back the pending sync of another """
+    scheduler.request_sync(git_utils.get_repo().name)
+    scheduler.request_sync()
+    scheduler.request_sync(git_utils.get_repo().name)
+    assert len(scheduler.scheduler.get_jobs()) == 2
+
+    _wait_for(lambda: len(syncs) == 2)
+    assert sorted(repo or '' for repo, _ in syncs) == ['', git_utils.get_repo().name]
+
+def test_request_during_sync(syncs, monkeypatch):
+    """ Ensure that a sync requested while the previous one is still running isn't dropped """
+    started = threading.Event()
+    def _slow_sync(repo):
+        started.set()
+        time.sleep(0.5)
+        syncs.append((repo.name, time.monotonic()))
+    monkeypatch.setattr(scheduler, 'sync_repo', _slow_sync)
+
+    scheduler.request_sync(git_utils.get_repo().name)
+    assert started.wait(5)
+    scheduler.request_sync(git_utils.get_repo().name)
+    _wait_for(lambda: len(syncs) == 2)
+    assert len(syncs) == 2
+
+def test_sync_hook_endpoint(syncs, monkeypatch):
+    """ Ensure that the endpoint only schedules a sync for a correctly signed notification """
+    import app as appmod
+    client = TestClient(appmod.app)
+    monkeypatch.setattr(appmod, 'SYNC_HOOK_SECRET', None)
+    assert client.post('/public/sync-hook', content=BODY, headers={SIGNATURE_HEADER: _sign(BODY)}).status_code == 404
+
+    monkeypatch.setattr(appmod, 'SYNC_HOOK_SECRET', SECRET)
+    assert client.post('/public/sync-hook', content=BODY, headers={SIGNATURE_HEADER: _sign(b'')}).status_code == 403
+    assert client.post('/public/sync-hook', content=BODY).status_code == 403
+    assert scheduler.scheduler.get_jobs() == []
+
+    assert client.post('/public/sync-hook', content=BODY, headers={SIGNATURE_HEADER: _sign(BODY)}).status_code == 202
+    _wait_for(lambda: syncs)
+    assert [repo for repo, _ in syncs] == [None]
+
+    # A push to a served repo only syncs that repo
+    body = json.dumps({'repository': {'name': git_utils.get_repo().name}}).encode()
+    assert client.post('/public/sync-hook', content=body, headers={SIGNATURE_HEADER: _sign(body)}).status_code == 202
+    _wait_for(lambda: len(syncs) == 2)
+    assert [repo for repo, _ in syncs] == [None, git_utils.get_repo().name]
+
+def test_syncs_never_overlap(monkeypatch):
+    """ Ensure that concurrent syncs of a repo run one at a time """
+    running, overlaps = [], []
+    def _sync(repo):
+        overlaps.append(len(running))
+        running.append(1)
+        time.sleep(0.05)
+        running.pop()
+    monkeypatch.setattr(git_utils, '_sync_repo', _sync)
+
+    threads = [threading.Thread(target=git_utils.sync_repo) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlaps == [0, 0, 0, 0]
@@ -32,11 +32,14 @@ def reset_db():
     """ After all tests: Empty the database"""
     TABLES = [
         db.DbCommandQueueEntry,
+        db.DbCommandArchiveEntry,
         db.DbClientCommitAccess, 
         db.DbClientAuthChallenge, 
         db.DbClientAuthEvent, 
+        db.DbClientLatestState,
         db.DbClient, 
-        db.DbGitCommit
+        db.DbGitCommit,
+        db.DbRepoSync
     ]
     with db.DbSession() as session:
         for table in TABLES:
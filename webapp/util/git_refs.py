@@ -0,0 +1,95 @@
+from pathlib import Path
+from typing import Optional, Callable, Any
+import os
+import threading
+
+# Prefix of a symbolic ref, e.g. HEAD containing 'ref: refs/heads/main'
+SYMREF_PREFIX = 'ref: '
+# Limit on chains of symbolic refs, which git itself caps at 5
+MAX_SYMREF_DEPTH = 5
+
+
+def _parse_packed_refs(contents: str) -> dict[str, str]:
+    """ Parse a packed-refs file into ref name -> commit hash. Skips the header comment and
+    the peeled hashes of annotated tags, which follow their tag on a line starting with '^' """
+    refs = {}
+    for line in contents.splitlines():
+        if not line or line[0] in '#^':
+            continue
+        commit_hash, ref = line.split(' ', 1)
+        refs[ref] = commit_hash
+    return refs
+
+class GitRefResolver:
+    """ Resolves the refs of a git repository by reading its .git directory, rather than forking
+    git for every lookup. Handles loose refs, refs that git gc has moved into packed-refs, and a
+    detached HEAD. Each file is cached against its inode, mtime and size, so a repeat lookup costs
+    a stat() per file read. Git updates a ref by renaming a lock file over it, so a changed ref
+    has a new inode even if it's rewritten within the resolution of the mtime.
+    """
+    def __init__(self, git_dir: Path):
+        self.git_dir = Path(git_dir)
+        # path -> ((inode, mtime, size), parsed contents)
+        self._files: dict[Path, tuple[tuple[int, int, int], Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _read(self, path: Path, parse: Callable[[str], Any]) -> Any:
+        """ Parse the given file, reusing the last parse if the file hasn't changed since.
+        Returns None if the file doesn't exist """
+        try:
+            stat = os.stat(path)
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            with self._lock:
+                cached = self._files.get(path)
+                if cached is not None and cached[0] == key:
+                    self.hits += 1
+                    return cached[1]
+                self.misses += 1
+            # If the file is replaced after the stat, the next stat won't match and it's read again
+            with open(path, 'r') as f:
+                parsed = parse(f.read())
+        except (FileNotFoundError, NotADirectoryError):
+            with self._lock:
+                self._files.pop(path, None)
+            return None
+
+        with self._lock:
+            self._files[path] = (key, parsed)
+        return parsed
+
+    def read_ref(self, ref: str) -> Optional[str]:
+        """ Read a ref without following it, as either a commit hash or 'ref: <target>' for a
+        symbolic ref. A loose ref takes precedence over a packed one. Returns None if the ref
+        doesn't exist """
+        loose = self._read(self.git_dir / ref, str.strip)
+        if loose is not None:
+            return loose
+        return (self._read(self.git_dir / 'packed-refs', _parse_packed_refs) or {}).get(ref)
+
+    def resolve(self, ref: str = 'HEAD') -> str:
+        """ Get the commit hash of the given ref, e.g. 'HEAD' or 'refs/heads/main', following
+        symbolic refs """
+        name = ref
+        for _ in range(MAX_SYMREF_DEPTH):
+            value = self.read_ref(name)
+            if value is None:
+                raise RuntimeError(f"Unable to resolve ref {name} in {self.git_dir}")
+            if not value.startswith(SYMREF_PREFIX):
+                return value
+            name = value.removeprefix(SYMREF_PREFIX)
+        raise RuntimeError(f"Too many levels of symbolic refs resolving {ref} in {self.git_dir}")
+
+    def current_branch(self) -> Optional[str]:
+        """ Get the name of the branch checked out at HEAD, e.g. 'main', or None if HEAD is detached """
+        head = self.read_ref('HEAD')
+        if head is None:
+            raise RuntimeError(f"Git repository {self.git_dir} is missing its HEAD")
+        if not head.startswith(SYMREF_PREFIX):
+            return None
+        return head.removeprefix(SYMREF_PREFIX).removeprefix('refs/heads/')
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._files), 'hits': self.hits, 'misses': self.misses}
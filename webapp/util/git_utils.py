@@ -1,69 +1,129 @@
 #!/usr/bin/env python3
 import subprocess
 import os
-import signal
 from contextlib import contextmanager
+from typing import Iterator, Optional
+import time
+import threading
 import re
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
 import sys
+import logging
 from models.models import RepoListing
 from datetime import datetime
-from db.db import log_commit_fetch
+from db.db import log_commit_fetch, log_repo_sync
+from util.git_refs import GitRefResolver
+from util.repos import REPO_URLS, DEFAULT_REPO, get_repo_name_from_url
+from util.repo_status_cache import RepoStatusCache
+from util.ssh_agent import SshAgent
 
-# Location of locally cloned version of repo
+logger = logging.getLogger()
+
+# Location of locally cloned versions of the repos
 GIT_PROJECT_ROOT = Path('/var/lib/git/')
 
-# Extract the socket name from the stdout of ssh-agent
-SSH_AUTH_SOCK_RE = re.compile(r'SSH_AUTH_SOCK=([^;]*);')
-# Extract the agent PID from the stdout of ssh-agent
-SSH_AGENT_PID_RE = re.compile(r'SSH_AGENT_PID=([^;]*);')
-# Extract the project name from an upstream URL - assumes clone via SSH
-PROJECT_NAME_RE = re.compile(r'/(.*)\.git')
 # Extract the project host from an upstream URL - assumes clone via SSH
 PROJECT_HOST_RE = re.compile(r'git@(.*):')
 
-# URL of upstream repo to use
-REPO_URL = os.environ.get('REPO_URL')
-# SSH key to use to authenticate to the upstream repo
+# SSH key to use to authenticate to the upstream repos
 SSH_KEY  = os.environ.get('SSH_KEY')
-
-PROJECT_NAME = PROJECT_NAME_RE.search(REPO_URL)[1]
-
+# Directory for the control sockets of multiplexed SSH connections to the upstreams. Keep it short:
+# A socket's path, about 60 characters longer than this, must fit in a Unix socket address
+SSH_CONTROL_DIR = Path(os.environ.get('SSH_CONTROL_DIR', '/tmp/gmfs-ssh'))
+# How long an idle connection to an upstream is held open for the next sync
+SSH_CONTROL_PERSIST = os.environ.get('SSH_CONTROL_PERSIST', '10m')
+
+# Number of repos that are synced at once
+SYNC_WORKERS = int(os.environ.get('SYNC_WORKERS', 4))
+# How long a repo is left alone after a failed sync, doubling with each consecutive failure
+SYNC_BACKOFF_SECONDS = float(os.environ.get('SYNC_BACKOFF_SECONDS', 60))
+SYNC_BACKOFF_MAX_SECONDS = float(os.environ.get('SYNC_BACKOFF_MAX_SECONDS', 3600))
+
+
+class UpstreamRepo:
+    """ A repo cloned under GIT_PROJECT_ROOT from its upstream, with the state kept between syncs.
+    Each repo has its own sync lock, so that a repo is never synced twice at once while different
+    repos sync in parallel
+    """
+    def __init__(self, url: str):
+        self.url = url
+        self.name = get_repo_name_from_url(url)
+        # Reads the refs of the local clone without forking git
+        self.refs = GitRefResolver(self.dir / '.git')
+        # Serialized repo status, invalidated by log_latest_commit when HEAD moves
+        self.status_cache = RepoStatusCache(lambda: get_repo_status(self))
+        # Held for the duration of a sync, so that scheduled and push-triggered syncs never overlap
+        self.sync_lock = threading.Lock()
+        # Hash of the last commit recorded by log_latest_commit, so that unchanged syncs skip it
+        self.logged_commit_hash: Optional[str] = None
+        # Consecutive failed syncs, and the time.monotonic() before which the repo isn't retried
+        self.failures = 0
+        self.retry_after = 0.0
+
+    @property
+    def dir(self) -> Path:
+        return GIT_PROJECT_ROOT / self.name
+
+    def backing_off(self) -> bool:
+        """ Whether the repo's last sync failed recently enough that it shouldn't be retried yet """
+        return time.monotonic() < self.retry_after
+
+    def sync_failed(self) -> float:
+        """ Back off from the repo after a failed sync, returning the number of seconds until it's retried """
+        self.failures += 1
+        delay = min(SYNC_BACKOFF_SECONDS * 2 ** (self.failures - 1), SYNC_BACKOFF_MAX_SECONDS)
+        self.retry_after = time.monotonic() + delay
+        return delay
+
+    def sync_succeeded(self):
+        self.failures = 0
+        self.retry_after = 0.0
+
+# Repos to serve, by name
+repos: dict[str, UpstreamRepo] = {repo.name: repo for repo in map(UpstreamRepo, REPO_URLS)}
+
+# Bounded pool of workers for syncing the repos in parallel
+sync_pool = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix='repo-sync')
+
+# Long-lived agent for syncs, started and stopped by the app lifespan. Its multiplexed connections
+# are shared by every repo on the same upstream host
+upstream_agent = SshAgent(SSH_KEY, SSH_CONTROL_DIR, SSH_CONTROL_PERSIST)
+
+
+def get_repo(repo_name: Optional[str] = None) -> Optional[UpstreamRepo]:
+    """ Get the repo with the given name, or the default repo if no name is given. Returns
+    None if no such repo is served """
+    return repos.get(repo_name or DEFAULT_REPO)
 
 @contextmanager
-def ssh_agent_session(ssh_key_path: str):
-    """ Run the context within an eval $(ssh-agent), closing the agent at the end """
-    ssh_agent_out, ssh_agent_err = subprocess.Popen('ssh-agent', stdout=subprocess.PIPE).communicate()
-    socket_line, pid_line, *_ = [l.decode() for l in ssh_agent_out.splitlines()]
-
-    socket_match = SSH_AUTH_SOCK_RE.search(socket_line)
-    pid_match = SSH_AGENT_PID_RE.search(pid_line)
-    if not socket_match or not pid_match:
-        raise RuntimeError(f"Unexpected ssh-agent output: {ssh_agent_out.decode()}")
-
-    os.environ['SSH_AUTH_SOCK'] = socket_match[1]
-    os.environ['SSH_AGENT_PID'] = pid_match[1]
+def ssh_agent_session(ssh_key_path: str) -> Iterator[dict[str, str]]:
+    """ Run the context with an ssh-agent holding the given key, yielding the environment to
+    run git with. Uses the long-lived agent if it's running, otherwise an agent is started for
+    the context and closed at the end """
+    if ssh_key_path == SSH_KEY and upstream_agent.running:
+        yield upstream_agent.env()
+        return
 
+    agent = SshAgent(ssh_key_path, SSH_CONTROL_DIR, SSH_CONTROL_PERSIST)
+    agent.start()
     try:
-        subprocess.run(['ssh-add', ssh_key_path])
-        yield
+        yield agent.env()
     finally:
-        os.kill(int(os.environ['SSH_AGENT_PID']), signal.SIGTERM)
-
-def get_repo_name_from_url(repo_url: str):
-    """ Extract the name of a repo from its upstream url """
-    if not (repo_name_match := PROJECT_NAME_RE.search(repo_url)):
-        raise RuntimeError(f"Unable to determine repo name from {repo_url}")
-    return repo_name_match[1]
-
+        agent.stop()
 
-def trust_upstream_host():
-    """ Add a host's fingerprints to known_hosts prior to cloning """
-    if not (host_match := PROJECT_HOST_RE.search(REPO_URL)):
-        raise RuntimeError(f"Unable to determine remote upstream host name from {REPO_URL}")
+def trust_upstream_hosts():
+    """ Add the fingerprints of each repo's upstream host to known_hosts prior to cloning """
+    hosts = []
+    for repo in repos.values():
+        if not (host_match := PROJECT_HOST_RE.search(repo.url)):
+            raise RuntimeError(f"Unable to determine remote upstream host name from {repo.url}")
+        if host_match[1] not in hosts:
+            hosts.append(host_match[1])
 
     with open(Path.home() / '.ssh' / 'known_hosts', 'a') as known_hosts:
-        subprocess.run(['ssh-keyscan', host_match[1]], stdout=known_hosts)
+        for host in hosts:
+            subprocess.run(['ssh-keyscan', host], stdout=known_hosts)
 
 def cloned_repo_exists(repo_url: str):
     """ Check whether the given repo is already cloned. If it is, confirm the origin is correct """
@@ -82,63 +142,110 @@ def cloned_repo_exists(repo_url: str):
     
     return True
 
-def log_latest_commit():
+def log_latest_commit(repo: UpstreamRepo = None):
     """ Add an entry to the access tracking database indicating that a new commit has been
-    pulled from upstream 
+    pulled from upstream. Only forks git to read the commit time when HEAD has moved
     """
-    repo_dir = GIT_PROJECT_ROOT / PROJECT_NAME
-    commit_info, _ = subprocess.Popen(['git','show','--no-patch','--format=%H,%ct','HEAD'],
-                                      stdout=subprocess.PIPE, cwd=repo_dir).communicate()
-    commit_hash, commit_timestamp = commit_info.decode().strip().split(',')
-    log_commit_fetch(commit_hash, datetime.fromtimestamp(int(commit_timestamp)))
-
-    
-def clone_repo():
-    """ Clone the repo at the given url """
-
-    if cloned_repo_exists(REPO_URL):
-        sync_repo()
+    repo = repo or get_repo()
+    commit_hash = repo.refs.resolve('HEAD')
+    if commit_hash == repo.logged_commit_hash:
         return
+    # HEAD has already moved, so the cached status is stale even if logging the commit fails
+    repo.status_cache.invalidate()
+
+    commit_info, _ = subprocess.Popen(['git','show','--no-patch','--format=%ct',commit_hash],
+                                      stdout=subprocess.PIPE, cwd=repo.dir).communicate()
+    log_commit_fetch(commit_hash, datetime.fromtimestamp(int(commit_info.decode().strip())), repo.name)
+    repo.logged_commit_hash = commit_hash
 
-    with ssh_agent_session(SSH_KEY):
-        repo_name = get_repo_name_from_url(REPO_URL)
-        subprocess.run(['git', 'clone', REPO_URL, repo_name], cwd=GIT_PROJECT_ROOT)
-        log_latest_commit()
-
-def sync_repo():
-    """ Hard reset the state of the repo to the given upstream """
-    with ssh_agent_session(SSH_KEY):
-        repo_name = PROJECT_NAME_RE.search(REPO_URL)[1]
-        repo_dir = GIT_PROJECT_ROOT / repo_name
-        branch_info, _ = subprocess.Popen(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], stdout=subprocess.PIPE, cwd=repo_dir).communicate()
-        branch_name = branch_info.decode().strip()
-        subprocess.run(['git', 'fetch', '--all'], cwd=repo_dir)
-        subprocess.run(['git', 'reset', '--hard', f'origin/{branch_name}'], cwd=repo_dir)
-        log_latest_commit()
-
-def get_latest_commit_hash() -> str:
-    """ Read the active git hash of the repo
-    TODO this is somewhat fragile, want to avoid spinning up a separate git cli instance
-    for each client request though. 
-    """
-    # Get the active ref from HEAD
-    git_repo_dir = GIT_PROJECT_ROOT / PROJECT_NAME_RE.search(REPO_URL)[1]
-    git_head_file = git_repo_dir / '.git' / 'HEAD'
-    if not git_head_file.exists():
-        raise RuntimeError(f"Git repository {git_repo_dir} is missing its .git directory")
-    with open(git_head_file, 'r') as head:
-        active_ref = head.read().strip()
-    
-    if not active_ref.startswith('ref:'):
-        raise RuntimeError(f"Unable to parse HEAD ref: {active_ref}")
     
-    # Return the hash of the active ref
-    active_ref_path = git_repo_dir / '.git' / active_ref.removeprefix('ref: ')
-    with open(active_ref_path, 'r') as ref:
-        return ref.read().strip()
+def clone_repo(repo: UpstreamRepo = None):
+    """ Clone the given repo from its upstream, or sync it if it's already cloned """
+    repo = repo or get_repo()
+    # Confirms the origin of an existing clone. A missing clone is cloned by the sync
+    cloned_repo_exists(repo.url)
+    sync_repo(repo)
+
+def clone_repos():
+    """ Clone or sync every repo, SYNC_WORKERS at a time """
+    for future in [sync_pool.submit(clone_repo, repo) for repo in repos.values()]:
+        future.result()
 
-def get_repo_status() -> RepoListing:
+@contextmanager
+def _timed(stage_seconds: dict[str, float], stage: str):
+    """ Record the time taken by the context as the given stage """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds[stage] = round(time.perf_counter() - start, 6)
+
+def get_upstream_commit_hash(repo_dir: Path, branch_name: str, git_env: dict[str, str]) -> Optional[str]:
+    """ Ask the upstream for the hash of the given branch, without fetching anything. Returns
+    None if it can't be determined """
+    ref = 'HEAD' if branch_name == 'HEAD' else f'refs/heads/{branch_name}'
+    result = subprocess.run(['git', 'ls-remote', 'origin', ref], cwd=repo_dir, env=git_env, stdout=subprocess.PIPE)
+    if result.returncode != 0 or not (ls_remote_out := result.stdout.decode().split()):
+        return None
+    return ls_remote_out[0]
+
+def sync_repo(repo: UpstreamRepo = None) -> bool:
+    """ Hard reset the state of the given repo to its upstream, cloning it if it isn't yet. The
+    fetch and reset are skipped if the upstream branch is already checked out, which costs a
+    single ls-remote round trip. A failed sync is logged and backed off from by sync_repos.
+    Returns whether the sync succeeded """
+    repo = repo or get_repo()
+    with repo.sync_lock:
+        try:
+            _sync_repo(repo)
+        except Exception:
+            delay = repo.sync_failed()
+            logger.exception(f"Failed to sync {repo.name}, retrying in {delay:.0f}s")
+            return False
+        repo.sync_succeeded()
+        return True
+
+def _sync_repo(repo: UpstreamRepo):
+    started = datetime.now()
+    stage_seconds = {}
+    with _timed(stage_seconds, 'total'), ssh_agent_session(SSH_KEY) as git_env:
+        if not repo.dir.exists():
+            subprocess.run(['git', 'clone', repo.url, repo.name], cwd=GIT_PROJECT_ROOT, env=git_env, check=True)
+            log_latest_commit(repo)
+            return
+        # As with git rev-parse --abbrev-ref, a detached HEAD is reset to the upstream's HEAD
+        branch_name = repo.refs.current_branch() or 'HEAD'
+        with _timed(stage_seconds, 'ls_remote'):
+            upstream_hash = get_upstream_commit_hash(repo.dir, branch_name, git_env)
+        # If the upstream couldn't be asked, fall back to a full sync
+        changed = upstream_hash is None or upstream_hash != repo.refs.resolve('HEAD')
+        if changed:
+            with _timed(stage_seconds, 'fetch'):
+                subprocess.run(['git', 'fetch', '--all'], cwd=repo.dir, env=git_env, check=True)
+            with _timed(stage_seconds, 'reset'):
+                subprocess.run(['git', 'reset', '--hard', f'origin/{branch_name}'], cwd=repo.dir, env=git_env, check=True)
+            with _timed(stage_seconds, 'log_commit'):
+                log_latest_commit(repo)
+        else:
+            # In case logging the commit failed after an earlier sync reset to it. A no-op once it's logged
+            log_latest_commit(repo)
+    log_repo_sync(repo.name, started, changed, repo.refs.resolve('HEAD'), stage_seconds)
+
+def sync_repos(wait_for_running: bool = False):
+    """ Sync every repo on the bounded pool of sync workers. Repos that are backing off after a
+    failed sync are skipped, as are repos that are already being synced, unless wait_for_running
+    is set. Those are then synced again once the running sync is done """
+    wait([sync_pool.submit(sync_repo, repo) for repo in repos.values()
+          if not repo.backing_off() and (wait_for_running or not repo.sync_lock.locked())])
+
+def get_latest_commit_hash(repo: UpstreamRepo = None) -> str:
+    """ Read the active git hash of the repo, without spinning up a separate git cli
+    instance for each client request """
+    return (repo or get_repo()).refs.resolve('HEAD')
+
+def get_repo_status(repo: UpstreamRepo = None) -> RepoListing:
+    repo = repo or get_repo()
     return RepoListing(
-        name=PROJECT_NAME,
-        commit_hash=get_latest_commit_hash(),
-        upstream=REPO_URL)
+        name=repo.name,
+        commit_hash=get_latest_commit_hash(repo),
+        upstream=repo.url)
@@ -0,0 +1,62 @@
+from models.models import RepoListing
+from typing import Callable, Optional
+import threading
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """ Check an If-None-Match header, which may list several entity tags, against an ETag.
+    Uses the weak comparison that RFC 9110 specifies for If-None-Match """
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in tags
+
+class RepoStatusCache:
+    """ Holds the serialized RepoListing of the repo, with its commit hash as the ETag, so
+    that polling the repo status doesn't touch the filesystem. The repo only changes when it's
+    synced, so the sync invalidates the cache when HEAD moves.
+    """
+    def __init__(self, load: Callable[[], RepoListing]):
+        self._load = load
+        # (RepoListing, ETag, serialized RepoListing), or None until the next request loads it
+        self._entry: Optional[tuple[RepoListing, str, bytes]] = None
+        # Bumped on each invalidation, so that a load that raced with one isn't kept
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_cached(self) -> Optional[tuple[RepoListing, str, bytes]]:
+        """ Get the RepoListing of the repo, with its ETag and serialized form, if it's cached. Never
+        loads the repo, so it's safe to call from the event loop """
+        with self._lock:
+            if self._entry is not None:
+                self.hits += 1
+            return self._entry
+
+    def get(self) -> tuple[RepoListing, str, bytes]:
+        """ Get the RepoListing of the repo, with its ETag and serialized form """
+        with self._lock:
+            entry = self._entry
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self._generation
+
+        repo = self._load()
+        entry = (repo, f'"{repo.commit_hash}"', repo.model_dump_json().encode())
+        with self._lock:
+            if self._generation == generation:
+                self._entry = entry
+        return entry
+
+    def invalidate(self):
+        """ Drop the cached listing, to be reloaded on the next request """
+        with self._lock:
+            self._entry = None
+            self._generation += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': int(self._entry is not None), 'hits': self.hits, 'misses': self.misses}
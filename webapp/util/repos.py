@@ -0,0 +1,20 @@
+from os import environ
+import re
+
+# Extract the project name from an upstream URL - assumes clone via SSH
+PROJECT_NAME_RE = re.compile(r'/(.*)\.git')
+
+
+def get_repo_name_from_url(repo_url: str):
+    """ Extract the name of a repo from its upstream url """
+    if not (repo_name_match := PROJECT_NAME_RE.search(repo_url)):
+        raise RuntimeError(f"Unable to determine repo name from {repo_url}")
+    return repo_name_match[1]
+
+# URLs of the upstream repos to serve, separated by whitespace or commas. Falls back to the
+# single repo in REPO_URL
+REPO_URLS = [url for url in re.split(r'[\s,]+', environ.get('REPO_URLS') or environ.get('REPO_URL') or '') if url]
+
+# Repo that requests which don't name one refer to, so that clients from before multi-repo
+# serving keep working
+DEFAULT_REPO = get_repo_name_from_url(REPO_URLS[0]) if REPO_URLS else None
@@ -0,0 +1,104 @@
+from pathlib import Path
+from typing import Optional
+import subprocess
+import os
+import re
+import signal
+import threading
+
+# Extract the socket name from the stdout of ssh-agent
+SSH_AUTH_SOCK_RE = re.compile(r'SSH_AUTH_SOCK=([^;]*);')
+# Extract the agent PID from the stdout of ssh-agent
+SSH_AGENT_PID_RE = re.compile(r'SSH_AGENT_PID=([^;]*);')
+
+
+class SshAgent:
+    """ An ssh-agent holding a single key, with the environment for running git against an SSH
+    upstream through it. Connections to the upstream are multiplexed over an SSH ControlMaster
+    that's kept open for control_persist after its last use, so that consecutive fetches skip
+    the SSH handshake. The environment is passed to each subprocess rather than set on
+    os.environ, so that agents and syncs don't interfere with each other across threads.
+    Each agent keeps its control sockets in its own directory under control_dir, so that
+    stopping it only closes the connections it opened.
+    """
+    def __init__(self, ssh_key_path: str, control_dir: Path, control_persist: str):
+        self._ssh_key_path = ssh_key_path
+        self._control_root = Path(control_dir)
+        self._control_dir: Optional[Path] = None
+        self._control_persist = control_persist
+        self._env: Optional[dict[str, str]] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _ssh_command(self) -> str:
+        # %C is a hash of the connection's host, port and user, so each upstream gets its own master
+        return (f"ssh -o ControlMaster=auto -o ControlPath={self._control_dir}/%C "
+                f"-o ControlPersist={self._control_persist}")
+
+    def _alive(self) -> bool:
+        # The agent removes its socket when it exits. Its pid isn't a reliable check, since the
+        # agent daemonizes and may linger as a zombie where nothing reaps orphans
+        return self._env is not None and os.path.exists(self._env['SSH_AUTH_SOCK'])
+
+    def start(self):
+        """ Start the agent and add the key to it """
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        agent_out = subprocess.run(['ssh-agent', '-s'], stdout=subprocess.PIPE, check=True).stdout.decode()
+        socket_match = SSH_AUTH_SOCK_RE.search(agent_out)
+        pid_match = SSH_AGENT_PID_RE.search(agent_out)
+        if not socket_match or not pid_match:
+            raise RuntimeError(f"Unexpected ssh-agent output: {agent_out}")
+
+        self._pid = int(pid_match[1])
+        self._control_root.mkdir(mode=0o700, parents=True, exist_ok=True)
+        self._control_dir = self._control_root / f"agent-{self._pid}"
+        self._control_dir.mkdir(mode=0o700, exist_ok=True)
+        self._env = {
+            **os.environ,
+            'SSH_AUTH_SOCK': socket_match[1],
+            'SSH_AGENT_PID': pid_match[1],
+            'GIT_SSH_COMMAND': self._ssh_command(),
+        }
+        subprocess.run(['ssh-add', self._ssh_key_path], env=self._env)
+
+    def _close_connections(self):
+        """ Close the multiplexed connections opened through this agent """
+        if self._control_dir is None:
+            return
+        for control_socket in self._control_dir.glob('*'):
+            subprocess.run(['ssh', '-o', f'ControlPath={control_socket}', '-O', 'exit', 'upstream'],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            self._control_dir.rmdir()
+        except OSError:
+            pass
+        self._control_dir = None
+
+    def stop(self):
+        """ Close the agent's multiplexed connections and kill the agent """
+        with self._lock:
+            if self._pid is None:
+                return
+            self._close_connections()
+            try:
+                os.kill(self._pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self._pid = None
+            self._env = None
+
+    @property
+    def running(self) -> bool:
+        with self._lock:
+            return self._pid is not None
+
+    def env(self) -> dict[str, str]:
+        """ Get the environment for git subprocesses, restarting the agent if it has died """
+        with self._lock:
+            if not self._alive():
+                self._close_connections()
+                self._start()
+            return self._env
@@ -0,0 +1,18 @@
+from typing import Optional
+from os import environ
+import hashlib
+import hmac
+
+# Shared secret that push notifications to /public/sync-hook are signed with. The hook is
+# disabled if it isn't set
+SYNC_HOOK_SECRET = environ.get('SYNC_HOOK_SECRET')
+# Header carrying the signature, in the 'sha256=<hex digest>' form that GitHub and Gitea send
+SIGNATURE_HEADER = 'X-Hub-Signature-256'
+
+
+def verify_signature(secret: str, body: bytes, signature: Optional[str]) -> bool:
+    """ Check that the signature header is the HMAC-SHA256 of the request body under the secret """
+    if not signature or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.removeprefix('sha256='))